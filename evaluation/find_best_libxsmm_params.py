@@ -0,0 +1,83 @@
+import setup  # noqa # isort:skip
+
+from itertools import product
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from measure import measure_all
+from tqdm import tqdm
+
+from onnx2code.ops.gemm import (
+    LIBXSMM_PARAMS_PATH,
+    LIBXSMM_PREFETCHES,
+    LibxsmmParams,
+    load_libxsmm_params,
+    save_libxsmm_params,
+    set_libxsmm_params,
+)
+from onnx2code.targets import host_target
+
+# (N, M, K), the GEMMs that matter for the models we generate
+SHAPES = [
+    (64, 64, 64),
+    (128, 128, 128),
+    (256, 256, 256),
+    (512, 512, 512),
+    (1024, 1024, 1024),
+    (64, 4096, 64),
+    (256, 1024, 4096),
+]
+
+ALIGNED_OPTIONS = [False, True]
+
+target = host_target()
+arch = target.libxsmm if target is not None else "hsw"
+
+# keep the measurements of other shapes and archs
+best = load_libxsmm_params(LIBXSMM_PARAMS_PATH)
+results = pd.DataFrame(columns=["arch", "N", "M", "K", "prefetch", "aligned", "time"])
+
+for N, M, K in tqdm(SHAPES, desc="Shapes"):
+    model = tf.keras.Sequential(
+        [
+            tf.keras.Input(shape=(N, M)),
+            tf.keras.layers.Dense(K, activation=None, use_bias=False),
+        ]
+    )
+
+    times: dict[LibxsmmParams, float] = {}
+
+    for prefetch, aligned in tqdm(
+        list(product(LIBXSMM_PREFETCHES, ALIGNED_OPTIONS)),
+        desc="libxsmm params",
+        leave=False,
+    ):
+        params = LibxsmmParams(prefetch=prefetch, aligned=aligned)
+        set_libxsmm_params({(arch, N, M, K): params})
+
+        data = measure_all(
+            model,
+            variations=["libxsmm"],
+            measure_base=False,
+            runs=300,
+            tqdm_leave=False,
+        )
+
+        assert len(data) == 1
+        times[params] = float(np.mean(data[next(iter(data.keys()))]))
+
+        entry = {
+            "arch": arch,
+            "N": N,
+            "M": M,
+            "K": K,
+            "prefetch": prefetch,
+            "aligned": aligned,
+            "time": times[params],
+        }
+        results = pd.concat([results, pd.DataFrame.from_records([entry])])
+        results.to_csv("results_libxsmm.csv", index=False)
+
+    best[(arch, N, M, K)] = min(times, key=lambda p: times[p])
+    save_libxsmm_params(LIBXSMM_PARAMS_PATH, best)
@@ -0,0 +1,49 @@
+# Time and arena size of the memory layout strategies on synthetic graphs
+#
+# Usage: python measure_memory.py [--sizes 10000 100000]
+
+import setup  # noqa # isort:skip
+
+import argparse
+import random
+import time
+
+from onnx2code.memory import (
+    Records,
+    TensorUsageRecord,
+    greedy_by_breadth,
+    greedy_by_size,
+    greedy_by_size_improved,
+    lower_bound,
+)
+
+STRATEGIES = [greedy_by_size, greedy_by_size_improved, greedy_by_breadth]
+
+
+def synthetic_records(n: int, seed: int = 0) -> Records:
+    """
+    Chain-like graph: most tensors die right after they are consumed,
+    a few of them (skip connections) live much longer
+    """
+    rng = random.Random(seed)
+    records = []
+    for op in range(n):
+        lifetime = rng.randint(1, 3) if rng.random() < 0.9 else rng.randint(4, 200)
+        size = rng.choice([1, 4, 16, 64]) * rng.randint(1, 4096)
+        records.append(TensorUsageRecord(op, op + lifetime, size))
+    return records
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 30000, 100000])
+args = parser.parse_args()
+
+for n in args.sizes:
+    records = synthetic_records(n)
+    print(f"{n} tensors, lower bound {lower_bound(records)}")
+
+    for strategy in STRATEGIES:
+        start = time.perf_counter()
+        size, _ = strategy(records)
+        elapsed = time.perf_counter() - start
+        print(f"  {strategy.__name__:<24} {size:>12} {elapsed:8.2f}s")
@@ -21,6 +21,45 @@ def main() -> None:
         default="asm, c",
         action="store",
     )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        help="number of threads the generated code uses",
+        default=1,
+        action="store",
+    )
+    parser.add_argument(
+        "--pin-threads",
+        help="pin each thread of the generated code to a core",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--layout-time-budget",
+        type=float,
+        help="seconds the exact memory layout solver can use (0 to skip it)",
+        default=0,
+        action="store",
+    )
+    parser.add_argument(
+        "--alignment",
+        type=int,
+        help="alignment in bytes of the intermediate and weight tensors",
+        default=64,
+        action="store",
+    )
+    parser.add_argument(
+        "--embed-weights",
+        help="embed weights.bin in model.asm (the weights parameter is ignored)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--targets",
+        type=str,
+        help="instruction sets to emit kernels for (avx512, avx2, sse4.2), "
+        + "the best one the CPU supports is picked at load time",
+        default="",
+        action="store",
+    )
     parser.add_argument(
         "--checks",
         type=int,
@@ -38,9 +77,19 @@ def main() -> None:
         sys.exit(1)
 
     variations = [v.strip() for v in args.variations.split(",")]
+    targets = [t.strip() for t in args.targets.split(",") if t.strip() != ""]
 
     try:
-        result = Generator(model_proto, variations).generate()
+        result = Generator(
+            model_proto,
+            variations,
+            threads=args.threads,
+            pin_threads=args.pin_threads,
+            layout_time_budget=args.layout_time_budget,
+            alignment=args.alignment,
+            embed_weights=args.embed_weights,
+            targets=targets,
+        ).generate()
     except Exception as e:
         print("Error generating code: ", e)
         sys.exit(2)
@@ -48,6 +97,9 @@ def main() -> None:
     print("Input shapes:", result.input_shapes)
     print("Output shapes:", result.output_shapes)
     print("Weights size (floats):", result.weights.size)
+    print("Intermediates size (floats) by memory strategy:")
+    for strategy, size in result.memory_layouts.items():
+        print(f"  {strategy}: {size}")
 
     path = Path(args.output_folder)
     print("Writing files to", path.resolve())
@@ -55,13 +55,27 @@ def check_model_result(
 
 
 def check_model(
-    model_proto: onnx.ModelProto, variations: list[str] = [], n_inputs: int = 1
+    model_proto: onnx.ModelProto,
+    variations: list[str] = [],
+    n_inputs: int = 1,
+    threads: int = 1,
+    embed_weights: bool = False,
+    targets: list[str] = [],
 ) -> None:
     """
     Generates code for the given model and checks if the generated output matches the reference runtime (ONNX Runtime)
 
     :param n_inputs: random inputs will be generated
+    :param threads: threads the generated code uses
+    :param embed_weights: embed the weights in the ASM
+    :param targets: instruction sets to dispatch to at load time
     """
-    result = Generator(model_proto, variations).generate()
+    result = Generator(
+        model_proto,
+        variations,
+        threads=threads,
+        embed_weights=embed_weights,
+        targets=targets,
+    ).generate()
 
     check_model_result(model_proto, result, n_inputs)
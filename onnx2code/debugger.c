@@ -30,7 +30,7 @@ int main(int argc, char** argv) {
     long outputs_size;
 
     const float* inputs = (const float*)read_file("./sample_inputs.bin", NULL);
-    const float* weights = (const float*)read_file("./weights.bin", NULL);
+    const float* weights = map_weights("./weights.bin");
     const float* truth_outputs = (const float*)read_file("./sample_outputs.bin", &outputs_size);
     float* outputs = (float*)malloc(outputs_size);
 
@@ -2,6 +2,7 @@ import os
 import re
 import warnings
 from collections import defaultdict
+from dataclasses import replace
 from itertools import chain
 from pathlib import Path
 from textwrap import dedent, indent
@@ -10,14 +11,32 @@ import numpy as np
 import onnx
 import onnxsim.onnx_simplifier as onnx_simplifier
 
-from .memory import TensorUsageRecord, find_best_layout
+from .memory import TensorUsageRecord, compare_layouts
+from .ops.conv import supports_blocked
+from .ops.epilogue import (
+    EPILOGUE_ACTIVATIONS,
+    EPILOGUE_BROADCASTS,
+    Epilogue,
+    EpilogueStep,
+    is_channel_constant,
+)
+from .ops.layout import NHWC, blocked_layout, blocked_size
 from .ops.operation import OpCall, Operation, OpImpl
 from .result import ModelResult
-from .tensor import TensorData, parse_tensors
-from .util import get_fixed_input_shapes
+from .targets import TARGET_MACROS, dispatching, parse_targets
+from .tensor import TensorData, TensorInfo, TensorTag, parse_tensors
+from .util import get_attribute, get_fixed_input_shapes
 
 REGISTER_ORDER = ["rdi", "rsi", "rdx", "rcx", "r8", "r9"]
 INFERENCE_SIGNATURE = "void __attribute__ ((noinline)) inference(const float* weights, const float* inputs, float* outputs)"
+# symbol of the weights when they are embedded in the ASM
+EMBEDDED_WEIGHTS = "o2c_weights"
+
+# operators that accept a fused epilogue, with the axis of their output
+# that per-channel constants broadcast along
+EPILOGUE_PRODUCERS = {"Conv": 1, "Gemm": -1, "MatMul": -1}
+# reshapes an epilogue can be fused through (they are no-ops in runtime)
+EPILOGUE_RESHAPES = {"Reshape", "Squeeze", "Unsqueeze", "Flatten"}
 
 
 class Generator:
@@ -27,7 +46,30 @@ class Generator:
     Proto ref: https://github.com/onnx/onnx/blob/main/docs/IR.md
     """
 
-    def __init__(self, _model_proto: onnx.ModelProto, variations: list[str] = []):
+    def __init__(
+        self,
+        _model_proto: onnx.ModelProto,
+        variations: list[str] = [],
+        threads: int = 1,
+        pin_threads: bool = False,
+        layout_time_budget: float = 0,
+        alignment: int = 64,
+        embed_weights: bool = False,
+        targets: list[str] = [],
+    ):
+        """
+        :param variations: Variation priority
+        :param threads: Number of threads the generated code uses (1 means serial)
+        :param pin_threads: Pin each thread to a core
+        :param layout_time_budget: Seconds the exact memory layout solver can use
+            (0 to only use the heuristics)
+        :param alignment: Alignment in bytes of the intermediate and weight tensors
+        :param embed_weights: Include weights.bin in the assembly (incbin) so the
+            weights are a link-time constant, the `weights` parameter is ignored
+        :param targets: Instruction sets to emit a copy of the kernels for, the widest
+            one the CPU supports is picked at load time (empty: only the instruction
+            sets the code is compiled with)
+        """
         try:
             model_proto, check = onnx_simplifier.simplify(
                 model=_model_proto,
@@ -46,7 +88,19 @@ class Generator:
 
         self.model_proto = model_proto
         self.tensors = {tensor.name: tensor for tensor in parse_tensors(model_proto)}
+        # nodes to emit, graph passes rewrite copies so the proto is left untouched
+        self.nodes = list(model_proto.graph.node)
         self.variations = variations + ["c", "asm"]
+        self.threads = threads
+        self.pin_threads = pin_threads
+        self.layout_time_budget = layout_time_budget
+        # the weights are mapped, so they can't be aligned beyond a page
+        assert (
+            4 <= alignment <= 4096 and alignment & (alignment - 1) == 0
+        ), "alignment must be a power of two between 4 and 4096 (in bytes)"
+        self.alignment = alignment
+        self.embed_weights = embed_weights
+        self.targets = parse_targets(targets)
 
         self.impls: dict[OpImpl, OpCall] = {}
         self.calls: list[OpCall] = []
@@ -65,71 +119,588 @@ class Generator:
         if self.tensors[name_to].tag != "output":
             self.tensors[name_to].tag = "welded"
 
-    def generate(self) -> ModelResult:
+    def _add_tensor(
+        self, name: str, tag: TensorTag, shape: list[int], data: TensorData | None
+    ) -> TensorInfo:
         """
-        Generate C and ASM code to run the model
+        Adds a new tensor to the model (for example, a folded weight)
+        """
+        tensor = TensorInfo(
+            name=name,
+            tag=tag,
+            shape=shape,
+            size=int(np.prod(shape)),
+            data=data,
+            variable=f"T{len(self.tensors)}",
+        )
+        self.tensors[name] = tensor
+        return tensor
+
+    def _fold_batch_normalization(self) -> None:
         """
-        for node in self.model_proto.graph.node:
-            if node.op_type in [
-                # Reshape/Squeeze/Unsqueeze operator ⚠️ SPECIAL CASE ⚠️
-                #
-                # https://github.com/onnx/onnx/blob/main/docs/Operators.md#reshape
-                # https://github.com/onnx/onnx/blob/main/docs/Operators.md#squeeze
-                # https://github.com/onnx/onnx/blob/main/docs/Operators.md#unsqueeze
-                "Reshape",
-                "Squeeze",
-                "Unsqueeze",
-                # have no effect during inference
-                "Dropout",
-                "BatchNormalization",  # are we sure about this one?
-                # other kind of reshape
-                "Flatten",
-            ]:
-                # Since it just reshapes the tensor, we don't need to do anything in runtime
-                # But we must must be weld the input and output tensors (variables/data)
-                self.weld_tensors(node.input[0], node.output[0])
+        Folds BatchNormalization nodes into the weights of the preceding Conv or Gemm
+
+            y = (x - mean) / sqrt(var + epsilon) * scale + B = x * s + (B - mean * s)
+
+        so the filters (or columns of B) are scaled by s and the bias is shifted.
+        BatchNormalization nodes that can't be folded are kept and computed at runtime
+        """
+        producers = {name: node for node in self.nodes for name in node.output}
+
+        consumers: defaultdict[str, int] = defaultdict(int)
+        for node in self.nodes:
+            for name in node.input:
+                consumers[name] += 1
+
+        def constant(name: str) -> TensorData | None:
+            tensor = self.tensors.get(name)
+            if tensor is None or tensor.tag != "weight" or tensor.data is None:
+                return None
+            if tensor.data.dtype != np.float32:
+                return None
+            return tensor.data
+
+        def rewrite(node: onnx.NodeProto, index: int, data: TensorData) -> None:
+            # update in place unless some other node reads the same weight
+            name = node.input[index] if index < len(node.input) else ""
+
+            if name != "" and consumers[name] == 1:
+                tensor = self.tensors[name]
+                tensor.data = data.astype(np.float32)
+                tensor.shape = list(data.shape)
+                tensor.size = data.size
+            else:
+                new_name = f"{node.output[0]}_folded_{index}"
+                self._add_tensor(
+                    new_name, "weight", list(data.shape), data.astype(np.float32)
+                )
+                if index < len(node.input):
+                    node.input[index] = new_name
+                else:
+                    node.input.append(new_name)
+
+        nodes: list[onnx.NodeProto] = []
+        folded: dict[int, onnx.NodeProto] = {}
+
+        for node in self.nodes:
+            if node.op_type != "BatchNormalization" or len(node.output) != 1:
+                nodes.append(node)
+                continue
 
+            X = node.input[0]
+            producer = producers.get(X)
+            params = [constant(name) for name in node.input[1:5]]
+
+            if (
+                producer is None
+                or producer.op_type not in ["Conv", "Gemm", "MatMul"]
+                or self.tensors[X].tag != "intermediate"
+                or consumers[X] != 1
+                or any(p is None for p in params)
+            ):
+                nodes.append(node)
                 continue
 
-            variants = Operation.get(node.op_type, self.variations)
+            scale, B, mean, var = params  # type: ignore
+            epsilon = get_attribute(node, "epsilon", 1e-5)
+            s = scale / np.sqrt(var + epsilon)
+            shift = B - mean * s
 
-            impl: (OpImpl | None) = None
-            call: (OpCall | None) = None
-            ex: (Exception | None) = None
+            # fold into a copy, the original proto is left untouched
+            new = onnx.NodeProto()
+            new.CopyFrom(producer)
 
-            # we try all the variants we have available, in the order specified
-            # if one throws NotImplemented, we try the next one
-            for var in variants:
-                try:
-                    op = var(
-                        node,
-                        [self.tensors[name] for name in node.input],
-                        [self.tensors[name] for name in node.output],
+            W = constant(new.input[1])
+            bias = constant(new.input[2]) if len(new.input) > 2 else None
+
+            if W is None or (len(new.input) > 2 and bias is None):
+                nodes.append(node)
+                continue
+
+            if producer.op_type == "Conv":
+                # W: (F x KC x KH x KW), bias: (F)
+                rewrite(new, 1, W * s.reshape(-1, *[1] * (W.ndim - 1)))
+                rewrite(new, 2, (0 if bias is None else bias) * s + shift)
+            else:
+                # only for (N x K) outputs, the channel is the column
+                Y = self.tensors[X]
+                transB = get_attribute(new, "transB", 0) != 0
+                beta = get_attribute(new, "beta", 1.0)
+
+                if len(Y.shape) != 2 or W.ndim != 2 or beta != 1.0:
+                    nodes.append(node)
+                    continue
+
+                # B: (M x K), or (K x M) if transposed
+                rewrite(new, 1, W * (s.reshape(-1, 1) if transB else s))
+                # C keeps its shape, (K) if there was none (broadcast over the rows)
+                C = (0 if bias is None else bias) * s + shift
+                if np.any(C != 0):
+                    rewrite(new, 2, C)
+                elif len(new.input) > 2:
+                    del new.input[2]
+
+            # the producer writes directly to the output of the BatchNormalization
+            self.weld_tensors(node.output[0], X)
+            new.output[0] = node.output[0]
+
+            folded[id(producer)] = new
+
+        # replace the folded producers
+        self.nodes = [folded.get(id(node), node) for node in nodes]
+
+    def _eliminate_transposes(self) -> None:
+        """
+        Removes the Transpose nodes that can be done without moving data
+        (exporters of TF models add plenty of them):
+
+        - two consecutive transposes are merged into one, or removed if they cancel out
+        - a transpose of a matrix read by Gemm/MatMul is folded into its transA/transB
+
+        The remaining ones run the blocked kernel of TransposeC
+        """
+
+        def perm_of(node: onnx.NodeProto) -> list[int]:
+            rank = len(self.tensors[node.input[0]].shape)
+            return list(get_attribute(node, "perm", list(reversed(range(rank)))))
+
+        def set_attribute(
+            node: onnx.NodeProto, name: str, value: int | list[int]
+        ) -> None:
+            attributes = [attr for attr in node.attribute if attr.name != name]
+            del node.attribute[:]
+            node.attribute.extend(attributes)
+            node.attribute.append(onnx.helper.make_attribute(name, value))
+
+        changed = True
+        while changed:
+            changed = False
+
+            producers = {name: node for node in self.nodes for name in node.output}
+            consumers: defaultdict[str, list[onnx.NodeProto]] = defaultdict(list)
+            for node in self.nodes:
+                for name in node.input:
+                    consumers[name].append(node)
+
+            for node in self.nodes:
+                if node.op_type != "Transpose":
+                    continue
+
+                X, Y = self.tensors[node.input[0]], self.tensors[node.output[0]]
+                perm = perm_of(node)
+                # rewrite copies, the original proto is left untouched
+                # (None to remove them)
+                rewritten: dict[int, onnx.NodeProto | None] = {}
+
+                previous = producers.get(X.name)
+                if (
+                    previous is not None
+                    and previous.op_type == "Transpose"
+                    and X.tag == "intermediate"
+                    and len(consumers[X.name]) == 1
+                ):
+                    # transpose(transpose(X0, p), q) = transpose(X0, p∘q)
+                    first = perm_of(previous)
+                    merged = [first[i] for i in perm]
+                    X0 = previous.input[0]
+
+                    if merged == sorted(merged) and Y.tag == "intermediate":
+                        # they cancel out
+                        self.weld_tensors(X0, Y.name)
+                        rewritten[id(node)] = rewritten[id(previous)] = None
+                    else:
+                        new = onnx.NodeProto()
+                        new.CopyFrom(node)
+                        new.input[0] = X0
+                        set_attribute(new, "perm", merged)
+                        rewritten[id(node)] = new
+                        rewritten[id(previous)] = None
+
+                    # nothing writes or reads the output of the first one anymore
+                    del self.tensors[X.name]
+                elif (
+                    perm == [1, 0]
+                    and Y.tag == "intermediate"
+                    and len(consumers[Y.name]) > 0
+                    and all(
+                        other.op_type in ["Gemm", "MatMul"]
+                        and Y.name in other.input[:2]
+                        and Y.name not in other.input[2:]
+                        for other in consumers[Y.name]
                     )
-                    impl = op.impl()
-                    call = op.call()
+                ):
+                    # Gemm/MatMul read the matrix transposed
+                    for other in consumers[Y.name]:
+                        new = onnx.NodeProto()
+                        new.CopyFrom(other)
+                        for index, trans in enumerate(["transA", "transB"]):
+                            if new.input[index] == Y.name:
+                                new.input[index] = X.name
+                                flag = get_attribute(new, trans, 0)
+                                set_attribute(new, trans, 0 if flag else 1)
+                        rewritten[id(other)] = new
+                    rewritten[id(node)] = None
+
+                    # the transposed matrix is never materialized
+                    del self.tensors[Y.name]
+
+                if len(rewritten) > 0:
+                    self.nodes = [
+                        new
+                        for new in (rewritten.get(id(n), n) for n in self.nodes)
+                        if new is not None
+                    ]
+                    changed = True
                     break
-                except NotImplementedError as _ex:
-                    # keep first
-                    if ex is None:
-                        ex = _ex
-
-            if impl is None or call is None:
-                assert ex is not None
-                raise ex
-
-            if call is not None and impl is not None:
-                if impl in self.impls:
-                    new_name = call.fn_name()
-                    prev_name = self.impls[impl].fn_name()
-                    assert (
-                        new_name == prev_name
-                    ), "function name should coincide if the implementation is the same"
-
-                self.impls[impl] = call
-                self.calls.append(call)
 
+    def _fuse_epilogues(self) -> list[tuple[onnx.NodeProto, Epilogue, str]]:
+        """
+        Fuses chains of elementwise operators into the epilogue of the
+        operator that produces their input (for example Conv → Add → Relu)
+
+        The fused intermediate tensors are never materialized
+
+        :returns: The nodes to emit, with their epilogue and the name of their final output
+        """
+        nodes = self.nodes
+
+        consumers: defaultdict[str, list[int]] = defaultdict(list)
+        for i, node in enumerate(nodes):
+            for name in node.input:
+                consumers[name].append(i)
+
+        fused: set[int] = set()
+        result: list[tuple[onnx.NodeProto, Epilogue, str]] = []
+
+        for i, node in enumerate(nodes):
+            if i in fused:
+                continue
+
+            epilogue: Epilogue = []
+            output = node.output[0] if len(node.output) > 0 else ""
+
+            if node.op_type in EPILOGUE_PRODUCERS:
+                axis = EPILOGUE_PRODUCERS[node.op_type]
+
+                while True:
+                    tensor = self.tensors.get(output)
+                    if (
+                        tensor is None
+                        or tensor.tag != "intermediate"
+                        or len(consumers[output]) != 1
+                    ):
+                        break
+
+                    j = consumers[output][0]
+
+                    if nodes[j].op_type in EPILOGUE_RESHAPES:
+                        # only if the channel of each element is preserved
+                        reshaped = self.tensors.get(nodes[j].output[0])
+                        if reshaped is None or (
+                            tensor.shape[: axis + 1] != reshaped.shape[: axis + 1]
+                            if axis >= 0
+                            else tensor.shape[axis:] != reshaped.shape[axis:]
+                        ):
+                            break
+                    else:
+                        step = self._epilogue_step(nodes[j], tensor.name, axis)
+                        if step is None:
+                            break
+
+                        epilogue.append(step)
+
+                    fused.add(j)
+
+                    # the fused tensor now lives in the final output
+                    self.weld_tensors(nodes[j].output[0], output)
+                    output = nodes[j].output[0]
+
+            result.append((node, epilogue, output))
+
+        return result
+
+    def _epilogue_step(
+        self, node: onnx.NodeProto, input_name: str, axis: int
+    ) -> EpilogueStep | None:
+        """
+        Builds the epilogue step equivalent to the node, if it can be fused
+
+        :param input_name: Name of the input of the node that comes from the producer
+        :param axis: Axis of the producer output that per-channel constants broadcast along
+        """
+        X = self.tensors[input_name]
+        Y = self.tensors.get(node.output[0]) if len(node.output) == 1 else None
+
+        if Y is None or Y.shape != X.shape:
+            return None
+
+        if node.op_type in EPILOGUE_ACTIVATIONS and node.input[0] == input_name:
+            if node.op_type != "Clip":
+                return EpilogueStep(node.op_type)
+
+            # Clip may have min and max as inputs
+            # or as attributes (depending on ONNX opset)
+            finfo = np.finfo(dtype=np.float32)
+            bounds = [
+                get_attribute(node, "min", finfo.min),
+                get_attribute(node, "max", finfo.max),
+            ]
+            for k, name in enumerate(node.input[1:3]):
+                if name == "":
+                    continue
+                data = self.tensors[name].data
+                if data is None:
+                    return None
+                bounds[k] = data.item()
+
+            return EpilogueStep("Clip", bounds=(float(bounds[0]), float(bounds[1])))
+
+        if node.op_type in EPILOGUE_BROADCASTS and len(node.input) == 2:
+            other = [name for name in node.input if name != input_name]
+            if len(other) != 1:
+                return None
+
+            C = self.tensors[other[0]]
+            if not is_channel_constant(C, X.shape, axis):
+                return None
+
+            return EpilogueStep(node.op_type, tensor=C)
+
+        return None
+
+    def _choose_layouts(
+        self, nodes: list[tuple[onnx.NodeProto, Epilogue, str]]
+    ) -> list[tuple[onnx.NodeProto, Epilogue, str]]:
+        """
+        Picks the layout in memory of the intermediate tensors around the
+        convolutions that run in NCHWc (see ConvNCHWc)
+
+        Those convolutions read and write any layout, so no transform is ever inserted:
+        - the NHWC ↔ NCHW transposes next to them (added by the exporters of
+          TF models) are removed, the convolution reads or writes NHWC instead
+        - the tensors between them are kept in NCHWc, if every operation in the way
+          can run in that layout too (see Operation.keeps_layout), for example
+          Conv → Relu → MaxPool → Conv
+
+        :param nodes: The nodes to emit, as returned by `_fuse_epilogues`
+        :returns: The nodes to emit, without the removed transposes
+        """
+        if "nchwc" not in self.variations:
+            return nodes
+
+        def converts(node: onnx.NodeProto, output: str) -> bool:
+            # the epilogue may be fused through a reshape
+            return (
+                node.op_type == "Conv"
+                and supports_blocked(
+                    node, self.tensors[node.input[0]], self.tensors[node.input[1]]
+                )
+                and self.tensors[output].shape == self.tensors[node.output[0]].shape
+            )
+
+        producers: dict[str, tuple[onnx.NodeProto, str]] = {}
+        consumers: defaultdict[str, list[tuple[onnx.NodeProto, int]]] = defaultdict(
+            list
+        )
+        for node, _, output in nodes:
+            producers[output] = (node, output)
+            for i, name in enumerate(node.input):
+                consumers[name].append((node, i))
+
+        def read_by_convs(name: str) -> bool:
+            return len(consumers[name]) > 0 and all(
+                i == 0 and converts(node, node.output[0]) for node, i in consumers[name]
+            )
+
+        # NHWC transposes
+        removed: set[int] = set()
+        for node, _, output in nodes:
+            if node.op_type != "Transpose":
+                continue
+            perm = list(get_attribute(node, "perm", []))
+            X, Y = self.tensors[node.input[0]], self.tensors[output]
+
+            if perm == [0, 3, 1, 2] and Y.tag == "intermediate" and read_by_convs(Y.name):
+                # NHWC → NCHW, the convolutions read the NHWC input
+                Y.layout = NHWC
+                self.weld_tensors(X.name, Y.name)
+            elif (
+                perm == [0, 2, 3, 1]
+                and X.tag == "intermediate"
+                and len(consumers[X.name]) == 1
+                and X.name in producers
+                and converts(*producers[X.name])
+            ):
+                # NCHW → NHWC, the convolution writes the NHWC output
+                X.layout = NHWC
+                self.weld_tensors(Y.name, X.name)
+            else:
+                continue
+
+            removed.add(id(node))
+
+        nodes = [entry for entry in nodes if id(entry[0]) not in removed]
+
+        # tensors that must share the same layout (union-find)
+        parent: dict[str, str] = {}
+
+        def find(name: str) -> str:
+            while parent.setdefault(name, name) != name:
+                name = parent[name]
+            return name
+
+        layout = blocked_layout()
+        plain: set[str] = set()
+        for node, _, output in nodes:
+            names = [
+                name
+                for name in list(node.input) + [output] + list(node.output[1:])
+                if name != "" and self.tensors[name].tag != "weight"
+            ]
+            for name in names:
+                find(name)
+            if converts(node, output):
+                continue
+
+            inputs = [self.tensors[name] for name in node.input if name != ""]
+            outputs = [self.tensors[output]]
+            try:
+                keeps = len(node.output) == 1 and all(
+                    variant.keeps_layout(node, inputs, outputs, layout)
+                    for variant in Operation.get(node.op_type, self.variations)
+                )
+            except (NotImplementedError, ValueError):
+                # not an operation (for example, Reshape)
+                keeps = False
+
+            if keeps:
+                for name in names[1:]:
+                    parent[find(name)] = find(names[0])
+            else:
+                plain.update(names)
+
+        groups: defaultdict[str, list[TensorInfo]] = defaultdict(list)
+        for name in parent:
+            groups[find(name)].append(self.tensors[name])
+
+        for group in groups.values():
+            if (
+                any(tensor.name in plain for tensor in group)
+                or any(tensor.tag != "intermediate" for tensor in group)
+                or any(tensor.layout is not None for tensor in group)
+                or any(len(tensor.shape) != 4 for tensor in group)
+                # nothing to gain if no convolution writes it
+                or not any(
+                    tensor.name in producers and converts(*producers[tensor.name])
+                    for tensor in group
+                )
+            ):
+                continue
+
+            for tensor in group:
+                tensor.layout = layout
+                tensor.size = blocked_size(tensor.shape)
+
+        return nodes
+
+    def generate(self) -> ModelResult:
+        """
+        Generate C and ASM code to run the model
+        """
+        self._fold_batch_normalization()
+        self._eliminate_transposes()
+
+        # ops that depend on the instruction set read the targets while generated
+        with dispatching(self.targets):
+            nodes = self._choose_layouts(self._fuse_epilogues())
+
+            for node, epilogue, output in nodes:
+                if node.op_type in [
+                    # Reshape/Squeeze/Unsqueeze operator ⚠️ SPECIAL CASE ⚠️
+                    #
+                    # https://github.com/onnx/onnx/blob/main/docs/Operators.md#reshape
+                    # https://github.com/onnx/onnx/blob/main/docs/Operators.md#squeeze
+                    # https://github.com/onnx/onnx/blob/main/docs/Operators.md#unsqueeze
+                    "Reshape",
+                    "Squeeze",
+                    "Unsqueeze",
+                    # have no effect during inference
+                    "Dropout",
+                    # other kind of reshape
+                    "Flatten",
+                ]:
+                    # Since it just reshapes the tensor, we don't need to do anything in runtime
+                    # But we must must be weld the input and output tensors (variables/data)
+                    self.weld_tensors(node.input[0], node.output[0])
+
+                    continue
+
+                variants = Operation.get(node.op_type, self.variations)
+
+                impl: (OpImpl | None) = None
+                call: (OpCall | None) = None
+                ex: (Exception | None) = None
+
+                outputs = [self.tensors[name] for name in node.output]
+                if output != node.output[0]:
+                    # write directly into the output of the fused chain,
+                    # seen with the shape the operator produces
+                    outputs = [replace(self.tensors[output], shape=outputs[0].shape)]
+
+                # we try all the variants we have available, in the order specified
+                # if one throws NotImplemented, we try the next one
+                for var in variants:
+                    try:
+                        op = var(
+                            node,
+                            [self.tensors[name] for name in node.input],
+                            outputs,
+                            epilogue,
+                        )
+                        impl = op.impl()
+                        call = op.call()
+                        break
+                    except NotImplementedError as _ex:
+                        # keep first
+                        if ex is None:
+                            ex = _ex
+
+                if impl is None or call is None:
+                    assert ex is not None
+                    raise ex
+
+                if call is not None and impl is not None:
+                    if impl in self.impls:
+                        new_name = call.fn_name()
+                        prev_name = self.impls[impl].fn_name()
+                        assert (
+                            new_name == prev_name
+                        ), "function name should coincide if the implementation is the same"
+
+                    for i, data in call.packed_inputs.items():
+                        # tensors packed in the same way are shared between calls
+                        tensor = call.inputs[i]
+                        name = f"{tensor.name}_packed_{call.fn_name()}"
+                        if name not in self.tensors:
+                            self._add_tensor(name, "weight", [data.size], data)
+                        call.inputs[i] = self.tensors[name]
+
+                    if call.scratch_size > 0:
+                        # short-lived intermediate, only alive during the call
+                        call.scratch = self._add_tensor(
+                            f"{call.fn_name()}_scratch_{len(self.calls)}",
+                            "intermediate",
+                            [call.scratch_size],
+                            None,
+                        )
+
+                    self.impls[impl] = call
+                    self.calls.append(call)
+
+        self._elide_views()
+        self._schedule()
         self._compute_memory_layout()
+        self._compute_weight_layout()
 
         inputs = [tensor for tensor in self.tensors.values() if tensor.tag == "input"]
         outputs = [tensor for tensor in self.tensors.values() if tensor.tag == "output"]
@@ -138,11 +709,108 @@ class Generator:
             input_shapes={tensor.name: tensor.shape for tensor in inputs},
             output_shapes={tensor.name: tensor.shape for tensor in outputs},
             source_c=self._gen_c_source(),
-            source_h=f"extern {INFERENCE_SIGNATURE};",
+            source_h=f"// weights must be aligned to {self.alignment} bytes\n"
+            + (
+                "// runs on a global thread pool: don't call it from several threads at once\n"
+                if self.threads > 1
+                else ""
+            )
+            + f"extern {INFERENCE_SIGNATURE};\n"
+            + "// maps a weights file (read-only, page-aligned)\n"
+            + "extern const float* map_weights(const char* filename);",
             source_asm=self._gen_asm_source(),
             weights=self._gen_weights(),
+            memory_layouts=self.inter_layouts,
+            targets=[target.name for target in self.targets],
         )
 
+    def _elide_views(self) -> None:
+        """
+        Drops the calls that only copy their inputs into slices of the output
+        (see OpCall.view_offsets), the inputs become views of the output:
+        their producers write directly into their slice
+        """
+        # variable -> (variable it is a view of, offset)
+        self.views: dict[str, tuple[str, int]] = {}
+
+        tags: dict[str, set[str]] = defaultdict(set)
+        for tensor in self.tensors.values():
+            tags[tensor.variable].add(tensor.tag)
+
+        calls = []
+        for call in self.calls:
+            variables = [tensor.variable for tensor in call.inputs]
+            output = call.outputs[0].variable
+
+            if (
+                call.view_offsets is None
+                or len(set(variables)) != len(variables)
+                or output in variables
+                # the memory of the inputs must be planned by us
+                or any(
+                    tags[variable] & {"input", "output", "weight"}
+                    or variable in self.views
+                    for variable in variables
+                )
+            ):
+                calls.append(call)
+                continue
+
+            for variable, offset in zip(variables, call.view_offsets):
+                self.views[variable] = (output, offset)
+
+        if len(calls) == len(self.calls):
+            return
+
+        self.calls = calls
+        # remove the implementations that are not called anymore
+        called = {call.fn_name() for call in self.calls}
+        self.impls = {
+            impl: call for impl, call in self.impls.items() if call.fn_name() in called
+        }
+
+    def _resolve_view(self, variable: str) -> tuple[str, int]:
+        """
+        Finds the variable that owns the memory of a view and the offset in it
+        """
+        offset = 0
+        while variable in self.views:
+            variable, delta = self.views[variable]
+            offset += delta
+        return variable, offset
+
+    def _schedule(self) -> None:
+        """
+        Groups the calls into waves, each call only depends on calls of previous waves
+
+        In multi-threaded mode the calls of a wave run concurrently (for example
+        the branches of an Inception block), each one on its share of the threads
+        (see parallel_calls), otherwise every call is its own wave
+        """
+        if self.threads == 1:
+            self.waves = [[index] for index in range(len(self.calls))]
+            return
+
+        # calls are already in topological order
+        # first level where each variable can be read (views can have many writers)
+        ready: dict[str, int] = {}
+        levels: list[int] = []
+
+        for call in self.calls:
+            level = 0
+            for tensor in call.inputs:
+                variable, _ = self._resolve_view(tensor.variable)
+                level = max(level, ready.get(variable, 0))
+
+            levels.append(level)
+            for tensor in call.outputs:
+                variable, _ = self._resolve_view(tensor.variable)
+                ready[variable] = max(ready.get(variable, 0), level + 1)
+
+        self.waves = [[] for _ in range(max(levels, default=-1) + 1)]
+        for index, level in enumerate(levels):
+            self.waves[level].append(index)
+
     def _compute_memory_layout(self) -> None:
         """
         Finds a good memory layout for intermediate tensors
@@ -152,25 +820,46 @@ class Generator:
 
         inter_tensors: dict[str, TensorUsageRecord] = {}
 
-        # add all intermediate tensors
+        # add all intermediate tensors (views use the memory of other tensor)
         for t in self.tensors.values():
-            if t.tag == "intermediate":
-                inter_tensors[t.variable] = TensorUsageRecord(MAX, MIN, t.size)
+            if t.tag == "intermediate" and t.variable not in self.views:
+                inter_tensors[t.variable] = TensorUsageRecord(
+                    MAX, MIN, self._aligned_size(t.size)
+                )
 
         # build usage records knowing the order of calls and data dependencies
-        for index, call in enumerate(self.calls):
+        # calls in the same wave may run at the same time, so they share the index
+        waved_calls = [
+            (index, self.calls[call_index])
+            for index, wave in enumerate(self.waves)
+            for call_index in wave
+        ]
+
+        # number of calls reading each tensor at each index
+        readers: defaultdict[tuple[str, int], int] = defaultdict(int)
+
+        for index, call in waved_calls:
             # for inputs, make sure we reserve the tensor up to index
+            # (welded tensors are checked through their variable)
             for tensor in call.inputs:
-                if tensor.tag == "intermediate":
-                    rec = inter_tensors[tensor.variable]
+                variable, _ = self._resolve_view(tensor.variable)
+                if variable in inter_tensors:
+                    rec = inter_tensors[variable]
                     rec.last_op = max(rec.last_op, index)
+                    readers[(variable, index)] += 1
 
             # for outputs, make sure we reserve the tensor from at least index
             for tensor in call.outputs:
-                if tensor.tag == "intermediate":
-                    rec = inter_tensors[tensor.variable]
+                variable, _ = self._resolve_view(tensor.variable)
+                if variable in inter_tensors:
+                    rec = inter_tensors[variable]
                     rec.first_op = min(rec.first_op, index)
 
+            # scratch memory is only reserved during the call
+            if call.scratch is not None:
+                rec = inter_tensors[call.scratch.variable]
+                rec.first_op = rec.last_op = index
+
         # tensors that connect with the output don't have last_op set
         # set to first_op + 1
         for var, rec in inter_tensors.items():
@@ -179,25 +868,131 @@ class Generator:
             if rec.last_op == -1:
                 rec.last_op = rec.first_op + 1
 
-        self.inter_size, offsets = find_best_layout(list(inter_tensors.values()))
+        # in-place calls: the output takes the memory of the input
+        # if this call is the only and last reader of it
+        aliases: dict[str, str] = {}
+        output_vars = {t.variable for t in self.tensors.values() if t.tag == "output"}
+
+        for index, call in waved_calls:
+            if call.inplace_input is None:
+                continue
+
+            input = call.inputs[call.inplace_input].variable
+            output = call.outputs[0].variable
+            root = aliases.get(input, input)
+            if (
+                root not in inter_tensors
+                or output not in inter_tensors
+                or input in output_vars
+                or output in output_vars
+                or input in self.views
+                or output in self.views
+            ):
+                continue
+
+            rec = inter_tensors[root]
+            if rec.last_op != index or readers[(input, index)] != 1:
+                continue
+
+            out_rec = inter_tensors.pop(output)
+            rec.last_op = max(rec.last_op, out_rec.last_op)
+            rec.size = max(rec.size, out_rec.size)
+            aliases[output] = root
+
+        # keep the arena size of every strategy for reporting
+        layouts = compare_layouts(list(inter_tensors.values()), self.layout_time_budget)
+        self.inter_strategy = min(layouts.keys(), key=lambda name: layouts[name][0])
+        self.inter_layouts = {name: size for name, (size, _) in layouts.items()}
+        self.inter_size, offsets = layouts[self.inter_strategy]
         self.inter_offsets = {}
 
         # map tensor names to variables
         for var, offset in zip(inter_tensors.keys(), offsets):
             self.inter_offsets[var] = offset
+        for var, root in aliases.items():
+            self.inter_offsets[var] = self.inter_offsets[root]
 
-    def _gen_weights(self) -> TensorData:
-        return np.concatenate(
-            [
-                tensor.data.reshape(-1)
-                for tensor in self.tensors.values()
-                if tensor.tag == "weight"
+    def _aligned_size(self, size: int) -> int:
+        """
+        Rounds up a number of floats so the next tensor starts aligned
+        """
+        floats = self.alignment // 4
+        return -(-size // floats) * floats
+
+    def _compute_weight_layout(self) -> None:
+        """
+        Places every weight tensor used by a call aligned in the weights buffer
+        """
+        self.weight_offsets: dict[str, int] = {}
+        self.weights_size = 0
+
+        # folded or packed weights may leave the original ones unused
+        used = {tensor.variable for call in self.calls for tensor in call.inputs}
+
+        for tensor in self.tensors.values():
+            if (
+                tensor.tag == "weight"
+                and tensor.variable in used
                 and tensor.data is not None
                 and tensor.data.dtype == np.float32
-            ]
-            # concatenate needs at least one array
-            + [np.array([], dtype=np.float32)],
-        )
+            ):
+                self.weight_offsets[tensor.variable] = self.weights_size
+                self.weights_size += self._aligned_size(tensor.size)
+
+    def _gen_weights(self) -> TensorData:
+        weights = np.zeros(self.weights_size, dtype=np.float32)
+
+        for tensor in self.tensors.values():
+            if tensor.tag == "weight" and tensor.variable in self.weight_offsets:
+                assert tensor.data is not None
+                offset = self.weight_offsets[tensor.variable]
+                weights[offset : offset + tensor.size] = tensor.data.reshape(-1)
+
+        return weights
+
+    def _aligned_params(self) -> dict[str, set[str]]:
+        """
+        Parameters of each function that are aligned in every call
+
+        Intermediates and weights are aligned (views depend on their offset), inputs
+        and outputs belong to the host so nothing is assumed about them
+        """
+        floats = self.alignment // 4
+        aligned_variables = {
+            variable
+            for variable, offset in chain(
+                self.inter_offsets.items(), self.weight_offsets.items()
+            )
+            if offset is not None and offset % floats == 0
+        }
+
+        # intermediates welded with an output live in the outputs buffer
+        for tensor in self.tensors.values():
+            if tensor.tag == "output":
+                aligned_variables.discard(tensor.variable)
+
+        for variable in self.views:
+            root, offset = self._resolve_view(variable)
+            if root in aligned_variables and offset % floats == 0:
+                aligned_variables.add(variable)
+
+        aligned: dict[str, set[str]] = {}
+        for call in self.calls:
+            params = {
+                name
+                for name, tensor in chain(
+                    zip(call.input_names, call.inputs),
+                    zip(call.output_names, call.outputs),
+                )
+                if tensor.variable in aligned_variables
+            }
+            if call.scratch is not None:
+                params.add("scratch")
+
+            name = call.fn_name()
+            aligned[name] = aligned.get(name, params) & params
+
+        return aligned
 
     def _gen_c_source(self) -> str:
         source = "\n".join(
@@ -206,13 +1001,22 @@ class Generator:
                 "#include <assert.h>",
                 "#include <math.h>",
                 "#include <string.h>",
-                "#define min(a,b) ((a)<(b)?(a):(b))",
-                "#define max(a,b) ((a)>(b)?(a):(b))",
-                "float im2col[50000000]; // TODO: do this correctly...",
+                "#include <stdlib.h>",
+                "",
+                f"#define O2C_THREADS {self.threads}",
+                f"#define O2C_PIN_THREADS {int(self.pin_threads)}",
                 "",
             ]
         )
 
+        # parallel runtime and weights loading (before min/max, they clash with the STL)
+        for runtime in ["parallel.cpp", "weights.cpp", "targets.cpp"]:
+            with open(Path(__file__).parent / runtime, "r") as f:
+                source += f.read() + "\n"
+
+        source += "#define min(a,b) ((a)<(b)?(a):(b))\n"
+        source += "#define max(a,b) ((a)>(b)?(a):(b))\n\n"
+
         # asm auxiliary function declarations
 
         source += "// Auxiliary functions (ASM):\n\n"
@@ -225,22 +1029,44 @@ class Generator:
 
         source += 'extern "C" {\n' + "\n\n".join(asm_aux_declarations) + "\n}\n\n"
 
+        if self.embed_weights:
+            source += "// Weights (embedded in the ASM):\n\n"
+            source += f'extern "C" const float {EMBEDDED_WEIGHTS}[];\n\n'
+
+        # define ASM functions in C
+
+        source += "// ASM functions:\n\n"
+
+        for impl, call in self.impls.items():
+            if impl.lang == "asm":
+                source += f"extern {call.signature()};"
+
+        source += "\n" * 2
+
+        # define intermediate tensor
+        # it is a shared buffer
+        source += f"// layout: {self.inter_strategy}\n"
+        source += f"alignas({self.alignment}) float intermediates[{self.inter_size}];"
+        source += "\n" * 2
+
+        # kernels: everything that depends on the instruction set
+
         # loading external files
-        source += "// External files:\n\n"
+        kernels = "// External files:\n\n"
 
         efp = [path for impl in self.impls.keys() for path in impl.external_paths]
         external_file_paths = sorted(set(efp), key=efp.index)
 
         for path in external_file_paths:
-            source += f"// {path}\n\n"
+            kernels += f"// {path}\n\n"
             with open(path, "r") as f:
-                source += f.read() + "\n"
+                kernels += f.read() + "\n"
 
-        source += "\n" * 2
+        kernels += "\n" * 2
 
         # c++ auxiliary functions
 
-        source += "// Auxiliary functions (C++):\n\n"
+        kernels += "// Auxiliary functions (C++):\n\n"
 
         cpp_aux_functions = list(
             dict.fromkeys(
@@ -250,43 +1076,39 @@ class Generator:
             )
         )
 
-        source += "\n".join(cpp_aux_functions) + "\n" * 2
-
-        # define ASM functions in C
-
-        source += "// ASM functions:\n\n"
-
-        for impl, call in self.impls.items():
-            if impl.lang == "asm":
-                source += f"extern {call.signature()};"
-
-        source += "\n" * 2
+        kernels += "\n".join(cpp_aux_functions) + "\n" * 2
 
         # implementations
 
-        source += "// Implementations:\n\n"
+        kernels += "// Implementations:\n\n"
+
+        aligned_params = self._aligned_params()
 
         for impl, call in self.impls.items():
             if impl.lang == "c":
-                source += call.signature() + " {\n"
-                source += indent(impl.full_source().strip(), prefix=" " * 4)
-                source += "\n}\n"
+                kernels += call.signature() + " {\n"
+                for name in sorted(aligned_params.get(call.fn_name(), set())):
+                    cast = "const float*" if name in call.input_names else "float*"
+                    kernels += f"    {name} = ({cast})__builtin_assume_aligned({name}, {self.alignment});\n"
+                kernels += indent(impl.full_source().strip(), prefix=" " * 4)
+                kernels += "\n}\n"
 
-        # define intermediate tensor
-        # it is a shared buffer
-        source += "\n" * 2
-        source += f"float intermediates[{self.inter_size}];"
-        source += "\n" * 2
+        kernels += "\n" * 2
 
         inference_source = ""
         io_offsets: defaultdict[str, int] = defaultdict(int)
+        views: list[TensorInfo] = []
         # build tensor variables
         for tensor in self.tensors.values():
+            if tensor.variable in self.views and tensor.tag == "intermediate":
+                # declared after the tensor that owns its memory
+                views.append(tensor)
+                continue
+
             if tensor.tag != "welded":
                 if (
                     tensor.tag == "weight"
-                    and tensor.data is not None
-                    and tensor.data.dtype != np.float32
+                    and tensor.variable not in self.weight_offsets
                 ):
                     # weight with no data or invalid, skip
                     continue
@@ -307,13 +1129,19 @@ class Generator:
                 if tensor.tag == "intermediate":
                     offset = self.inter_offsets[tensor.variable]
                     assert offset is not None, "invliad offset"
-                else:  # input, output or weight
+                elif tensor.tag == "weight":
+                    offset = self.weight_offsets[tensor.variable]
+                else:  # input or output
                     offset = io_offsets[tensor.tag]
                     io_offsets[tensor.tag] += tensor.size
 
+                buffer = f"{tensor.tag}s"
+                if tensor.tag == "weight" and self.embed_weights:
+                    buffer = EMBEDDED_WEIGHTS
+
                 decl = "const " if tensor.tag in ["input", "weight"] else ""
                 decl += f"float* {tensor.variable} = "
-                decl += f"{tensor.tag}s + {offset};"
+                decl += f"{buffer} + {offset};"
 
             else:
                 # welded
@@ -322,17 +1150,107 @@ class Generator:
             decl = f"\n{decl : <34} // ({tensor.shape_str()}) {tensor.name}"
             inference_source += decl
 
+        for tensor in views:
+            variable, offset = self._resolve_view(tensor.variable)
+            decl = f"float* {tensor.variable} = {variable} + {offset};"
+            inference_source += (
+                f"\n{decl : <34} // ({tensor.shape_str()}) {tensor.name}"
+            )
+
         # make op calls
         inference_source += "\n"
-        for call in self.calls:
-            inference_source += f"\n{call.invocation()};"
+        for wave in self.waves:
+            if len(wave) == 1:
+                inference_source += f"\n{self.calls[wave[0]].invocation()};"
+                continue
+
+            # independent calls, each one runs on its own threads
+            cases = "\n".join(
+                f"case {k}: {self.calls[index].invocation()}; break;"
+                for k, index in enumerate(wave)
+            )
+            inference_source += "\n" + "\n".join(
+                [
+                    f"parallel_calls({len(wave)}, [&](int i) {{",
+                    "    switch (i) {",
+                    indent(cases, prefix=" " * 8),
+                    "    }",
+                    "});",
+                ]
+            )
 
+        if len(self.targets) > 0:
+            return source + self._gen_dispatch(kernels, inference_source)
+
+        source += kernels
         source += INFERENCE_SIGNATURE + " {"
         source += indent(inference_source, prefix=" " * 4)
         source += "\n}"
 
         return source
 
+    def _gen_dispatch(self, kernels: str, inference_source: str) -> str:
+        """
+        A copy of the kernels and the inference for each target, in its own namespace
+        and compiled for its instruction set. `inference` runs the copy of the widest
+        target the CPU supports, picked when the library is loaded
+        """
+        source = ""
+
+        for target in self.targets:
+            source += f"// Kernels for {target.name}:\n\n"
+            source += f"namespace {target.namespace()} {{\n\n"
+            source += "#pragma GCC push_options\n"
+            source += f'#pragma GCC target("{target.gcc}")\n'
+            # g++ doesn't update the predefined macros (__AVX2__, ...) with the pragma
+            for macro in TARGET_MACROS:
+                source += f"#undef {macro}\n"
+                source += f"#define {macro} {int(macro in target.macros)}\n"
+            source += "\n" + kernels
+            source += (
+                "void inference(const float* weights, const float* inputs, float* outputs) {"
+                + indent(inference_source, prefix=" " * 4)
+                + "\n}\n\n"
+            )
+            source += "#pragma GCC pop_options\n\n"
+            source += "}\n\n"
+
+        selection = []
+        for target in self.targets[:-1]:
+            checks = " && ".join(
+                f'__builtin_cpu_supports("{feature}")' for feature in target.cpu
+            )
+            selection += [
+                f'if (forced ? strcmp(forced, "{target.name}") == 0 : {checks}) {{',
+                f"    return {target.namespace()}::inference;",
+                "}",
+            ]
+        # the narrowest one if nothing else is supported
+        selection.append(f"return {self.targets[-1].namespace()}::inference;")
+
+        source += "\n".join(
+            [
+                "// Dispatch:\n",
+                "typedef void (*o2c_inference_fn)(const float*, const float*, float*);",
+                "",
+                "// O2C_TARGET=<name> in the environment forces a target",
+                "static o2c_inference_fn o2c_select_inference() {",
+                '    const char* forced = getenv("O2C_TARGET");',
+                "    __builtin_cpu_init();",
+                indent("\n".join(selection), prefix=" " * 4),
+                "}",
+                "",
+                "// picked when the library is loaded",
+                "static const o2c_inference_fn o2c_inference = o2c_select_inference();",
+                "",
+                INFERENCE_SIGNATURE + " {",
+                "    o2c_inference(weights, inputs, outputs);",
+                "}",
+            ]
+        )
+
+        return source
+
     def _gen_asm_source(self) -> str:
         source = ""
 
@@ -370,4 +1288,16 @@ class Generator:
                     ]
                 )
 
+        if self.embed_weights:
+            # weights.bin must be in the include path of nasm (-i)
+            source += "\n\n" + "\n".join(
+                [
+                    f"section .rodata align={self.alignment}",
+                    f"align {self.alignment}",
+                    f"global {EMBEDDED_WEIGHTS}",
+                    f"{EMBEDDED_WEIGHTS}:",
+                    '    incbin "weights.bin"',
+                ]
+            )
+
         return source.strip() + "\n"
@@ -1,5 +1,8 @@
+import heapq
 import math
+import time
 from dataclasses import dataclass
+from typing import Callable
 
 # We implement different memory strategies used in TFLite
 # Since we are using CPU we aim to the Memory Offset Calculation approach
@@ -23,6 +26,26 @@ Offsets = list[int | None]
 Result = tuple[int, Offsets]
 
 
+def overlaps(a: TensorUsageRecord, b: TensorUsageRecord) -> bool:
+    """
+    Whether both tensors are alive at the same time
+    """
+    return not (a.last_op < b.first_op or a.first_op > b.last_op)
+
+
+def lower_bound(records: Records) -> int:
+    """
+    No layout can use less memory than the tensors alive at the busiest op
+    (the breadth of that op)
+    """
+    breadths: dict[int, int] = {}
+    for r in records:
+        for op in range(r.first_op, r.last_op + 1):
+            breadths[op] = breadths.get(op, 0) + r.size
+
+    return max(breadths.values(), default=0)
+
+
 ##########################
 # Naive
 ##########################
@@ -37,39 +60,105 @@ def naive(records: Records) -> Result:
     return total_consumption, offsets
 
 
+class AllocatedIntervals:
+    """
+    Lifetimes of the tensors already placed, indexed by op with a segment tree
+    so the ones overlapping a lifetime are found in O(log T + k)
+
+    Each lifetime is split in the O(log T) canonical nodes that cover it,
+    it is stored in `full` of those nodes and in `partial` of them and their ancestors
+    """
+
+    def __init__(self, first_op: int, last_op: int):
+        self.base = first_op
+        self.leaves = 1
+        while self.leaves < last_op - first_op + 1:
+            self.leaves *= 2
+
+        self.full: dict[int, list[int]] = {}
+        self.partial: dict[int, list[int]] = {}
+
+    def _canonical(self, first_op: int, last_op: int) -> list[int]:
+        nodes = []
+        lo = first_op - self.base + self.leaves
+        hi = last_op - self.base + self.leaves + 1
+        while lo < hi:
+            if lo & 1:
+                nodes.append(lo)
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                nodes.append(hi)
+            lo >>= 1
+            hi >>= 1
+        return nodes
+
+    def add(self, index: int, record: TensorUsageRecord) -> None:
+        ancestors = set()
+        for node in self._canonical(record.first_op, record.last_op):
+            self.full.setdefault(node, []).append(index)
+            while node not in ancestors and node > 0:
+                ancestors.add(node)
+                node >>= 1
+
+        for node in ancestors:
+            self.partial.setdefault(node, []).append(index)
+
+    def overlapping(self, record: TensorUsageRecord) -> set[int]:
+        """
+        Indexes of the tensors alive at some point of the lifetime of `record`
+        """
+        result: set[int] = set()
+        ancestors = set()
+        for node in self._canonical(record.first_op, record.last_op):
+            result.update(self.partial.get(node, []))
+            node >>= 1
+            while node not in ancestors and node > 0:
+                ancestors.add(node)
+                node >>= 1
+
+        for node in ancestors:
+            result.update(self.full.get(node, []))
+
+        return result
+
+
 ##########################
-# Greed by Size
+# Best fit
 #
-# TFLite C impl: https://github.com/tensorflow/tensorflow/blob/1b36c9fb27ce899e19ddf65da3c0920861210472/tensorflow/lite/delegates/gpu/common/memory_management/greedy_by_size_assignment.cc#L69
+# Common part of the greedy strategies: tensors are placed in the given order,
+# each one in the smallest gap between the already placed tensors that overlap with it
+#
+# Only the overlapping tensors are visited, so it is O(n log n) plus the
+# sorting of each overlapping set (usually small)
 ##########################
-def greedy_by_size(records: Records) -> Result:
-    # save original indexes
-    for i, r in enumerate(records):
-        r.index = i
-
-    # sort records in decreasing order of size
-    records.sort(key=lambda r: r.size, reverse=True)
-
-    # result
+def best_fit(records: Records, order: list[int]) -> Result:
     total_consumption = 0
     offsets: Offsets = [None] * len(records)
 
-    # indexes already allocated, ordered by offset
-    ordered_allocs: list[int] = []
+    if len(records) == 0:
+        return total_consumption, offsets
+
+    allocated = AllocatedIntervals(
+        min(r.first_op for r in records), max(r.last_op for r in records)
+    )
+    # position in the allocation order, breaks ties between equal offsets
+    sequence = [0] * len(records)
 
-    for t_i, t in enumerate(records):
+    for seq, i in enumerate(order):
+        t = records[i]
         prev_offset = 0
         best_offset = None
         smallest_gap = math.inf
 
-        for allocated_id in ordered_allocs:
+        # visit the overlapping tensors by offset
+        for allocated_id in sorted(
+            allocated.overlapping(t),
+            key=lambda k: (offsets[k], sequence[k]),
+        ):
             rec = records[allocated_id]
 
-            if rec.last_op < t.first_op or rec.first_op > t.last_op:
-                # no overlap, skip
-                continue
-
-            cur_offset = offsets[rec.index]
+            cur_offset = offsets[allocated_id]
             assert cur_offset is not None
 
             if cur_offset >= prev_offset:
@@ -85,35 +174,308 @@ def greedy_by_size(records: Records) -> Result:
         if best_offset is None:
             best_offset = prev_offset
 
-        offsets[t.index] = best_offset
+        offsets[i] = best_offset
         total_consumption = max(total_consumption, best_offset + t.size)
 
-        ordered_allocs.append(t_i)
-
-        # sort by offset
-        ordered_allocs.sort(key=lambda i: offsets[records[i].index])  # type: ignore
+        sequence[i] = seq
+        allocated.add(i, t)
 
     return total_consumption, offsets
 
 
+##########################
+# Greed by Size
+#
+# TFLite C impl: https://github.com/tensorflow/tensorflow/blob/1b36c9fb27ce899e19ddf65da3c0920861210472/tensorflow/lite/delegates/gpu/common/memory_management/greedy_by_size_assignment.cc#L69
+##########################
+def greedy_by_size(records: Records) -> Result:
+    # decreasing order of size (the sort is stable)
+    order = sorted(range(len(records)), key=lambda i: records[i].size, reverse=True)
+
+    return best_fit(records, order)
+
+
+##########################
+# Greed by Size (improved)
+#
+# The order of equally sized tensors (and of tensors of similar size) matters a lot,
+# so a few orders are tried and the smallest layout is kept
+##########################
+def greedy_by_size_improved(records: Records) -> Result:
+    def lifetime(r: TensorUsageRecord) -> int:
+        return r.last_op - r.first_op + 1
+
+    keys: list[Callable[[TensorUsageRecord], tuple[int, ...]]] = [
+        # larger first, long-lived first
+        lambda r: (-r.size, -lifetime(r), r.first_op),
+        # largest area in the (time, memory) plane first
+        lambda r: (-r.size * lifetime(r), -r.size),
+        # long-lived first, they constraint the most tensors
+        lambda r: (-lifetime(r), -r.size),
+    ]
+
+    return min(
+        (
+            best_fit(records, sorted(range(len(records)), key=lambda i: k(records[i])))
+            for k in keys
+        ),
+        key=lambda r: r[0],
+    )
+
+
 ##########################
 # Greed by Breadth
+#
+# Ops are visited in decreasing order of breadth (total size of the tensors alive),
+# the tensors of each op are placed in decreasing order of size
 ##########################
 def greedy_by_breadth(records: Records) -> Result:
-    raise NotImplementedError()
+    ops: dict[int, list[int]] = {}
+    for i, r in enumerate(records):
+        for op in range(r.first_op, r.last_op + 1):
+            ops.setdefault(op, []).append(i)
+
+    def breadth(op: int) -> int:
+        return sum(records[i].size for i in ops[op])
+
+    order: list[int] = []
+    visited: set[int] = set()
+
+    for op in sorted(ops.keys(), key=breadth, reverse=True):
+        for i in sorted(ops[op], key=lambda i: records[i].size, reverse=True):
+            if i not in visited:
+                visited.add(i)
+                order.append(i)
+
+    return best_fit(records, order)
+
 
+##########################
+# Min-cost flow
+#
+# Shared objects approach: each tensor either gets a new memory object or reuses the
+# object of a tensor that is dead by the time it is created.
+# Choosing the reuses is a min-cost flow problem (the cost of a reuse is how much the
+# object grows), then the objects are laid out one after another
+#
+# TFLite C impl: https://github.com/tensorflow/tensorflow/blob/1b36c9fb27ce899e19ddf65da3c0920861210472/tensorflow/lite/delegates/gpu/common/memory_management/min_cost_flow_assignment.cc
+##########################
+def min_cost_flow(records: Records) -> Result:
+    n = len(records)
+
+    # nodes: source, sink, the tensors releasing their object
+    # and the tensors acquiring an object
+    source, sink = 0, 1
+    nodes = 2 + 2 * n
 
-def find_best_layout(records: Records) -> Result:
+    def release(i: int) -> int:
+        return 2 + i
+
+    def acquire(i: int) -> int:
+        return 2 + n + i
+
+    graph: list[list[int]] = [[] for _ in range(nodes)]
+    to: list[int] = []
+    capacity: list[int] = []
+    cost: list[int] = []
+
+    def add_edge(u: int, v: int, c: int) -> None:
+        # forward edge is even, residual edge is odd
+        for a, b, cap, cst in ((u, v, 1, c), (v, u, 0, -c)):
+            graph[a].append(len(to))
+            to.append(b)
+            capacity.append(cap)
+            cost.append(cst)
+
+    for i, r in enumerate(records):
+        add_edge(source, release(i), 0)
+        add_edge(source, acquire(i), r.size)  # new object
+        add_edge(acquire(i), sink, 0)
+
+        for j, other in enumerate(records):
+            if r.last_op < other.first_op:
+                add_edge(release(i), acquire(j), max(0, other.size - r.size))
+
+    # successive shortest paths, all costs start non-negative
+    potential = [0] * nodes
+
+    for _ in range(n):
+        dist = [math.inf] * nodes
+        parent_edge = [-1] * nodes
+        dist[source] = 0
+        heap = [(0, source)]
+
+        while heap:
+            d, u = heapq.heappop(heap)
+            if d > dist[u]:
+                continue
+            for e in graph[u]:
+                v = to[e]
+                nd = d + cost[e] + potential[u] - potential[v]
+                if capacity[e] > 0 and nd < dist[v]:
+                    dist[v] = nd
+                    parent_edge[v] = e
+                    heapq.heappush(heap, (nd, v))
+
+        for v in range(nodes):
+            if dist[v] < math.inf:
+                potential[v] += int(dist[v])
+
+        v = sink
+        while v != source:
+            e = parent_edge[v]
+            capacity[e] -= 1
+            capacity[e ^ 1] += 1
+            v = to[e ^ 1]
+
+    # follow the reuses to build the objects
+    reused_from = [-1] * n
+    for i in range(n):
+        for e in graph[release(i)]:
+            if e % 2 == 0 and capacity[e] == 0:
+                reused_from[to[e] - acquire(0)] = i
+
+    objects: list[list[int]] = []
+    object_of = [-1] * n
+    for i in sorted(range(n), key=lambda i: records[i].first_op):
+        if reused_from[i] == -1:
+            object_of[i] = len(objects)
+            objects.append([i])
+        else:
+            object_of[i] = object_of[reused_from[i]]
+            objects[object_of[i]].append(i)
+
+    total_consumption = 0
+    offsets: Offsets = [None] * n
+    for tensors in objects:
+        for i in tensors:
+            offsets[i] = total_consumption
+        total_consumption += max(records[i].size for i in tensors)
+
+    return total_consumption, offsets
+
+
+##########################
+# Branch and bound
+#
+# Exact solver, only practical for small graphs: stops when the time budget
+# runs out and returns the best layout found so far.
+# There is always an optimal layout where every tensor rests on offset 0 or
+# right on top of an overlapping tensor, so those are the only offsets tried.
+# Tensors are placed in increasing order of offset to avoid visiting
+# the same layout more than once.
+##########################
+def branch_and_bound(
+    records: Records, time_budget: float, initial: Result | None = None
+) -> Result:
+    n = len(records)
+    best_size, best_offsets = (
+        initial if initial is not None else greedy_by_size(records)
+    )
+    target = lower_bound(records)
+    deadline = time.monotonic() + time_budget
+
+    offsets: Offsets = [None] * n
+    # ops where each tensor is alive, to bound the unplaced tensors
+    ops = sorted({op for r in records for op in range(r.first_op, r.last_op + 1)})
+    by_size = sorted(range(n), key=lambda i: records[i].size, reverse=True)
+
+    def search(level: int, last: int, peak: int, placed: int) -> None:
+        nonlocal best_size, best_offsets
+
+        if best_size <= target or time.monotonic() > deadline:
+            return
+
+        if placed == n:
+            if peak < best_size:
+                best_size, best_offsets = peak, list(offsets)
+            return
+
+        # every unplaced tensor goes at level or above
+        unplaced = [i for i in by_size if offsets[i] is None]
+        bound = peak
+        for op in ops:
+            alive = sum(
+                records[i].size
+                for i in unplaced
+                if records[i].first_op <= op <= records[i].last_op
+            )
+            bound = max(bound, level + alive)
+        if bound >= best_size:
+            return
+
+        for i in unplaced:
+            t = records[i]
+            neighbours = [
+                k
+                for k in range(n)
+                if offsets[k] is not None and overlaps(records[k], t)
+            ]
+            candidates = {0} | {offsets[k] + records[k].size for k in neighbours}  # type: ignore
+
+            for offset in sorted(candidates):
+                if offset < level or (offset == level and i < last):
+                    continue
+                if offset + t.size >= best_size:
+                    break
+                if any(
+                    offset < offsets[k] + records[k].size  # type: ignore
+                    and offsets[k] < offset + t.size  # type: ignore
+                    for k in neighbours
+                ):
+                    continue
+
+                offsets[i] = offset
+                search(offset, i, max(peak, offset + t.size), placed + 1)
+                offsets[i] = None
+
+    search(0, -1, 0, 0)
+
+    return best_size, best_offsets
+
+
+# strategies tried by find_best_layout
+STRATEGIES: dict[str, Callable[[Records], Result]] = {
+    "naive": naive,
+    "greedy_by_size": greedy_by_size,
+    "greedy_by_size_improved": greedy_by_size_improved,
+    "greedy_by_breadth": greedy_by_breadth,
+    "min_cost_flow": min_cost_flow,
+}
+
+# the flow network has O(n^2) edges
+MIN_COST_FLOW_MAX_RECORDS = 200
+
+
+def compare_layouts(
+    records: Records, exact_time_budget: float = 0
+) -> dict[str, Result]:
+    """
+    Runs every strategy, returns the layout each one achieves
+
+    :param exact_time_budget: Seconds given to the exact solver (0 to skip it)
+    """
+    layouts: dict[str, Result] = {}
+
+    for name, strategy in STRATEGIES.items():
+        if strategy is min_cost_flow and len(records) > MIN_COST_FLOW_MAX_RECORDS:
+            continue
+        layouts[name] = strategy(records)
+
+    if exact_time_budget > 0:
+        best = min(layouts.values(), key=lambda r: r[0])
+        layouts["branch_and_bound"] = branch_and_bound(records, exact_time_budget, best)
+
+    return layouts
+
+
+def find_best_layout(records: Records, exact_time_budget: float = 0) -> Result:
     """
     Find the best memory layout using different strategies.
     """
-    alternatives = [
-        naive(records),
-        greedy_by_size(records),
-        # greedy_by_breadth(records),
-    ]
+    alternatives = compare_layouts(records, exact_time_budget)
 
-    return min(alternatives, key=lambda r: r[0])
+    return min(alternatives.values(), key=lambda r: r[0])
 
 
 if __name__ == "__main__":
@@ -128,4 +490,6 @@ if __name__ == "__main__":
         TensorUsageRecord(7, 8, 40),
     ]
 
-    print(find_best_layout(test))
+    print("lower bound:", lower_bound(test))
+    for name, (size, offsets) in compare_layouts(test, exact_time_budget=1).items():
+        print(f"{name}: {size} {offsets}")
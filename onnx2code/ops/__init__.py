@@ -1,6 +1,7 @@
 # flake8: noqa
 
 from . import (
+    batchnorm,
     broadcastable,
     concat,
     conv,
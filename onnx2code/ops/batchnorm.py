@@ -0,0 +1,65 @@
+import re
+
+from ..util import get_attribute
+from .operation import OpCall, Operation, OpImpl
+
+
+class BatchNormalization(Operation):
+    """
+    BatchNormalization operator (inference mode)
+
+    Most of the time it is folded into the preceding Conv/Gemm
+    (see Generator._fold_batch_normalization), this is used when that is not possible
+
+    https://github.com/onnx/onnx/blob/main/docs/Operators.md#batchnormalization
+    """
+
+    node_types = {"BatchNormalization"}
+
+    def parse(self) -> None:
+        assert len(self.inputs) == 5, "expected five inputs"
+
+        if len(self.outputs) != 1:
+            raise NotImplementedError("training mode is not supported")
+
+        self.X = self.inputs[0]
+        self.epsilon = get_attribute(self.node, "epsilon", 1e-5)
+
+        # onnx is NCHW, normalization is done per channel
+        self.C = self.X.shape[1] if len(self.X.shape) > 1 else 1
+        self.batches = self.X.shape[0] if len(self.X.shape) > 1 else 1
+        self.spatial = self.X.size // (self.batches * self.C)
+
+    def call(self) -> OpCall:
+        return OpCall(
+            sig_name="BatchNormalization",
+            # epsilon is part of the implementation
+            sig_params=[self.X.shape, re.sub(r"\W", "_", f"{self.epsilon:g}")],
+            inputs=self.inputs,
+            outputs=self.outputs,
+            input_names=("X", "scale", "B", "mean", "var"),
+        )
+
+
+@BatchNormalization.variant("c")
+class BatchNormalizationC(BatchNormalization):
+    def impl(self) -> OpImpl:
+        # y = (x - mean) / sqrt(var + epsilon) * scale + B
+        # is rewritten as y = x * s + t, so the inner loop is a contiguous FMA
+        source = f"""
+        for(int c = 0; c < {self.C}; c++) {{
+            const float s = scale[c] / sqrt(var[c] + {self.epsilon}f);
+            const float t = B[c] - mean[c] * s;
+
+            for(int n = 0; n < {self.batches}; n++) {{
+                const float* x = X + (n * {self.C} + c) * {self.spatial};
+                float* y = OUT + (n * {self.C} + c) * {self.spatial};
+
+                for(int i = 0; i < {self.spatial}; i++) {{
+                    y[i] = x[i] * s + t;
+                }}
+            }}
+        }}
+        """
+
+        return OpImpl(lang="c", source=source)
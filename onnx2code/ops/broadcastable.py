@@ -1,7 +1,10 @@
 from typing import Any
 
 import numpy as np
+import onnx
 
+from ..tensor import TensorInfo
+from .layout import BLOCKED_LAYOUTS, NHWC
 from .operation import OpCall, Operation, OpImpl
 
 
@@ -13,6 +16,23 @@ class Broadcastable(Operation):
     """
 
     node_types = {"Add", "Div", "Mul", "Sub"}
+    # without broadcasting (or with a scalar) the order in memory doesn't matter
+    layouts = BLOCKED_LAYOUTS | {NHWC}
+
+    @classmethod
+    def keeps_layout(
+        cls,
+        node: onnx.NodeProto,
+        inputs: list[TensorInfo],
+        outputs: list[TensorInfo],
+        layout: str,
+    ) -> bool:
+        A, B = inputs
+        return (
+            A.tag != "weight"
+            and A.shape == outputs[0].shape
+            and (B.size == 1 or (B.tag != "weight" and B.shape == A.shape))
+        )
 
     def parse(self) -> None:
         assert len(self.inputs) == 2, "expected two inputs"
@@ -22,13 +42,23 @@ class Broadcastable(Operation):
         self.b_is_scalar = self.inputs[1].size == 1
         self.input_A = self.inputs[0]
         self.input_B = self.inputs[1]
+        self.layout = self.outputs[0].layout
 
     def call(self) -> OpCall:
+        # the output can overwrite an input that is not broadcasted
+        inplace_input = None
+        for i, input in enumerate(self.inputs):
+            if input.size == self.outputs[0].size:
+                inplace_input = i
+                break
+
         return OpCall(
             sig_name=self.op,
-            sig_params=[self.input_A.shape, self.input_B.shape],
+            sig_params=[self.input_A.shape, self.input_B.shape]
+            + ([self.layout] if self.layout is not None else []),
             inputs=self.inputs,
             outputs=self.outputs,
+            inplace_input=inplace_input,
         )
 
 
@@ -44,6 +74,10 @@ class BroadcastableC(Broadcastable):
             "Sub": "-",
         }[self.op]
 
+        if self.layout is not None:
+            # the shapes are the same (see keeps_layout), the layout includes padding
+            source += f"// layout {self.layout}\n"
+
         if self.b_is_scalar:
             source += f"""
             const float D = B[0];
@@ -51,6 +85,12 @@ class BroadcastableC(Broadcastable):
                 OUT[i] = A[i] {symbol} D;
             }}
             """
+        elif self.layout is not None:
+            source += f"""
+            for (int i = 0; i < {self.outputs[0].size}; i++) {{
+                OUT[i] = A[i] {symbol} B[i];
+            }}
+            """
         else:
             # since we are using the trick below, we can't tell beforehand if
             # implementations will differ for every pair of input shapes
@@ -1,4 +1,9 @@
+import numpy as np
+import onnx
+
+from ..tensor import TensorInfo
 from ..util import compute_strides, get_attribute
+from .layout import BLOCKED_LAYOUTS, channel_block
 from .operation import LETTERS, OpCall, Operation, OpImpl
 
 
@@ -10,6 +15,28 @@ class Concat(Operation):
     """
 
     node_types = {"Concat"}
+    # along the channels, if every input has whole blocks
+    layouts = BLOCKED_LAYOUTS
+
+    @classmethod
+    def keeps_layout(
+        cls,
+        node: onnx.NodeProto,
+        inputs: list[TensorInfo],
+        outputs: list[TensorInfo],
+        layout: str,
+    ) -> bool:
+        shape = outputs[0].shape
+        return (
+            layout in cls.layouts
+            and len(shape) == 4
+            and shape[0] == 1
+            and get_attribute(node, "axis", None) % 4 == 1
+            and all(
+                input.tag != "weight" and input.shape[1] % channel_block() == 0
+                for input in inputs
+            )
+        )
 
     def parse(self) -> None:
         assert len(self.outputs) == 1, "expected one output"
@@ -18,12 +45,23 @@ class Concat(Operation):
 
         assert self.axis is not None, "axis is not set"
 
+        self.axis = self.axis % len(self.outputs[0].shape)
+
     def call(self) -> OpCall:
+        # along an outer axis every input is a contiguous slice of the output
+        view_offsets = None
+        if np.prod(self.outputs[0].shape[: self.axis]) == 1:
+            view_offsets = [0]
+            for input in self.inputs[:-1]:
+                view_offsets.append(view_offsets[-1] + input.size)
+
         return OpCall(
             sig_name="Concat",
-            sig_params=[inp.shape for inp in self.inputs],
+            sig_params=[inp.shape for inp in self.inputs]
+            + ([self.outputs[0].layout] if self.outputs[0].layout is not None else []),
             inputs=self.inputs,
             outputs=self.outputs,
+            view_offsets=view_offsets,
         )
 
 
@@ -32,6 +70,14 @@ class ConcatC(Concat):
     def impl(self) -> OpImpl:
         source = ""
 
+        if self.outputs[0].layout is not None:
+            # the blocks of each input are a contiguous slice of the output
+            offset = 0
+            for k, input in enumerate(self.inputs):
+                source += f"for (int i = 0; i < {input.size}; i++) OUT[{offset} + i] = {LETTERS[k]}[i];\n"
+                offset += input.size
+            return OpImpl(lang="c", source=source)
+
         output_strides = compute_strides(self.outputs[0].shape)
 
         def output_index(axis_offset: int) -> str:
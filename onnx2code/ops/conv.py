@@ -1,8 +1,9 @@
 from math import ceil
 
 import numpy as np
+import onnx
 
-from onnx2code.ops.gemm_tiling.GEMM import call_GEMM, external_paths_GEMM
+from onnx2code.ops.gemm_tiling.GEMM import call_GEMM, external_paths_GEMM, pack_A
 from onnx2code.util import (
     compute_strides,
     get_attribute,
@@ -10,6 +11,9 @@ from onnx2code.util import (
     resolve_stride_attribute,
 )
 
+from ..tensor import TensorInfo
+from .epilogue import epilogue_lambda, epilogue_names, epilogue_tags, epilogue_tensors
+from .layout import BLOCKED_LAYOUTS, NHWC, blocked_layout, channel_block, layout_index
 from .operation import OpCall, Operation, OpImpl
 
 
@@ -17,7 +21,7 @@ class Conv(Operation):
     """
     Conv operator
 
-    Only 2D convolutions are supported
+    Only 2D convolutions are supported, grouped ones included
 
     https://github.com/onnx/onnx/blob/main/docs/Operators.md#conv
     """
@@ -30,15 +34,19 @@ class Conv(Operation):
         ), "expected two or three inputs"
         assert len(self.outputs) == 1, "expected one output"
 
-        group = get_attribute(self.node, "group", 1)
-        if group != 1:
-            raise NotImplementedError("depthwise is not supported (group != 1)")
-
         self.X = self.inputs[0]
         self.W = self.inputs[1]
         self.B = self.inputs[2] if len(self.inputs) == 3 else None
         self.Y = self.outputs[0]
 
+        # the input channels (and the filters) are split in groups,
+        # each filter only reads the KC channels of its group
+        self.group = get_attribute(self.node, "group", 1)
+        assert (
+            self.X.shape[1] == self.group * self.W.shape[1]
+            and self.W.shape[0] % self.group == 0
+        ), "channels and filters must be divisible by group"
+
         self.dilations = get_attribute(self.node, "dilations", [1] * 2)
         self.strides = resolve_stride_attribute(self.node)
         self.pads = resolve_padding_attribute(self.node, self.X.shape, self.W.shape)
@@ -46,10 +54,17 @@ class Conv(Operation):
     def call(self) -> OpCall:
         return OpCall(
             sig_name="Conv",
-            sig_params=[self.X.shape, self.W.shape, self.strides, self.pads],
-            inputs=self.inputs,
+            sig_params=[
+                self.X.shape,
+                self.W.shape,
+                self.strides,
+                self.pads,
+                *epilogue_tags(self.epilogue),
+            ],
+            inputs=self.inputs + epilogue_tensors(self.epilogue),
             outputs=self.outputs,
-            input_names=("X", "W", "B"),
+            input_names=("X", "W", "B")[: len(self.inputs)]
+            + epilogue_names(self.epilogue),
         )
 
 
@@ -62,9 +77,10 @@ class ConvC(Conv):
         H = self.X.shape[2]
         W = self.X.shape[3]
         F = self.W.shape[0]  # filters
-        KC = self.W.shape[1]
+        KC = self.W.shape[1]  # channels of each group
         KH = self.W.shape[2]
         KW = self.W.shape[3]
+        FG = F // self.group  # filters of each group
 
         pads_start = [self.pads[0], self.pads[1]]
         # pads_end = [self.pads[2], self.pads[3]]
@@ -73,10 +89,12 @@ class ConvC(Conv):
         output_strides = compute_strides(self.Y.shape)
         kernel_strides = compute_strides(self.W.shape)
 
-        source = ""
+        source = epilogue_lambda(self.epilogue, channel="row")
 
         source += f"""
         for(int f = 0; f < {F}; f++) {{
+            // first input channel of the group of the filter
+            const int c = (f / {FG}) * {KC};
             // start position of kernel
             for(int h = 0; h < {self.Y.shape[2]}; h++) {{
                 for(int w = 0; w < {self.Y.shape[3]}; w++) {{
@@ -90,7 +108,7 @@ class ConvC(Conv):
                                 const int iw = {-pads_start[1]} + (w * {self.strides[1]}) + ww;
                                 if(ih >= 0 && ih < {H} && iw >= 0 && iw < {W}) {{
                                     accum += X[
-                                        cc * {input_strides[1]} +
+                                        (c + cc) * {input_strides[1]} +
                                         ih * {input_strides[2]} +
                                         iw * {input_strides[3]}
                                     ] * W[
@@ -108,7 +126,7 @@ class ConvC(Conv):
                         f * {output_strides[1]} +
                         h * {output_strides[2]} +
                         w * {output_strides[3]}
-                    ] = accum;
+                    ] = epilogue(f, h * {self.Y.shape[3]} + w, accum);
                 }}
             }}
         }}
@@ -119,6 +137,57 @@ class ConvC(Conv):
 
 @Conv.variant(["im2col", "loop-tiling"], priority=0)
 class ConvIm2col(Conv):
+    def call(self) -> OpCall:
+        call = super().call()
+        # the im2col matrix
+        call.scratch_size = int(np.prod(self.im2col_shape()))
+
+        if self.packed_W():
+            assert self.W.data is not None
+            F = self.W.shape[0]
+            call.sig_params.append("packedW")
+            # the filters of each group are a GEMM of their own
+            call.packed_inputs[1] = np.concatenate(
+                [
+                    pack_A(filters)
+                    for filters in np.split(self.W.data.reshape(F, -1), self.group)
+                ]
+            )
+
+        return call
+
+    def packed_W(self) -> bool:
+        """
+        Constant filters (weights) are packed ahead of time
+        """
+        W = self.W
+        return W.tag == "weight" and W.data is not None and W.data.dtype == np.float32
+
+    def patches_shape(self) -> tuple[int, int]:
+        """
+        Number of patches (kernel positions) in each spatial dimension
+        """
+        H, W = self.X.shape[2], self.X.shape[3]
+        KH, KW = self.W.shape[2], self.W.shape[3]
+        pads, dilations, strides = self.pads, self.dilations, self.strides
+
+        return ceil(
+            (H - KH + 1 + pads[0] + pads[2] - (dilations[0] - 1) * (KH - 1))
+            / strides[0]
+        ), ceil(
+            (W - KW + 1 + pads[1] + pads[3] - (dilations[1] - 1) * (KW - 1))
+            / strides[1]
+        )
+
+    def im2col_shape(self) -> list[int]:
+        """
+        Shape of the im2col matrix of a single group
+        """
+        KC, KH, KW = self.W.shape[1], self.W.shape[2], self.W.shape[3]
+        PH, PW = self.patches_shape()
+
+        return [KC * KH * KW, PH * PW]
+
     def impl(self) -> OpImpl:
         input_shape = self.X.shape
         weight_shape = self.W.shape
@@ -130,54 +199,44 @@ class ConvIm2col(Conv):
         ), "expected padding only in two dimensions"
 
         # onnx is NCHW
-        N = input_shape[0]
-        C = input_shape[1]
         H = input_shape[2]
         W = input_shape[3]
         F = weight_shape[0]  # filters
-        KC = weight_shape[1]
+        KC = weight_shape[1]  # channels of each group
         KH = weight_shape[2]
         KW = weight_shape[3]
+        G = self.group
+        FG = F // G  # filters of each group
 
         input_strides = compute_strides(input_shape)
         kernel_strides = compute_strides([KC, KH, KW])
         pads_start = [pads[0], pads[1]]
-        pads_end = [pads[2], pads[3]]
-        patch_stride = KC * KH * KW
-        num_patches = ceil(
-            (H - KH + 1 + pads_start[0] + pads_end[0] - (dilations[0] - 1) * (KH - 1))
-            / strides[0]
-        ) * ceil(
-            (W - KW + 1 + pads_start[1] + pads_end[1] - (dilations[1] - 1) * (KW - 1))
-            / strides[0]
-        )
-        im2col_shape = [patch_stride, num_patches]
-
-        bias_code = (
-            f"""
-            // bias
-            for (int f = 0; f < {F}; f++) {{
-                for (int i = 0; i < {num_patches}; i++) {{
-                    OUT[f * {num_patches} + i] += B[f];
-                }}
-            }}
-            """
-            if has_bias
-            else ""
-        )
+        patch_stride, num_patches = self.im2col_shape()
+        PH, PW = self.patches_shape()
+
+        # filters of a group, as stored in W
+        filters_size = FG * patch_stride
+        if self.packed_W():
+            filters_size = pack_A(np.zeros((FG, patch_stride), dtype=np.float32)).size
 
-        _N = F  # weight_shape[0]
-        _M = patch_stride  # weight_shape[1]
-        _K = im2col_shape[1]
+        # the bias is added in the writeback of the GEMM, along with the epilogue
+        source = epilogue_lambda(
+            self.epilogue, channel="row", bias="B" if has_bias else None
+        )
 
-        source = f"""
+        source += f"""
         // padding, dilations, strides
-        // im2col
-        // float im2col[{np.prod(im2col_shape)}];
-        int patch = 0;
-        for(int c = 0; c < {C - KC + 1}; c++) {{
-            for(int h = {-pads_start[0]}; h < {H - KH + 1 + pads_end[0] - (dilations[0] - 1) * (KH - 1)}; h += {strides[0]}) {{
-                for(int w = {-pads_start[1]}; w < {W - KW + 1 + pads_end[1] - (dilations[1] - 1) * (KW - 1)}; w += {strides[1]}) {{
+        // one GEMM for each group, with an im2col ({patch_stride} x {num_patches})
+        // of the KC input channels of the group
+        float* im2col = scratch;
+        for(int g = 0; g < {G}; g++) {{
+        const float* Xg = X + g * {KC * input_strides[1]};
+        parallel_for({PH}, [&](int start, int end) {{
+            for(int ph = start; ph < end; ph++) {{
+                const int h = {-pads_start[0]} + ph * {strides[0]};
+                for(int pw = 0; pw < {PW}; pw++) {{
+                    const int w = {-pads_start[1]} + pw * {strides[1]};
+                    const int patch = ph * {PW} + pw;
                     // copy patch
                     for(int cc = 0; cc < {KC}; cc++) {{
                         for(int hh = 0; hh < {KH}; hh++) {{
@@ -188,8 +247,8 @@ class ConvIm2col(Conv):
                                 if(ih < 0 || ih >= {H} || iw < 0 || iw >= {W}) {{
                                     value = 0.0f;
                                 }} else {{
-                                    value = X[
-                                        (c + cc) * {input_strides[1]} +
+                                    value = Xg[
+                                        cc * {input_strides[1]} +
                                         ih * {input_strides[2]} +
                                         iw * {input_strides[3]}
                                     ];
@@ -203,22 +262,482 @@ class ConvIm2col(Conv):
                             }}
                         }}
                     }}
-                    patch++;
                 }}
             }}
-        }}
+        }});
         // gemm ({self.Y.shape})
-        for(int row = 0; row < {_N}; row++) {{
-            for(int col = 0; col < {_K}; col++) {{
-                float sum = 0;
-                for(int i = 0; i < {_M}; i++) {{
-                    sum += W[row * {_M} + i] * im2col[i * {_K} + col];
+        // W (FG x KC*KH*KW) * im2col (KC*KH*KW x patches), for the filters of the group
+        auto group_epilogue = [&](int row, int col, float v) {{
+            return epilogue(g * {FG} + row, col, v);
+        }};
+        {call_GEMM(FG, patch_stride, num_patches, f"W + g * {filters_size}, im2col, OUT + g * {FG * num_patches}, group_epilogue", packed_A=self.packed_W())}
+        }}
+        """
+
+        return OpImpl(lang="c", source=source, external_paths=external_paths_GEMM)
+
+
+# groups with more channels than this fall back to the next variations (im2col + GEMM)
+DIRECT_MAX_GROUP_CHANNELS = 16
+
+
+@Conv.variant("conv-direct", priority=-1)
+class ConvDirect(Conv):
+    """
+    Grouped and depthwise (group == C) convolutions with few channels per group
+
+    There is too little work in each group to amortize an im2col,
+    so each output row is accumulated directly, vectorized over its width
+    """
+
+    def parse(self) -> None:
+        super().parse()
+
+        if self.group == 1:
+            raise NotImplementedError("direct conv is only for grouped convs")
+        if self.W.shape[1] > DIRECT_MAX_GROUP_CHANNELS:
+            raise NotImplementedError("too many channels in each group")
+
+    def impl(self) -> OpImpl:
+        H = self.X.shape[2]
+        W = self.X.shape[3]
+        F = self.W.shape[0]  # filters
+        KC = self.W.shape[1]  # channels of each group
+        KH = self.W.shape[2]
+        KW = self.W.shape[3]
+        FG = F // self.group  # filters of each group
+        OH = self.Y.shape[2]
+        OW = self.Y.shape[3]
+        pads, dilations, strides = self.pads, self.dilations, self.strides
+
+        input_strides = compute_strides(self.X.shape)
+        output_strides = compute_strides(self.Y.shape)
+        kernel_strides = compute_strides(self.W.shape)
+
+        # the output columns whose input column falls inside the image
+        # are known for each column of the kernel, so the inner loops have no branches
+        taps = ""
+        for ww in range(KW):
+            offset = ww * dilations[1] - pads[1]
+            start = max(0, ceil(-offset / strides[1]))
+            end = min(OW, (W - 1 - offset) // strides[1] + 1)
+            if start >= end:
+                continue
+            taps += f"""
+                            {{
+                                const float k = Wf[cc * {kernel_strides[1]} + hh * {kernel_strides[2]} + {ww}];
+                                for(int w = {start}; w < {end}; w++) {{
+                                    acc[w] += k * row[w * {strides[1]} + {offset}];
+                                }}
+                            }}"""
+
+        source = epilogue_lambda(self.epilogue, channel="row")
+
+        source += f"""
+        // filters are independent
+        parallel_for({F}, [&](int start, int end) {{
+        for(int f = start; f < end; f++) {{
+            // input channels of the group of the filter
+            const float* Xg = X + (f / {FG}) * {KC * input_strides[1]};
+            const float* Wf = W + f * {kernel_strides[0]};
+            float acc[{OW}];
+
+            for(int h = 0; h < {OH}; h++) {{
+                for(int w = 0; w < {OW}; w++) {{
+                    acc[w] = {"0.0f" if self.B is None else "B[f]"};
+                }}
+
+                for(int cc = 0; cc < {KC}; cc++) {{
+                    for(int hh = 0; hh < {KH}; hh++) {{
+                        const int ih = {-pads[0]} + h * {strides[0]} + hh * {dilations[0]};
+                        if(ih >= 0 && ih < {H}) {{
+                            const float* row = Xg + cc * {input_strides[1]} + ih * {input_strides[2]};
+                            {taps.strip()}
+                        }}
+                    }}
+                }}
+
+                for(int w = 0; w < {OW}; w++) {{
+                    OUT[
+                        f * {output_strides[1]} +
+                        h * {output_strides[2]} +
+                        w
+                    ] = epilogue(f, h * {OW} + w, acc[w]);
+                }}
+            }}
+        }}
+        }});
+        """
+
+        return OpImpl(lang="c", source=source)
+
+
+# transforms of Winograd F(m x m, 3 x 3), for each output tile size m
+# (Lavin & Gray, Fast Algorithms for Convolutional Neural Networks)
+WINOGRAD_MATRICES = {
+    2: {
+        "BT": [
+            [1, 0, -1, 0],
+            [0, 1, 1, 0],
+            [0, -1, 1, 0],
+            [0, 1, 0, -1],
+        ],
+        "G": [
+            [1, 0, 0],
+            [1 / 2, 1 / 2, 1 / 2],
+            [1 / 2, -1 / 2, 1 / 2],
+            [0, 0, 1],
+        ],
+        "AT": [
+            [1, 1, 1, 0],
+            [0, 1, -1, -1],
+        ],
+    },
+    4: {
+        "BT": [
+            [4, 0, -5, 0, 1, 0],
+            [0, -4, -4, 1, 1, 0],
+            [0, 4, -4, -1, 1, 0],
+            [0, -2, -1, 2, 1, 0],
+            [0, 2, -1, -2, 1, 0],
+            [0, 4, 0, -5, 0, 1],
+        ],
+        "G": [
+            [1 / 4, 0, 0],
+            [-1 / 6, -1 / 6, -1 / 6],
+            [-1 / 6, 1 / 6, -1 / 6],
+            [1 / 24, 1 / 12, 1 / 6],
+            [1 / 24, -1 / 12, 1 / 6],
+            [0, 0, 1],
+        ],
+        "AT": [
+            [1, 1, 1, 1, 1, 0],
+            [0, 1, -1, 2, -2, 0],
+            [0, 1, 1, 4, 4, 0],
+            [0, 1, -1, 8, -8, 1],
+        ],
+    },
+}
+
+
+def c_matrix(matrix: list[list[float]]) -> str:
+    """
+    C initializer of a 2D array
+    """
+    rows = ["{" + ", ".join(f"{float(v)}f" for v in row) + "}" for row in matrix]
+    return "{" + ", ".join(rows) + "}"
+
+
+@Conv.variant("winograd", priority=-2)
+class ConvWinograd(Conv):
+    """
+    Winograd F(m x m, 3 x 3) for 3x3 convolutions with stride and dilation 1
+
+    The filters are transformed ahead of time (U = G g G^T), the input is split
+    in overlapping tiles of (m + 2) x (m + 2) which are transformed (V = B^T d B),
+    then each of the (m + 2)^2 positions of the tiles is a GEMM U (F x KC) * V (KC x tiles)
+    and the output tiles are transformed back (Y = A^T M A)
+    """
+
+    def parse(self) -> None:
+        super().parse()
+
+        if self.group != 1:
+            raise NotImplementedError("winograd does not support groups")
+        if self.W.shape[2:] != [3, 3]:
+            raise NotImplementedError("winograd is only for 3x3 kernels")
+        if self.strides != [1, 1] or self.dilations != [1, 1]:
+            raise NotImplementedError("winograd needs stride and dilation 1")
+        W = self.W
+        if W.tag != "weight" or W.data is None or W.data.dtype != np.float32:
+            raise NotImplementedError("winograd needs constant filters")
+
+        # bigger tiles save more multiplications but are less precise,
+        # and waste more work in the borders of small images
+        self.m = 4 if min(self.Y.shape[2], self.Y.shape[3]) >= 8 else 2
+
+    def tiles_shape(self) -> tuple[int, int]:
+        """
+        Number of output tiles in each spatial dimension
+        """
+        return ceil(self.Y.shape[2] / self.m), ceil(self.Y.shape[3] / self.m)
+
+    def transformed_W(self) -> np.ndarray:
+        """
+        Filters in the Winograd domain, one packed F x KC matrix for each position of a tile
+        """
+        assert self.W.data is not None
+        F, KC = self.W.shape[0], self.W.shape[1]
+        G = np.array(WINOGRAD_MATRICES[self.m]["G"])
+
+        U = np.einsum("ik,fckl,jl->ijfc", G, self.W.data.astype(np.float64), G)
+        U = U.reshape(-1, F, KC).astype(np.float32)
+
+        return np.concatenate([pack_A(position) for position in U])
+
+    def call(self) -> OpCall:
+        call = super().call()
+        TH, TW = self.tiles_shape()
+        alpha = self.m + 2
+        F, KC = self.W.shape[0], self.W.shape[1]
+
+        # transformed input tiles and output tiles
+        call.scratch_size = alpha * alpha * (KC + F) * TH * TW
+        call.sig_params.append(f"winograd{self.m}")
+        call.packed_inputs[1] = self.transformed_W()
+
+        return call
+
+    def impl(self) -> OpImpl:
+        H = self.X.shape[2]
+        W = self.X.shape[3]
+        F = self.W.shape[0]  # filters
+        KC = self.W.shape[1]
+        OH = self.Y.shape[2]
+        OW = self.Y.shape[3]
+        m = self.m
+        alpha = m + 2
+        TH, TW = self.tiles_shape()
+        T = TH * TW
+
+        matrices = WINOGRAD_MATRICES[m]
+        input_strides = compute_strides(self.X.shape)
+        output_strides = compute_strides(self.Y.shape)
+        # filters of a position of the tile, as stored in W
+        filters_size = pack_A(np.zeros((F, KC), dtype=np.float32)).size
+
+        source = epilogue_lambda(
+            self.epilogue, channel="row", bias="B" if self.B is not None else None
+        )
+
+        source += f"""
+        static const float BT[{alpha}][{alpha}] = {c_matrix(matrices["BT"])};
+        static const float AT[{m}][{alpha}] = {c_matrix(matrices["AT"])};
+
+        // {alpha}x{alpha} positions x KC channels x {T} tiles
+        float* V = scratch;
+        // {alpha}x{alpha} positions x F filters x {T} tiles
+        float* M = scratch + {alpha * alpha * KC * T};
+
+        // input transform: V = BT d B
+        parallel_for({KC}, [&](int start, int end) {{
+        for(int c = start; c < end; c++) {{
+            for(int t = 0; t < {T}; t++) {{
+                const int ih0 = (t / {TW}) * {m} - {self.pads[0]};
+                const int iw0 = (t % {TW}) * {m} - {self.pads[1]};
+
+                float d[{alpha}][{alpha}];
+                for(int i = 0; i < {alpha}; i++) {{
+                    for(int j = 0; j < {alpha}; j++) {{
+                        const int ih = ih0 + i;
+                        const int iw = iw0 + j;
+                        d[i][j] = ih >= 0 && ih < {H} && iw >= 0 && iw < {W} ? X[
+                            c * {input_strides[1]} +
+                            ih * {input_strides[2]} +
+                            iw * {input_strides[3]}
+                        ] : 0.0f;
+                    }}
+                }}
+
+                float tmp[{alpha}][{alpha}];
+                for(int i = 0; i < {alpha}; i++) {{
+                    for(int j = 0; j < {alpha}; j++) {{
+                        float acc = 0.0f;
+                        for(int k = 0; k < {alpha}; k++) {{
+                            acc += BT[i][k] * d[k][j];
+                        }}
+                        tmp[i][j] = acc;
+                    }}
+                }}
+                for(int i = 0; i < {alpha}; i++) {{
+                    for(int j = 0; j < {alpha}; j++) {{
+                        float acc = 0.0f;
+                        for(int k = 0; k < {alpha}; k++) {{
+                            acc += tmp[i][k] * BT[j][k];
+                        }}
+                        V[((i * {alpha} + j) * {KC} + c) * {T} + t] = acc;
+                    }}
                 }}
-                OUT[row * {_K} + col] = sum;
             }}
         }}
-        //{call_GEMM(_N, _M, _K,"W, im2col, OUT")}
-        {bias_code}
+        }});
+
+        // one gemm for each position of the tiles
+        // U (F x KC) * V (KC x tiles)
+        for(int p = 0; p < {alpha * alpha}; p++) {{
+            {call_GEMM(F, KC, T, f"W + p * {filters_size}, V + p * {KC * T}, M + p * {F * T}", packed_A=True)}
+        }}
+
+        // output transform: Y = AT M A
+        parallel_for({F}, [&](int start, int end) {{
+        for(int f = start; f < end; f++) {{
+            for(int t = 0; t < {T}; t++) {{
+                const int h0 = (t / {TW}) * {m};
+                const int w0 = (t % {TW}) * {m};
+
+                float tmp[{m}][{alpha}];
+                for(int i = 0; i < {m}; i++) {{
+                    for(int j = 0; j < {alpha}; j++) {{
+                        float acc = 0.0f;
+                        for(int k = 0; k < {alpha}; k++) {{
+                            acc += AT[i][k] * M[((k * {alpha} + j) * {F} + f) * {T} + t];
+                        }}
+                        tmp[i][j] = acc;
+                    }}
+                }}
+                for(int i = 0; i < {m}; i++) {{
+                    for(int j = 0; j < {m}; j++) {{
+                        const int h = h0 + i;
+                        const int w = w0 + j;
+                        if(h < {OH} && w < {OW}) {{
+                            float acc = 0.0f;
+                            for(int k = 0; k < {alpha}; k++) {{
+                                acc += tmp[i][k] * AT[j][k];
+                            }}
+                            OUT[
+                                f * {output_strides[1]} +
+                                h * {output_strides[2]} +
+                                w * {output_strides[3]}
+                            ] = epilogue(f, h * {OW} + w, acc);
+                        }}
+                    }}
+                }}
+            }}
+        }}
+        }});
         """
 
         return OpImpl(lang="c", source=source, external_paths=external_paths_GEMM)
+
+
+def supports_blocked(node: onnx.NodeProto, X: TensorInfo, W: TensorInfo) -> bool:
+    """
+    Checks if ConvNCHWc can run the convolution
+    """
+    return (
+        len(X.shape) == 4
+        and X.shape[0] == 1
+        and get_attribute(node, "group", 1) == 1
+        and W.tag == "weight"
+        and W.data is not None
+        and W.data.dtype == np.float32
+    )
+
+
+@Conv.variant("nchwc", priority=-1)
+class ConvNCHWc(Conv):
+    """
+    Direct convolution over the NCHWc (channel blocked) layout
+
+    Each step computes a block of filters (one vector) for a few consecutive
+    output pixels, broadcasting one input value at a time,
+    so there is no im2col matrix. The filters are packed ahead of time in
+    (F/c) x KC x KH x KW x c, so each vector of weights is contiguous.
+    Input and output can be in NCHW, NHWC or NCHWc: the generator keeps the tensors
+    between two of these convolutions blocked, the first one reads NCHW (or NHWC)
+    and the last one writes NCHW (or NHWC)
+    """
+
+    layouts = BLOCKED_LAYOUTS | {NHWC}
+
+    def parse(self) -> None:
+        super().parse()
+
+        if not supports_blocked(self.node, self.X, self.W):
+            raise NotImplementedError("NCHWc needs constant filters and no groups")
+
+        self.CB = channel_block()
+        for tensor in [self.X, self.Y]:
+            assert tensor.layout in [None, NHWC, blocked_layout()], "unexpected block"
+
+    def call(self) -> OpCall:
+        call = super().call()
+        assert self.W.data is not None
+
+        F, KC, KH, KW = self.W.shape
+        FB = ceil(F / self.CB)
+
+        call.sig_params += [
+            self.X.layout or "NCHW",
+            self.Y.layout or "NCHW",
+            self.dilations,
+        ]
+
+        # (F/c) x KC x KH x KW x c, the missing filters of the last block are zero
+        filters = np.zeros((FB * self.CB, KC, KH, KW), dtype=np.float32)
+        filters[:F] = self.W.data
+        filters = filters.reshape(FB, self.CB, KC, KH, KW).transpose(0, 2, 3, 4, 1)
+        call.packed_inputs[1] = filters.reshape(-1)
+
+        return call
+
+    def impl(self) -> OpImpl:
+        H = self.X.shape[2]
+        W = self.X.shape[3]
+        F, KC, KH, KW = self.W.shape
+        OH = self.Y.shape[2]
+        OW = self.Y.shape[3]
+        pads, dilations, strides = self.pads, self.dilations, self.strides
+        CB = self.CB
+        FB = ceil(F / CB)
+        # output pixels computed at once (their accumulators fill the vector registers)
+        WB = 64 // CB
+
+        # the filters that pad the last block are zeroed in a blocked output,
+        # and don't exist in NCHW or NHWC
+        padding = "break;"
+        if self.Y.layout in BLOCKED_LAYOUTS:
+            padding = "OUT[index] = 0.0f; continue;"
+
+        # the bias is added in the writeback, it is not padded to the blocks
+        source = epilogue_lambda(
+            self.epilogue, channel="row", bias="B" if self.B is not None else None
+        )
+
+        source += f"""
+        // blocks of {CB} filters x output rows
+        parallel_for({FB * OH}, [&](int start, int end) {{
+        for(int job = start; job < end; job++) {{
+            const int fb = job / {OH};
+            const int h = job % {OH};
+            const float* Wb = W + fb * {KC * KH * KW * CB};
+
+            for(int w0 = 0; w0 < {OW}; w0 += {WB}) {{
+                float acc[{WB}][{CB}] = {{}};
+
+                for(int c = 0; c < {KC}; c++) {{
+                    for(int kh = 0; kh < {KH}; kh++) {{
+                        const int ih = {-pads[0]} + h * {strides[0]} + kh * {dilations[0]};
+                        if(ih < 0 || ih >= {H}) {{
+                            continue;
+                        }}
+                        for(int kw = 0; kw < {KW}; kw++) {{
+                            const float* wv = Wb + ((c * {KH} + kh) * {KW} + kw) * {CB};
+                            for(int j = 0; j < {WB}; j++) {{
+                                const int iw = {-pads[1]} + (w0 + j) * {strides[1]} + kw * {dilations[1]};
+                                const float x = iw >= 0 && iw < {W} ? X[{layout_index(self.X, "c", "ih", "iw")}] : 0.0f;
+                                for(int l = 0; l < {CB}; l++) {{
+                                    acc[j][l] += x * wv[l];
+                                }}
+                            }}
+                        }}
+                    }}
+                }}
+
+                for(int j = 0; j < {WB} && w0 + j < {OW}; j++) {{
+                    const int w = w0 + j;
+                    for(int l = 0; l < {CB}; l++) {{
+                        const int f = fb * {CB} + l;
+                        const int index = {layout_index(self.Y, "f", "h", "w")};
+                        if(f >= {F}) {{
+                            {padding}
+                        }}
+                        OUT[index] = epilogue(f, h * {OW} + w, acc[j][l]);
+                    }}
+                }}
+            }}
+        }}
+        }});
+        """
+
+        return OpImpl(lang="c", source=source)
@@ -1,6 +1,9 @@
 import numpy as np
+import onnx
 
+from ..tensor import TensorInfo
 from ..util import get_attribute
+from .layout import BLOCKED_LAYOUTS, NHWC
 from .operation import LETTERS, OpCall, Operation, OpImpl
 
 
@@ -12,6 +15,22 @@ class Elementwise(Operation):
     """
 
     node_types = {"Relu", "Tanh", "Sigmoid", "Clip", "Sum"}
+    # every element is computed on its own, the order in memory doesn't matter
+    layouts = BLOCKED_LAYOUTS | {NHWC}
+
+    @classmethod
+    def keeps_layout(
+        cls,
+        node: onnx.NodeProto,
+        inputs: list[TensorInfo],
+        outputs: list[TensorInfo],
+        layout: str,
+    ) -> bool:
+        # the bounds of Clip are scalars
+        return all(
+            input.size == 1 if input.tag == "weight" else input.shape == outputs[0].shape
+            for input in inputs
+        )
 
     def parse(self) -> None:
         assert len(self.outputs) == 1, "expected one output"
@@ -35,6 +54,7 @@ class Elementwise(Operation):
             sig_params=[self.size],
             inputs=self.inputs,
             outputs=self.outputs,
+            inplace_input=0,
         )
 
 
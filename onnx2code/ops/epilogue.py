@@ -0,0 +1,130 @@
+import re
+from dataclasses import dataclass
+from typing import Literal
+
+import numpy as np
+
+from ..tensor import TensorInfo
+
+# elementwise operators that can be fused into the writeback of their producer
+EPILOGUE_ACTIVATIONS = {"Relu", "Tanh", "Sigmoid", "Clip"}
+EPILOGUE_BROADCASTS = {"Add", "Mul"}
+
+
+@dataclass
+class EpilogueStep:
+    """
+    Elementwise operation applied to a value right before it is written back
+    to the output tensor of the operation that produced it
+    """
+
+    op: str
+    # per-channel (or scalar) constant operand of Add/Mul
+    tensor: TensorInfo | None = None
+    # min and max of Clip
+    bounds: tuple[float, float] | None = None
+
+    def tag(self) -> str:
+        """
+        Short identifier used in function names
+        """
+        if self.tensor is not None:
+            return self.op + ("S" if self.tensor.size == 1 else "C")
+        if self.bounds is not None:
+            return self.op + re.sub(r"\W", "_", "{:g}_{:g}".format(*self.bounds))
+        return self.op
+
+    def statement(self, name: str, channel: str) -> str:
+        """
+        C statement that updates the value `v`
+
+        :param name: Name of the parameter holding the constant operand
+        :param channel: Variable that holds the channel index of `v`
+        """
+        match self.op:
+            case "Relu":
+                return "v = v > 0 ? v : 0;"
+            case "Tanh":
+                return "v = tanh(v);"
+            case "Sigmoid":
+                return "v = 1.0f / (1.0f + exp(-v));"
+            case "Clip":
+                assert self.bounds is not None
+                lo, hi = self.bounds
+                return f"v = v < {lo} ? {lo} : (v > {hi} ? {hi} : v);"
+            case "Add" | "Mul":
+                assert self.tensor is not None
+                index = "0" if self.tensor.size == 1 else channel
+                symbol = "+" if self.op == "Add" else "*"
+                return f"v = v {symbol} {name}[{index}];"
+            case _:
+                raise NotImplementedError(f"Epilogue: {self.op}")
+
+
+Epilogue = list[EpilogueStep]
+
+
+def epilogue_tags(epilogue: Epilogue) -> list[str]:
+    return [step.tag() for step in epilogue]
+
+
+def epilogue_tensors(epilogue: Epilogue) -> list[TensorInfo]:
+    """
+    Constant tensors the epilogue reads, they must be appended to the call inputs
+    """
+    return [step.tensor for step in epilogue if step.tensor is not None]
+
+
+def epilogue_names(epilogue: Epilogue) -> tuple[str, ...]:
+    return tuple(f"E{i}" for i in range(len(epilogue_tensors(epilogue))))
+
+
+def epilogue_lambda(
+    epilogue: Epilogue,
+    channel: Literal["row", "col"],
+    bias: str | None = None,
+    prologue: tuple[str, ...] = (),
+) -> str:
+    """
+    Generates a C++ lambda `epilogue(row, col, v)` that applies every step to `v`
+
+    The output of the operation is seen as a matrix, `channel` tells which
+    of its indices addresses the per-channel constants
+
+    :param bias: Parameter with a per-channel bias to add before the epilogue
+    :param prologue: Statements of the operation itself, applied before everything else
+    """
+    statements = list(prologue)
+    if bias is not None:
+        statements.append(f"v = v + {bias}[{channel}];")
+    names = iter(epilogue_names(epilogue))
+
+    for step in epilogue:
+        name = next(names) if step.tensor is not None else ""
+        statements.append(step.statement(name, channel))
+
+    body = " ".join(statements + ["return v;"])
+
+    return f"auto epilogue = [&](int row, int col, float v) {{ {body} }};"
+
+
+def is_channel_constant(tensor: TensorInfo, shape: list[int], axis: int) -> bool:
+    """
+    Checks if the tensor is a constant that, broadcasted to `shape`,
+    only varies along `axis` (or is a scalar)
+    """
+    if tensor.tag != "weight" or tensor.data is None:
+        return False
+    if tensor.data.dtype != np.float32:
+        return False
+    if tensor.size == 1:
+        return True
+    if len(tensor.shape) > len(shape):
+        return False
+
+    axis = axis % len(shape)
+    aligned = [1] * (len(shape) - len(tensor.shape)) + tensor.shape
+
+    return all(
+        dim == (shape[axis] if i == axis else 1) for i, dim in enumerate(aligned)
+    )
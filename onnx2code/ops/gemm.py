@@ -1,10 +1,23 @@
+import functools
+import hashlib
+import json
+import os
+import re
+import shutil
 import subprocess
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from textwrap import dedent, indent
 from typing import Iterable
 
+import numpy as np
+
+from onnx2code.targets import dispatch_targets, host_target
 from onnx2code.util import get_attribute
 
-from .gemm_tiling.GEMM import call_GEMM, external_paths_GEMM
-from .operation import OpCall, Operation, OpImpl
+from .epilogue import epilogue_lambda, epilogue_names, epilogue_tags, epilogue_tensors
+from .gemm_tiling.GEMM import call_GEMM, external_paths_GEMM, pack_B
+from .operation import LETTERS, OpCall, Operation, OpImpl
 
 
 class GEMM(Operation):
@@ -32,23 +45,49 @@ class GEMM(Operation):
         self.alpha = None if self.alpha == 1.0 else self.alpha
         self.beta = None if self.beta == 1.0 else self.beta
 
-        if self.transA:
-            raise NotImplementedError("transA not supported")
-        if self.alpha is not None:
-            raise NotImplementedError("alpha not supported")
-        if self.beta is not None:
-            raise NotImplementedError("beta not supported")
-
         A = self.inputs[0]
         B = self.inputs[1]
         Y = self.outputs[0]
 
-        self.N = A.shape[0]
-        self.M = B.shape[1] if self.transB else B.shape[0]
-        self.K = B.shape[0] if self.transB else B.shape[1]
+        # MatMul promotes 1-D operands to matrices (numpy semantics)
+        A_shape = [1] + A.shape if len(A.shape) == 1 else A.shape
+        B_shape = B.shape + [1] if len(B.shape) == 1 else B.shape
+
+        self.N = A_shape[-1] if self.transA else A_shape[-2]
+        self.M = A_shape[-2] if self.transA else A_shape[-1]
+        self.K = B_shape[-2] if self.transB else B_shape[-1]
+
+        assert (B_shape[-1] if self.transB else B_shape[-2]) == self.M
 
-        assert Y.shape[0] == self.N
-        assert Y.shape[1] == self.K
+        # leading dimensions are batch dimensions, broadcasted between A and B
+        A_batch, B_batch = A_shape[:-2], B_shape[:-2]
+        batch_shape = np.broadcast_shapes(tuple(A_batch), tuple(B_batch))
+        batch = int(np.prod(batch_shape))
+
+        # offsets of the matrices of A and B in each batch (empty if not batched)
+        self.batch_offsets: list[tuple[int, int]] = []
+
+        if np.prod(B_batch) == 1:
+            # B is shared: the batches of A are just more rows
+            self.N *= batch
+        else:
+            A_index = np.arange(np.prod(A_batch)).reshape(A_batch)
+            B_index = np.arange(np.prod(B_batch)).reshape(B_batch)
+            self.batch_offsets = [
+                (int(a) * self.N * self.M, int(b) * self.M * self.K)
+                for a, b in zip(
+                    np.broadcast_to(A_index, batch_shape).reshape(-1),
+                    np.broadcast_to(B_index, batch_shape).reshape(-1),
+                )
+            ]
+
+        assert Y.size == max(len(self.batch_offsets), 1) * self.N * self.K
+
+        if self.hasC:
+            C = self.inputs[2]
+            assert len(C.shape) <= 2, "C must be unidirectional broadcastable"
+            rows, cols = ([1, 1] + C.shape)[-2:]
+            assert rows in (1, self.N) and cols in (1, self.K)
 
     def call(self) -> OpCall:
         return OpCall(
@@ -59,9 +98,110 @@ class GEMM(Operation):
                 self.M,
                 self.K,
                 self.transB,
+                *self.attribute_tags(),
+                *epilogue_tags(self.epilogue),
             ],
-            inputs=self.inputs,
+            inputs=self.inputs + epilogue_tensors(self.epilogue),
             outputs=self.outputs,
+            input_names=LETTERS[: len(self.inputs)] + epilogue_names(self.epilogue),
+        )
+
+    def attribute_tags(self) -> list[str]:
+        """
+        Tags of the attributes that change the generated code, besides transB
+        """
+        tags = []
+        if len(self.batch_offsets) > 0:
+            A_batch, B_batch = (t.shape[:-2] for t in self.inputs[:2])
+            tags.append(f"batch{'x'.join(map(str, A_batch or [1]))}")
+            tags.append(f"by{'x'.join(map(str, B_batch or [1]))}")
+        if self.transA:
+            tags.append("transA")
+        if self.alpha is not None:
+            tags.append(re.sub(r"\W", "_", f"alpha{self.alpha!r}"))
+        if self.beta is not None:
+            tags.append(re.sub(r"\W", "_", f"beta{self.beta!r}"))
+        if self.hasC:
+            tags.append("C" + "x".join(map(str, self.inputs[2].shape)))
+        return tags
+
+    def is_constant(self, index: int) -> bool:
+        tensor = self.inputs[index]
+        return (
+            tensor.tag == "weight"
+            and tensor.data is not None
+            and tensor.data.dtype == np.float32
+        )
+
+    def constant_operand(self, index: int) -> np.ndarray:
+        """
+        Data of the constant A (NxM) or B (MxK), already transposed if needed
+        """
+        data = self.inputs[index].data
+        assert data is not None
+        trans = self.transA if index == 0 else self.transB
+        rows, cols = (self.N, self.M) if index == 0 else (self.M, self.K)
+        return data.reshape(cols, rows).T if trans else data.reshape(rows, cols)
+
+    def writeback_lambda(self, scaled: bool = False) -> str:
+        """
+        Epilogue lambda that also computes `alpha * v + beta * C`
+
+        :param scaled: alpha was already applied to an operand
+        """
+        prologue = []
+        if self.alpha is not None and not scaled:
+            prologue.append(f"v = v * {self.alpha!r}f;")
+        if self.hasC and self.beta != 0.0:
+            rows, cols = ([1, 1] + self.inputs[2].shape)[-2:]
+            index = {
+                (False, False): "0",
+                (False, True): "col",
+                (True, False): "row",
+                (True, True): f"row * {self.K} + col",
+            }[(rows > 1, cols > 1)]
+            beta = "" if self.beta is None else f"{self.beta!r}f * "
+            prologue.append(f"v = v + {beta}C[{index}];")
+
+        return epilogue_lambda(self.epilogue, channel="col", prologue=tuple(prologue))
+
+    def batched(self, source: str, prefetch: bool = False) -> str:
+        """
+        Runs the source, that multiplies a single pair of matrices,
+        for every matrix of a batched MatMul
+
+        :param prefetch: The source also reads `A_next`, `B_next` and `OUT_next`,
+                         the matrices of the next batch (the last one repeats itself)
+        """
+        if len(self.batch_offsets) == 0:
+            return source
+
+        batches = len(self.batch_offsets)
+        offsets = list(self.batch_offsets)
+        if prefetch:
+            # one more entry, so the last batch can look at the "next" one
+            offsets.append(offsets[-1])
+        offsets_A = ", ".join(str(a) for a, _ in offsets)
+        offsets_B = ", ".join(str(b) for _, b in offsets)
+        size = self.N * self.K
+
+        body = indent(dedent(source).strip(), " " * 4)
+
+        params = "const float* __restrict__ A, const float* __restrict__ B, float* __restrict__ OUT"  # noqa: E501
+        args = f"A + batch_A[b], B + batch_B[b], OUT + b * {size}"
+        if prefetch:
+            params += ", const float* A_next, const float* B_next, float* OUT_next"
+            args += f", A + batch_A[b + 1], B + batch_B[b + 1], OUT + (b + (b + 1 < {batches})) * {size}"  # noqa: E501
+
+        return (
+            f"static const int batch_A[] = {{{offsets_A}}};\n"
+            f"static const int batch_B[] = {{{offsets_B}}};\n"
+            f"auto matmul = [&]({params}) {{\n"
+            f"{body}\n"
+            "};\n"
+            f"for(int b = 0; b < {batches}; b++) {{\n"
+            f"    matmul({args});\n"
+            "}"
         )
 
 
@@ -70,137 +210,395 @@ class GEMMC(GEMM):
     def impl(self) -> OpImpl:
         N, M, K = self.N, self.M, self.K
 
+        index_A = f"row * {M} + i" if not self.transA else f"i * {N} + row"
         index_B = f"i * {K} + col" if not self.transB else f"col * {M} + i"
 
-        source = f"""
+        source = self.writeback_lambda()
+
+        source += f"""
         for(int row = 0; row < {N}; row++) {{
             for(int col = 0; col < {K}; col++) {{
                 float sum = 0;
                 for(int i = 0; i < {M}; i++) {{
-                    sum += A[row * {M} + i] * B[{index_B}];
+                    sum += A[{index_A}] * B[{index_B}];
                 }}
-                OUT[row * {K} + col] = sum{f' + C[row * {K} + col]' if self.hasC else ''};
+                OUT[row * {K} + col] = epilogue(row, col, sum);
             }}
         }}
         """
 
-        return OpImpl(lang="c", source=source)
+        return OpImpl(lang="c", source=self.batched(source))
 
 
 # Make sure this executable is in your PATH
 LIBXSMM_PATH = "libxsmm_gemm_generator"
 
 
+def libxsmm_cache_dir() -> Path | None:
+    """
+    Folder of the on-disk cache of libxsmm kernels (None if disabled)
+
+    ONNX2CODE_CACHE replaces the default (~/.cache/onnx2code), empty disables it
+    """
+    root = os.getenv("ONNX2CODE_CACHE")
+    if root is None:
+        xdg = os.getenv("XDG_CACHE_HOME", str(Path.home() / ".cache"))
+        root = str(Path(xdg) / "onnx2code")
+    return Path(root) / "libxsmm" if root != "" else None
+
+
+@functools.cache
+def run_libxsmm(args: tuple[str, ...]) -> str:
+    """
+    Runs the libxsmm generator and returns its output
+
+    Outputs are kept in memory and on disk, keyed by the arguments and
+    the generator binary (path, size and modification time)
+    """
+    executable = shutil.which(args[0])
+    if executable is None:
+        raise RuntimeError(f"libxsmm not found at '{args[0]}'")
+
+    stat = os.stat(executable)
+    key = hashlib.sha256(
+        json.dumps([executable, stat.st_size, stat.st_mtime_ns, *args[1:]]).encode()
+    ).hexdigest()
+
+    cache = libxsmm_cache_dir()
+    if cache is not None and (cache / key).is_file():
+        return (cache / key).read_text()
+
+    libxsmm_generator_process = subprocess.run(
+        [executable, *args[1:]],
+        capture_output=True,
+        encoding="utf-8",
+    )
+
+    if (
+        libxsmm_generator_process.returncode != 0
+        or libxsmm_generator_process.stderr != ""
+    ):
+        raise RuntimeError(f"libxsmm: {libxsmm_generator_process.stderr}")
+
+    output = libxsmm_generator_process.stdout
+
+    if cache is not None:
+        # written aside and renamed, concurrent generations never see half a file
+        cache.mkdir(parents=True, exist_ok=True)
+        partial = cache / f"{key}.{os.getpid()}.tmp"
+        partial.write_text(output)
+        os.replace(partial, cache / key)
+
+    return output
+
+
+@dataclass(frozen=True)
+class LibxsmmParams:
+    """
+    Code generation options of a libxsmm kernel
+    """
+
+    # prefetch strategy, one of LIBXSMM_PREFETCHES
+    prefetch: str = "nopf"
+    # also generate a kernel with aligned loads and stores, used when
+    # B and OUT are aligned to a vector at runtime
+    aligned: bool = False
+
+
+# "nopf": none, "BL2viaC": next B into L2 (B of libxsmm, A for us)
+# "curAL2": current A into L2 ahead, "AL2": next A into L2
+LIBXSMM_PREFETCHES = [
+    "nopf",
+    "BL2viaC",
+    "curAL2",
+    "curAL2_BL2viaC",
+    "AL2",
+    "AL2_BL2viaC",
+]
+
+# bytes of a vector register of each libxsmm arch
+LIBXSMM_VECTOR_BYTES = {"wsm": 16, "snb": 32, "hsw": 32, "skx": 64}
+
+# best params measured by evaluation/find_best_libxsmm_params.py
+LIBXSMM_PARAMS_PATH = Path(__file__).parent / "libxsmm_params.json"
+
+LibxsmmShape = tuple[str, int, int, int]
+
+
+def load_libxsmm_params(path: Path) -> dict[LibxsmmShape, LibxsmmParams]:
+    """
+    Reads a table of params by (arch, N, M, K), empty if the file does not exist
+    """
+    if not path.is_file():
+        return {}
+    with open(path, "r") as f:
+        entries = json.load(f)
+    return {
+        (entry["arch"], entry["N"], entry["M"], entry["K"]): LibxsmmParams(
+            prefetch=entry["prefetch"], aligned=entry["aligned"]
+        )
+        for entry in entries
+    }
+
+
+def save_libxsmm_params(path: Path, params: dict[LibxsmmShape, LibxsmmParams]) -> None:
+    entries = [
+        {"arch": arch, "N": N, "M": M, "K": K, **asdict(p)}
+        for (arch, N, M, K), p in sorted(params.items())
+    ]
+    with open(path, "w") as f:
+        json.dump(entries, f, indent=2)
+        f.write("\n")
+
+
+libxsmm_params = load_libxsmm_params(LIBXSMM_PARAMS_PATH)
+
+
+def set_libxsmm_params(params: dict[LibxsmmShape, LibxsmmParams]) -> None:
+    global libxsmm_params
+    libxsmm_params = params
+
+
+def get_libxsmm_params(arch: str, N: int, M: int, K: int) -> LibxsmmParams:
+    """
+    Measured params of the shape, the baseline (no prefetch, unaligned) if it
+    was not measured: a guess could be slower than the baseline
+    """
+    return libxsmm_params.get((arch, N, M, K), LibxsmmParams())
+
+
+def libxsmm_gemm(
+    name: str,
+    N: int,
+    M: int,
+    K: int,
+    arch: str,
+    prefetch: str = "nopf",
+    aligned: bool = False,
+) -> str:
+    """
+    Generates the C function `name(B, A, OUT)` with libxsmm
+    (NxM times MxK, in libxsmm's column-major terms)
+
+    With a prefetch strategy the function also takes the B, A and OUT
+    of the next call: `name(B, A, OUT, B_next, A_next, OUT_next)`
+
+    :param arch: libxsmm arch, for instance "hsw" (AVX2) or "skx" (AVX-512)
+    :param aligned: B and OUT are aligned to a vector (and so are their rows)
+    """
+    # Reference: https://scalable.uni-jena.de/opt/hpc/chapters/assignment_small_gemms.html
+    generator_args = [
+        LIBXSMM_PATH,
+        # matrix type
+        "dense",
+        # output file name
+        "/dev/stdout",
+        # function name
+        name,
+        # matrix size
+        str(K),
+        str(N),
+        str(M),
+        # lda, ldb, ldc
+        str(K),
+        str(M),
+        str(K),
+        # alpha beta
+        # C := alpha*A*B + beta*C
+        "1",
+        "0",
+        # aligned A, C (1) or not (0)
+        str(int(aligned)),
+        str(int(aligned)),
+        # arch
+        arch,
+        # prefetch
+        prefetch,
+        # precision
+        "SP",  # single precision (f32)
+    ]
+
+    output = run_libxsmm(tuple(generator_args))
+
+    lines: Iterable[str] = output.splitlines()
+
+    aux_fn = "\n".join(
+        filter(
+            # Filter out the flops line
+            lambda line: not (line.startswith("libxsmm_num_total_flops") or line == ""),
+            lines,
+        )
+    )
+
+    if aux_fn == "":
+        raise RuntimeError("libxsmm: no output")
+
+    return aux_fn
+
+
 @GEMM.variant(["asm", "libxsmm"], priority=0)
 class GEMMAsm(GEMM):
+    def relayout(self, index: int) -> bool:
+        """
+        Constant operand stored again ahead of time, transposed and/or scaled by alpha
+        """
+        trans = self.transA if index == 0 else self.transB
+        scale = index == 1 and self.alpha is not None
+        return self.is_constant(index) and (trans or scale)
+
+    def call(self) -> OpCall:
+        call = super().call()
+
+        for index in (0, 1):
+            if self.relayout(index):
+                data = self.constant_operand(index)
+                if index == 1 and self.alpha is not None:
+                    data = data * np.float32(self.alpha)
+
+                call.sig_params.append(f"packed{LETTERS[index]}")
+                call.packed_inputs[index] = data.astype(np.float32).reshape(-1)
+
+        return call
+
     def impl(self) -> OpImpl:
         N, M, K = self.N, self.M, self.K
 
-        aux_fn_name = f"libxsmm_GEMM_{N}_{M}_{K}"
-
-        # Reference: https://scalable.uni-jena.de/opt/hpc/chapters/assignment_small_gemms.html
-        generator_args = [
-            LIBXSMM_PATH,
-            # matrix type
-            "dense",
-            # output file name
-            "/dev/stdout",
-            # function name
-            aux_fn_name,
-            # matrix size
-            str(K),
-            str(N),
-            str(M),
-            # lda, ldb, ldc
-            str(K),
-            str(M),
-            str(K),
-            # alpha beta
-            # C := alpha*A*B + beta*C
-            "1",
-            "0",
-            # 0: unaligned A, C
-            "0",
-            "0",
-            # arch
-            "hsw",  # haswell, targets AVX2
-            # prefetch
-            "nopf",  # no prefetch
-            # precision
-            "SP",  # single precision (f32)
-        ]
-
-        try:
-            libxsmm_generator_process = subprocess.run(
-                " ".join(generator_args),
-                capture_output=True,
-                encoding="utf-8",
-                shell=True,
-            )
-        except PermissionError:
-            raise RuntimeError(f"libxsmm not found at '{LIBXSMM_PATH}'")
+        # the generated kernel only reads row-major operands
+        if self.transA and not self.relayout(0):
+            raise NotImplementedError("transA not supported")
+        if self.transB and not self.relayout(1):
+            raise NotImplementedError("transB not supported")
+
+        scaled = self.relayout(1)
+
+        # one kernel for each instruction set the code is compiled for
+        if len(dispatch_targets) > 0:
+            targets = dispatch_targets
+        else:
+            host = host_target()
+            targets = [host] if host is not None else []
+        archs = [target.libxsmm for target in targets] or ["hsw"]
+
+        aux_fns: list[str] = []
+        calls: list[str] = []
+        prefetch = False
+
+        for arch in archs:
+            params = get_libxsmm_params(arch, N, M, K)
+            name = f"libxsmm_GEMM_{arch}_{N}_{M}_{K}"
+
+            # tensors MUST be reversed since libxsmm uses BLAS' column-major order
+            # and we use onnx's row-major order
+            args = "B, A, OUT"
+            if params.prefetch != "nopf":
+                args += ", B_next, A_next, OUT_next"
+                prefetch = True
+
+            aux_fns.append(libxsmm_gemm(name, N, M, K, arch, params.prefetch))
+            call = f"{name}({args});"
+
+            if params.aligned:
+                aux_fns.append(
+                    libxsmm_gemm(
+                        f"{name}_aligned", N, M, K, arch, params.prefetch, True
+                    )
+                )
+                vector = LIBXSMM_VECTOR_BYTES.get(arch, 64)
+                call = (
+                    f"if ((((size_t)B) | ((size_t)OUT)) % {vector} == 0) {{\n"
+                    f"    {name}_aligned({args});\n"
+                    "} else {\n"
+                    f"    {call}\n"
+                    "}"
+                )
+
+            calls.append(call)
+
+        if len(calls) == 1:
+            source = calls[0] + "\n"
+        else:
+            # pick the one of the copy of the code being compiled (see targets.cpp)
+            source = ""
+            for i, (target, call) in enumerate(zip(targets, calls)):
+                if i == 0:
+                    source += f"#if {target.macros[0]}\n"
+                elif i == len(calls) - 1:
+                    source += "#else\n"
+                else:
+                    source += f"#elif {target.macros[0]}\n"
+                source += call + "\n"
+            source += "#endif\n"
 
         if (
-            libxsmm_generator_process.returncode != 0
-            or libxsmm_generator_process.stderr != ""
+            self.hasC
+            or len(self.epilogue) > 0
+            or (self.alpha is not None and not scaled)
         ):
-            raise RuntimeError(f"libxsmm: {libxsmm_generator_process.stderr}")
-
-        lines: Iterable[str] = libxsmm_generator_process.stdout.splitlines()
+            # libxsmm owns the writeback, so we apply alpha, C and the epilogue
+            # right after while the output is still hot in cache
+            source += f"""
+            {self.writeback_lambda(scaled)}
+            for(int row = 0; row < {N}; row++) {{
+                for(int col = 0; col < {K}; col++) {{
+                    const int i = row * {K} + col;
+                    OUT[i] = epilogue(row, col, OUT[i]);
+                }}
+            }}
+            """
 
-        aux_fn = "\n".join(
-            filter(
-                # Filter out the flops line
-                lambda line: not (
-                    line.startswith("libxsmm_num_total_flops") or line == ""
-                ),
-                lines,
+        if prefetch and len(self.batch_offsets) == 0:
+            # a single call, it prefetches its own operands
+            source = (
+                "const float* A_next = A;\n"
+                "const float* B_next = B;\n"
+                "float* OUT_next = OUT;\n" + source
             )
-        )
 
-        if aux_fn == "":
-            raise RuntimeError("libxsmm: no output")
-
-        # tensors MUST be reversed since libxsmm uses BLAS' column-major order
-        # and we use onnx's row-major order
-        source = f"""
-        {aux_fn_name}(B, A, OUT);
-        """ + (
-            f"""
-            for(int i = 0; i < {N * K}; i++) {{
-                OUT[i] += C[i];
-            }}
-            """
-            if self.hasC
-            else ""
+        return OpImpl(
+            lang="c",
+            source=self.batched(source, prefetch),
+            cpp_aux_functions=tuple(aux_fns),
         )
 
-        return OpImpl(lang="c", source=source, cpp_aux_functions=(aux_fn,))
-
 
 @GEMM.variant(["c", "loop-tiling"], priority=1)
 class GEMMLoopTiling(GEMM):
+    def packed_B(self) -> bool:
+        """
+        Constant B (weights) is packed ahead of time, with alpha folded in
+        """
+        return self.is_constant(1) and len(self.batch_offsets) == 0
+
+    def call(self) -> OpCall:
+        call = super().call()
+
+        if self.packed_B():
+            B = self.constant_operand(1)
+            if self.alpha is not None:
+                B = B * np.float32(self.alpha)
+
+            call.sig_params.append("packedB")
+            call.packed_inputs[1] = pack_B(B)
+
+        return call
+
     def impl(self) -> OpImpl:
         M, K, N = self.N, self.M, self.K
 
-        if self.hasC:
-            raise NotImplementedError("hasC not supported")
-
-        # unit_update_asm = ASMAuxFunction(
-        #     signature="void unit_update(const float*, const float*, float*)",
-        #     source="""
-        #         vbroadcastss ymm0, [rsi]
-        #         vmovups ymm1, [rdi]
-        #         vfmadd213ps ymm0, ymm1, [rdx]
-        #         vmovups [rdx], ymm0
-        #         vzeroupper
-        #         ret
-        #     """,
-        # )
-
         return OpImpl(
             lang="c",
-            source=call_GEMM(M, K, N, "A, B, OUT"),
+            source=self.batched(
+                self.writeback_lambda(scaled=self.packed_B())
+                + "\n"
+                + call_GEMM(
+                    M,
+                    K,
+                    N,
+                    "A, B, OUT, epilogue",
+                    packed_B=self.packed_B(),
+                    trans_A=self.transA,
+                    trans_B=self.transB and not self.packed_B(),
+                ),
+            ),
             external_paths=external_paths_GEMM,
-            # asm_aux_functions=(unit_update_asm,),
         )
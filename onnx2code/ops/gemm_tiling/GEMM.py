@@ -2,6 +2,10 @@ from dataclasses import dataclass
 import math
 from pathlib import Path
 
+import numpy as np
+
+from onnx2code.targets import Target, dispatch_targets, host_target
+
 
 @dataclass
 class LoopTilingParams:
@@ -14,15 +18,42 @@ class LoopTilingParams:
     nu: int  # Columnas de unit-update
 
 
-tiling_params = LoopTilingParams(
-    nc=4096,
-    kc=256,
-    mc=256,
-    mr=4,
-    nr=8,
-    mv=4,
-    nu=4,
-)
+# microkernel shapes for each instruction set (see microkernel_simd.cpp),
+# mc is a multiple of mr so every block of A starts at a sliver
+MICROKERNEL_PARAMS = {
+    "avx512": LoopTilingParams(nc=4096, kc=256, mc=252, mr=14, nr=32, mv=2, nu=8),
+    "avx2": LoopTilingParams(nc=4096, kc=256, mc=252, mr=6, nr=16, mv=2, nu=8),
+    "generic": LoopTilingParams(nc=4096, kc=256, mc=256, mr=4, nr=8, mv=4, nu=4),
+}
+
+
+def default_tiling_params() -> LoopTilingParams:
+    """
+    Parameters of the widest microkernel the CPU supports
+    """
+    target = host_target()
+    return MICROKERNEL_PARAMS.get(
+        target.name if target else "", MICROKERNEL_PARAMS["generic"]
+    )
+
+
+def portable_tiling_params(targets: list[Target]) -> LoopTilingParams:
+    """
+    Parameters shared by the code of every dispatch target (the packed weights are
+    the same for all), the narrowest microkernel so no target runs out of registers
+
+    Trade-off: the wider targets run the tile of a narrower one (with avx512,avx2
+    the AVX-512 copy runs 6x16 instead of 14x32, using 12 of its 32 registers as
+    accumulators), in exchange for a single copy of the packed weights. Targets
+    without a microkernel of their own (sse4.2) run the generic one
+    """
+    if len(targets) == 0:
+        return MICROKERNEL_PARAMS["generic"]
+    # targets are sorted from the widest
+    return MICROKERNEL_PARAMS.get(targets[-1].name, MICROKERNEL_PARAMS["generic"])
+
+
+tiling_params = default_tiling_params()
 
 
 def set_tiling_params(params: LoopTilingParams) -> None:
@@ -30,23 +61,98 @@ def set_tiling_params(params: LoopTilingParams) -> None:
     tiling_params = params
 
 
+def current_tiling_params() -> LoopTilingParams:
+    """
+    The parameters set, unless the code is compiled for explicit instruction sets
+    """
+    if len(dispatch_targets) > 0:
+        return portable_tiling_params(dispatch_targets)
+    return tiling_params
+
+
 external_paths_GEMM = (
     Path(__file__).parent / "gpackA.cpp",
     Path(__file__).parent / "gpackB.cpp",
     Path(__file__).parent / "microkernel_ref.cpp",
     Path(__file__).parent / "microkernel_test.cpp",
+    Path(__file__).parent / "microkernel_simd.cpp",
     Path(__file__).parent / "gemm.cpp",
 )
 
 
-def call_GEMM(M: int, K: int, N: int, params: str) -> str:
-    nc = min(2 ** math.ceil(math.log2(N)), tiling_params.nc)
-    kc = tiling_params.kc
-    mc = tiling_params.mc
-    mr = tiling_params.mr
-    nr = tiling_params.nr
+def call_GEMM(
+    M: int,
+    K: int,
+    N: int,
+    params: str,
+    packed_A: bool = False,
+    packed_B: bool = False,
+    trans_A: bool = False,
+    trans_B: bool = False,
+) -> str:
+    tiling = current_tiling_params()
+    kc = tiling.kc
+    mc = tiling.mc
+    mr = tiling.mr
+    nr = tiling.nr
+    # the panels of B are whole slivers (the packed layout relies on it)
+    nc = min(2 ** math.ceil(math.log2(N)), tiling.nc)
+    nc = -(-nc // nr) * nr
+
+    mv = tiling.mv
+    nu = tiling.nu
+
+    flags = [packed_A, packed_B, trans_A, trans_B]
+    layout = ""
+    if any(flags):
+        layout = "," + ",".join(str(flag).lower() for flag in flags)
+
+    return f"gemm<{M},{K},{N},{nc},{kc},{mc},{mr},{nr},{mv},{nu}{layout}>({params});"
+
+
+def pack_A(A: np.ndarray) -> np.ndarray:
+    """
+    Packs A (MxK) ahead of time, as gpackA does for every panel
+
+    Panels of kc columns (the last one may be narrower), each one split in
+    slivers of mr rows stored column major, the last sliver is padded with zeros
+    """
+    params = current_tiling_params()
+    kc, mr = params.kc, params.mr
+    M, K = A.shape
+    slivers = -(-M // mr)
+
+    padded = np.zeros((slivers * mr, K), dtype=np.float32)
+    padded[:M] = A
+
+    panels = []
+    for pc in range(0, K, kc):
+        panel = padded[:, pc : pc + kc]
+        # (slivers, mr, _kc) -> (slivers, _kc, mr)
+        panels.append(panel.reshape(slivers, mr, -1).transpose(0, 2, 1).reshape(-1))
+
+    return np.concatenate(panels)
+
+
+def pack_B(B: np.ndarray) -> np.ndarray:
+    """
+    Packs B (KxN) ahead of time, as gpackB does for every panel
+
+    Panels of kc rows (the last one may be shorter), each one split in
+    slivers of nr columns stored row major, the last sliver is padded with zeros
+    """
+    params = current_tiling_params()
+    kc, nr = params.kc, params.nr
+    K, N = B.shape
+    slivers = -(-N // nr)
+
+    padded = np.zeros((K, slivers * nr), dtype=np.float32)
+    padded[:, :N] = B
 
-    mv = tiling_params.mv
-    nu = tiling_params.nu
+    panels = []
+    for pc in range(0, K, kc):
+        panel = padded[pc : pc + kc]
+        # (_kc, slivers, nr) -> (slivers, _kc, nr)
+        panels.append(panel.reshape(-1, slivers, nr).transpose(1, 0, 2).reshape(-1))
 
-    return f"gemm<{M},{K},{N},{nc},{kc},{mc},{mr},{nr},{mv},{nu}>({params});"
+    return np.concatenate(panels)
@@ -1,3 +1,33 @@
+// Buffers de cada thread para empaquetar A y B: son demasiado grandes para el stack
+// de los workers (el panel de B es de (nc + nr) x kc floats). Crecen segun haga falta
+// y los comparten todas las llamadas a gemm del thread
+struct gemm_buffers {
+    float* data[2] = {nullptr, nullptr};
+    size_t size[2] = {0, 0};
+
+    float* get(int index, size_t floats) {
+        if (size[index] < floats) {
+            free(data[index]);
+            // aligned_alloc pide un tamaño multiplo de la alineacion
+            data[index] = (float*)aligned_alloc(64, (floats * sizeof(float) + 63) / 64 * 64);
+            size[index] = floats;
+        }
+        return data[index];
+    }
+
+    ~gemm_buffers() {
+        free(data[0]);
+        free(data[1]);
+    }
+};
+
+static thread_local gemm_buffers o2c_gemm_buffers;
+
+// Epilogue por defecto: deja el valor como esta
+struct gemm_no_epilogue {
+    inline float operator()(int row, int col, float v) const { return v; }
+};
+
 template <
     // matrix sizes
     int M,
@@ -12,77 +42,126 @@ template <
     int nr,  // Columnas de microkernel
 
     int mv,  // Filas de unit update
-    int nu   // Columnas de unit update
-    >
-void gemm(
-    const float* __restrict__ A,  // MxK
-    const float* __restrict__ B,  // KxN
-    float* __restrict__ OUT       // MxN
-) {
-    memset(OUT, 0, M * N * sizeof(float));
-
-    float A_block[(mc + mr) * kc];
-    float B_panel[(nc + nr) * kc];
+    int nu,  // Columnas de unit update
 
-    float AB_microkernel[mr * nr];
+    // A y/o B ya vienen empaquetados (pesos constantes, ver GEMM.py: pack_A, pack_B)
+    bool packedA = false,
+    bool packedB = false,
 
-    for (int jc = 0; jc < N; jc += nc) {
-        int _nc = min(N - jc, nc);  // evitar que se pase "matrices grandes?"
+    // A y/o B vienen traspuestos en memoria (KxM y NxK)
+    bool transA = false,
+    bool transB = false,
 
-        for (int pc = 0; pc < K; pc += kc) {
-            int _kc = min(K - pc, kc);  // evitar que se pase el panel
-
-            if (_kc < kc || _nc < nc || true) {
-                gpackB_edge<kc, nc, nr, 1, N>(_kc, _nc, (float*)B + pc * N + jc, B_panel);
-            } else {
-                gpackB<kc, nc, nr, 1, N>((float*)B + pc * N + jc, B_panel);
-            }
-
-            for (int ic = 0; ic < M; ic += mc) {
-                int _mc = min(M - ic, mc);  // evitar que se pase el panel
-
-                if (_kc < kc || _mc < mc) {
-                    gpackA_edge<kc, mc, mr, 1, K>(_kc, _mc, (float*)A + ic * K + pc, A_block);
-                } else {
-                    gpackA<kc, mc, mr, 1, K>((float*)A + ic * K + pc, A_block);
+    // operaciones elementwise fusionadas (bias, activaciones)
+    typename Epilogue = gemm_no_epilogue>
+void gemm(
+    const float* __restrict__ A,  // MxK (o KxM, o empaquetado)
+    const float* __restrict__ B,  // KxN (o NxK, o empaquetado)
+    float* __restrict__ OUT,      // MxN
+    Epilogue epilogue = Epilogue()
+) {
+    // en modo multi-thread se achican los paneles de B para que haya
+    // al menos un bloque (ic, jc) de OUT por thread
+    constexpr int ic_blocks = (M + mc - 1) / mc;
+    constexpr int jc_min_blocks = (O2C_THREADS + ic_blocks - 1) / ic_blocks;
+    constexpr int nc_split = ((N + jc_min_blocks - 1) / jc_min_blocks + nr - 1) / nr * nr;
+    constexpr int _ncp = nc_split < nc ? nc_split : nc;
+    constexpr int jc_blocks = (N + _ncp - 1) / _ncp;
+
+    // los operandos empaquetados tienen todos los slivers de cada panel de kc filas
+    // uno detras de otro, asi cualquier bloque (ic, pc) o (pc, jc) es contiguo
+    // (el ultimo panel tiene _kc filas, no se rellena hasta kc)
+    constexpr int M_padded = (M + mr - 1) / mr * mr;
+    constexpr int N_padded = (N + nr - 1) / nr * nr;
+    static_assert(!packedA || mc % mr == 0, "los bloques de A deben empezar en un sliver");
+
+    // strides de A y B sin empaquetar (los traspuestos se empaquetan igual, solo cambia el recorrido)
+    constexpr int A_col = transA ? M : 1;
+    constexpr int A_row = transA ? 1 : K;
+    constexpr int B_col = transB ? K : 1;
+    constexpr int B_row = transB ? 1 : N;
+
+    // los bloques (ic, jc) de OUT son independientes: se reparten entre los threads
+    // (cada uno empaqueta sus propios paneles de A y B)
+    parallel_for(jc_blocks * ic_blocks, [&](int start, int end) {
+        float* A_block = packedA ? nullptr : o2c_gemm_buffers.get(0, (mc + mr) * kc);
+        float* B_panel = packedB ? nullptr : o2c_gemm_buffers.get(1, (_ncp + nr) * kc);
+
+        float AB_microkernel[mr * nr];
+
+        // los bloques de un mismo jc son consecutivos: se recorren en orden jc -> pc -> ic
+        // para empaquetar cada panel de B una sola vez (con un thread es el orden de siempre)
+        for (int block = start; block < end;) {
+            const int jb = block / ic_blocks;
+            const int ib_start = block % ic_blocks;
+            const int ib_end = min(end - jb * ic_blocks, ic_blocks);
+            block = jb * ic_blocks + ib_end;
+
+            int jc = jb * _ncp;
+            int _nc = min(N - jc, _ncp);  // evitar que se pase "matrices grandes?"
+
+            for (int pc = 0; pc < K; pc += kc) {
+                int _kc = min(K - pc, kc);  // evitar que se pase el panel
+                bool first = pc == 0;       // primer panel: pisar OUT en el writeback
+                bool last = pc + _kc >= K;  // ultimo panel: aplicar epilogue en el writeback
+
+                const float* B_packed = B + pc * N_padded + jc * _kc;
+                // distancia entre slivers
+                int A_stride = packedA ? _kc : kc;
+                int B_stride = packedB ? _kc : kc;
+
+                if (!packedB) {
+                    gpackB_edge<kc, _ncp, nr, B_col, B_row>(_kc, _nc, (float*)B + pc * B_row + jc * B_col, B_panel);
+                    B_packed = B_panel;
                 }
 
-                // fprintf(stderr, "jc=%d pc=%d ic=%d _kc=%d _nc=%d, _mc=%d\n", jc, pc, ic, _kc, _nc, _mc);
+                for (int ib = ib_start; ib < ib_end; ib++) {
+                    int ic = ib * mc;
+                    int _mc = min(M - ic, mc);  // evitar que se pase el panel
+
+                    const float* A_packed = A + pc * M_padded + ic * _kc;
 
-                for (int jr = 0; jr < _nc; jr += nr) {      // jr es el offset del sliver de ancho nr (violeta)
-                    for (int ir = 0; ir < _mc; ir += mr) {  // ir es el offset del sliver de ancho mr (verde)
-                        // (_mr x kc) * (kc x _nr)
+                    if (packedA) {
+                        // ya empaquetado
+                    } else if (_kc < kc || _mc < mc) {
+                        gpackA_edge<kc, mc, mr, A_col, A_row>(_kc, _mc, (float*)A + ic * A_row + pc * A_col, A_block);
+                        A_packed = A_block;
+                    } else {
+                        gpackA<kc, mc, mr, A_col, A_row>((float*)A + ic * A_row + pc * A_col, A_block);
+                        A_packed = A_block;
+                    }
 
-                        const float* A_kernel = A_block + ir * kc;  // (mr x kc) column major
-                        const float* B_kernel = B_panel + jr * kc;  // (kc x nr) row major
+                    for (int jr = 0; jr < _nc; jr += nr) {      // jr es el offset del sliver de ancho nr (violeta)
+                        for (int ir = 0; ir < _mc; ir += mr) {  // ir es el offset del sliver de ancho mr (verde)
+                            // (_mr x kc) * (kc x _nr)
 
-                        // ref_microkernel<mr, nr, kc, N>(A_kernel, B_kernel, AB_microkernel);
+                            const float* A_kernel = A_packed + ir * A_stride;  // (mr x kc) column major
+                            const float* B_kernel = B_packed + jr * B_stride;  // (kc x nr) row major
 
-                        memset(AB_microkernel, 0, mr * nr * sizeof(float));
-                        test_microkernel<mr, nr, mv, nu>(_kc, A_kernel, B_kernel, AB_microkernel);
+                            // ref_microkernel<mr, nr, kc, N>(A_kernel, B_kernel, AB_microkernel);
 
-                        // TODO: pasar _mr y _nr para evitar escribir fuera en C
-                        //       quizas un branch entre optimized y ref?
-                        int _nr = min(_nc - jr, nr);  // evitar que se pase el bloque
-                        int _mr = min(_mc - ir, mr);  // evitar que se pase el bloque
+                            microkernel<mr, nr, mv, nu>(_kc, A_kernel, B_kernel, AB_microkernel);
 
-                        // assert(_mr == mr);
-                        // assert(_nr == nr);
+                            int _nr = min(_nc - jr, nr);  // evitar que se pase el bloque
+                            int _mr = min(_mc - ir, mr);  // evitar que se pase el bloque
 
-                        float* C_writeback = (float*)OUT + (ic + ir) * N + (jc + jr);
+                            float* C_writeback = (float*)OUT + (ic + ir) * N + (jc + jr);
 
-                        if (_mr == mr && _nr == nr) {
-                            // Versión optimizada
-                            for (int i = 0; i < mr; i++) {
-                                for (int j = 0; j < nr; j++) {
-                                    C_writeback[i * N + j] += AB_microkernel[i * nr + j];
+                            if (_mr == mr && _nr == nr) {
+                                // Versión optimizada
+                                for (int i = 0; i < mr; i++) {
+                                    for (int j = 0; j < nr; j++) {
+                                        float v = (first ? 0 : C_writeback[i * N + j]) + AB_microkernel[i * nr + j];
+                                        C_writeback[i * N + j] = last ? epilogue(ic + ir + i, jc + jr + j, v) : v;
+                                    }
                                 }
-                            }
-                        } else {
-                            // Edge case
-                            for (int i = 0; i < _mr; i++) {
-                                for (int j = 0; j < _nr; j++) {
-                                    C_writeback[i * N + j] += AB_microkernel[i * nr + j];
+                            } else {
+                                // Edge case
+                                for (int i = 0; i < _mr; i++) {
+                                    for (int j = 0; j < _nr; j++) {
+                                        float v = (first ? 0 : C_writeback[i * N + j]) + AB_microkernel[i * nr + j];
+                                        C_writeback[i * N + j] = last ? epilogue(ic + ir + i, jc + jr + j, v) : v;
+                                    }
                                 }
                             }
                         }
@@ -90,5 +169,5 @@ void gemm(
                 }
             }
         }
-    }
+    });
 }
@@ -0,0 +1,148 @@
+// Microkernels con intrinsics (AVX2 + FMA y AVX-512)
+//
+// Calculan AB = A_kernel * B_kernel (mr x nr) con todo el bloque en registros:
+// mr * (nr / W) acumuladores, donde W es la cantidad de floats por registro.
+// Por cada k se cargan los nr / W registros de la fila de B y se hace broadcast
+// de cada elemento de la columna de A (un FMA por acumulador).
+//
+// Formas pensadas (acumuladores + fila de B + broadcast <= registros):
+//  - AVX2 (16 ymm):    6x16 (12 + 2 + 1), 8x8 (8 + 1 + 1)
+//  - AVX-512 (32 zmm): 14x32 (28 + 2 + 1)
+// Ver GEMM.py: MICROKERNEL_PARAMS
+//
+// O2C_AVX512 y O2C_AVX2 indican si se pueden usar (ver targets.cpp)
+
+#if O2C_AVX512
+template <int mr, int nr>
+inline void avx512_microkernel(
+    int kc,
+    const float* __restrict__ A_kernel,  // (mr x kc) column major
+    const float* __restrict__ B_kernel,  // (kc x nr) row major
+    float* __restrict__ AB               // (mr x nr)
+) {
+    static_assert(nr % 16 == 0, "nr debe ser multiplo de 16");
+    constexpr int nv = nr / 16;
+
+    __m512 acc[mr][nv];
+
+#pragma GCC unroll 32
+    for (int i = 0; i < mr; i++) {
+#pragma GCC unroll 8
+        for (int j = 0; j < nv; j++) {
+            acc[i][j] = _mm512_setzero_ps();
+        }
+    }
+
+    for (int k = 0; k < kc; k++) {
+        __m512 b[nv];
+
+#pragma GCC unroll 8
+        for (int j = 0; j < nv; j++) {
+            b[j] = _mm512_loadu_ps(B_kernel + j * 16);
+        }
+
+#pragma GCC unroll 32
+        for (int i = 0; i < mr; i++) {
+            __m512 a = _mm512_set1_ps(A_kernel[i]);
+#pragma GCC unroll 8
+            for (int j = 0; j < nv; j++) {
+                acc[i][j] = _mm512_fmadd_ps(a, b[j], acc[i][j]);
+            }
+        }
+
+        // avanzar una columna de A y una fila de B
+        A_kernel += mr;
+        B_kernel += nr;
+    }
+
+#pragma GCC unroll 32
+    for (int i = 0; i < mr; i++) {
+#pragma GCC unroll 8
+        for (int j = 0; j < nv; j++) {
+            _mm512_storeu_ps(AB + i * nr + j * 16, acc[i][j]);
+        }
+    }
+}
+#endif
+
+#if O2C_AVX2
+template <int mr, int nr>
+inline void avx2_microkernel(
+    int kc,
+    const float* __restrict__ A_kernel,  // (mr x kc) column major
+    const float* __restrict__ B_kernel,  // (kc x nr) row major
+    float* __restrict__ AB               // (mr x nr)
+) {
+    static_assert(nr % 8 == 0, "nr debe ser multiplo de 8");
+    constexpr int nv = nr / 8;
+
+    __m256 acc[mr][nv];
+
+#pragma GCC unroll 32
+    for (int i = 0; i < mr; i++) {
+#pragma GCC unroll 8
+        for (int j = 0; j < nv; j++) {
+            acc[i][j] = _mm256_setzero_ps();
+        }
+    }
+
+    for (int k = 0; k < kc; k++) {
+        __m256 b[nv];
+
+#pragma GCC unroll 8
+        for (int j = 0; j < nv; j++) {
+            b[j] = _mm256_loadu_ps(B_kernel + j * 8);
+        }
+
+#pragma GCC unroll 32
+        for (int i = 0; i < mr; i++) {
+            __m256 a = _mm256_broadcast_ss(A_kernel + i);
+#pragma GCC unroll 8
+            for (int j = 0; j < nv; j++) {
+                acc[i][j] = _mm256_fmadd_ps(a, b[j], acc[i][j]);
+            }
+        }
+
+        // avanzar una columna de A y una fila de B
+        A_kernel += mr;
+        B_kernel += nr;
+    }
+
+#pragma GCC unroll 32
+    for (int i = 0; i < mr; i++) {
+#pragma GCC unroll 8
+        for (int j = 0; j < nv; j++) {
+            _mm256_storeu_ps(AB + i * nr + j * 8, acc[i][j]);
+        }
+    }
+}
+#endif
+
+// Elige el microkernel segun las extensiones disponibles
+// (si no hay ninguna que sirva para nr, el escalar de microkernel_test.cpp)
+template <
+    int mr,
+    int nr,
+    int mv,
+    int nu>
+inline void microkernel(
+    int kc,
+    const float* __restrict__ A_kernel,  // (mr x kc) column major
+    const float* __restrict__ B_kernel,  // (kc x nr) row major
+    float* __restrict__ AB               // (mr x nr), se pisa
+) {
+#if O2C_AVX512
+    if constexpr (nr % 16 == 0) {
+        avx512_microkernel<mr, nr>(kc, A_kernel, B_kernel, AB);
+        return;
+    }
+#endif
+#if O2C_AVX2
+    if constexpr (nr % 8 == 0) {
+        avx2_microkernel<mr, nr>(kc, A_kernel, B_kernel, AB);
+        return;
+    }
+#endif
+    memset(AB, 0, mr * nr * sizeof(float));
+    test_microkernel<mr, nr, mv, nu>(kc, A_kernel, B_kernel, AB);
+}
@@ -25,6 +25,7 @@ class Identity(Operation):
             sig_params=[self.size],
             inputs=self.inputs,
             outputs=self.outputs,
+            inplace_input=0,
         )
 
 
@@ -0,0 +1,57 @@
+import re
+from math import ceil
+
+from ..targets import dispatch_targets, host_target
+from ..tensor import TensorInfo
+
+# layouts an NCHW tensor can have in memory, other than row-major
+BLOCKED_LAYOUTS = {"NCHW8c", "NCHW16c"}
+NHWC = "NHWC"
+
+
+def channel_block() -> int:
+    """
+    Channels in each block of the NCHWc layout, the floats of a vector register
+    """
+    if len(dispatch_targets) > 0:
+        # the same layout for every target, the narrowest vectors
+        avx512 = all(target.name == "avx512" for target in dispatch_targets)
+    else:
+        target = host_target()
+        avx512 = target is not None and target.name == "avx512"
+    return 16 if avx512 else 8
+
+
+def blocked_layout() -> str:
+    return f"NCHW{channel_block()}c"
+
+
+def blocked_size(shape: list[int]) -> int:
+    """
+    Floats of an NCHW tensor in the NCHWc layout (the last block is padded)
+    """
+    N, C, H, W = shape
+    CB = channel_block()
+    return N * ceil(C / CB) * CB * H * W
+
+
+def layout_index(tensor: TensorInfo, c: str, h: str, w: str) -> str:
+    """
+    C expression with the position of an element of an NCHW tensor (with N = 1)
+
+    :param c: Expression of the channel
+    :param h: Expression of the row
+    :param w: Expression of the column
+    """
+    _, C, H, W = tensor.shape
+
+    if tensor.layout is None:
+        return f"({c}) * {H * W} + ({h}) * {W} + ({w})"
+    if tensor.layout == NHWC:
+        return f"(({h}) * {W} + ({w})) * {C} + ({c})"
+
+    match = re.fullmatch(r"NCHW(\d+)c", tensor.layout)
+    assert match is not None, f"unknown layout {tensor.layout}"
+    CB = int(match.group(1))
+
+    return f"(({c}) / {CB}) * {H * W * CB} + (({h}) * {W} + ({w})) * {CB} + ({c}) % {CB}"
@@ -1,13 +1,14 @@
 from abc import ABC, abstractmethod
 from collections import defaultdict
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
 from textwrap import dedent
 from typing import Any, Callable, Literal
 
 import onnx
 
-from ..tensor import TensorInfo
+from ..tensor import TensorData, TensorInfo
+from .epilogue import Epilogue
 
 # used as tensor names
 LETTERS = (
@@ -48,6 +49,21 @@ class OpCall:
     outputs: list[TensorInfo]
     input_names: tuple[str, ...] = LETTERS
     output_names: tuple[str, ...] = ("OUT",)
+    # floats of temporary memory the call needs, passed as `scratch`
+    # the generator plans it in the intermediates buffer
+    scratch_size: int = 0
+    scratch: TensorInfo | None = None
+    # index of an input the output may overwrite (same size, each element is read
+    # before the same element of the output is written)
+    # the generator gives both the same memory when the input is not used afterwards
+    inplace_input: int | None = None
+    # offsets of the slices of the output where the inputs are copied
+    # if set, the call only does that copy and the generator may drop it,
+    # letting the producers of the inputs write directly into their slice
+    view_offsets: list[int] | None = None
+    # constant inputs the implementation reads in another layout (packed ahead of time)
+    # the generator replaces them with a weight holding this data
+    packed_inputs: dict[int, TensorData] = field(default_factory=dict)
 
     def fn_name(self) -> str:
         str_sig_params = []
@@ -64,17 +80,22 @@ class OpCall:
     def signature(self) -> str:
         params = []
         for i in range(len(self.inputs)):
-            params.append(f"const float* __restrict__ {self.input_names[i]}")
+            restrict = "" if i == self.inplace_input else "__restrict__ "
+            params.append(f"const float* {restrict}{self.input_names[i]}")
         for i in range(len(self.outputs)):
-            params.append(f"float* __restrict__ {self.output_names[i]}")
+            restrict = "" if self.inplace_input is not None else "__restrict__ "
+            params.append(f"float* {restrict}{self.output_names[i]}")
+        if self.scratch_size > 0:
+            params.append("float* __restrict__ scratch")
 
         return f"void {self.fn_name()}({', '.join(params)})"
 
     def invocation(self) -> str:
-        return (
-            self.fn_name()
-            + f"({', '.join(t.variable for t in self.inputs + self.outputs)})"
-        )
+        tensors = self.inputs + self.outputs
+        if self.scratch is not None:
+            tensors = tensors + [self.scratch]
+
+        return self.fn_name() + f"({', '.join(t.variable for t in tensors)})"
 
 
 @dataclass(frozen=True)
@@ -108,6 +129,8 @@ class RegistryEntry:
 
 class Operation(ABC):
     node_types: set[str]
+    # layouts other than row-major the implementation can read and write
+    layouts: set[str] = set()
     _registry: defaultdict[str, list[RegistryEntry]] = defaultdict(list)
 
     def __init__(
@@ -115,12 +138,34 @@ class Operation(ABC):
         node: onnx.NodeProto,
         inputs: list[TensorInfo],
         outputs: list[TensorInfo],
+        epilogue: Epilogue = [],
     ):
         self.node = node
         self.inputs = inputs
         self.outputs = outputs
+        # elementwise ops fused into the writeback (see Generator._fuse_epilogues)
+        self.epilogue = epilogue
+
+        for tensor in inputs + outputs:
+            if tensor.layout is not None and tensor.layout not in self.layouts:
+                raise NotImplementedError(f"layout {tensor.layout} is not supported")
+
         self.parse()
 
+    @classmethod
+    def keeps_layout(
+        cls,
+        node: onnx.NodeProto,
+        inputs: list[TensorInfo],
+        outputs: list[TensorInfo],
+        layout: str,
+    ) -> bool:
+        """
+        Checks if the operation can run with its (non constant) inputs and outputs
+        all in `layout`, used by the generator to pick the layout of the tensors
+        """
+        return False
+
     @abstractmethod
     def parse(self) -> None:
         pass
@@ -1,5 +1,9 @@
-from onnx2code.util import compute_strides, get_attribute
+import onnx
 
+from onnx2code.util import get_attribute
+
+from ..tensor import TensorInfo
+from .layout import BLOCKED_LAYOUTS, NHWC, layout_index
 from .operation import OpCall, Operation, OpImpl
 
 
@@ -12,6 +16,18 @@ class Pooling(Operation):
     """
 
     node_types = {"MaxPool", "AveragePool"}
+    # channels are independent, they can be in blocks
+    layouts = BLOCKED_LAYOUTS | {NHWC}
+
+    @classmethod
+    def keeps_layout(
+        cls,
+        node: onnx.NodeProto,
+        inputs: list[TensorInfo],
+        outputs: list[TensorInfo],
+        layout: str,
+    ) -> bool:
+        return inputs[0].shape[0] == 1
 
     def parse(self) -> None:
         assert len(self.inputs) == 1, "expected one input"
@@ -36,7 +52,8 @@ class Pooling(Operation):
     def call(self) -> OpCall:
         return OpCall(
             sig_name=self.op,
-            sig_params=[self.X.shape, [self.KW, self.KH], self.strides, self.pads],
+            sig_params=[self.X.shape, [self.KW, self.KH], self.strides, self.pads]
+            + ([self.X.layout] if self.X.layout is not None else []),
             inputs=self.inputs,
             outputs=self.outputs,
         )
@@ -53,12 +70,11 @@ class PoolingC(Pooling):
         pads_start = [self.pads[0], self.pads[1]]
         # pads_end = [self.pads[2], self.pads[3]]
 
-        input_strides = compute_strides(self.X.shape)
-        output_strides = compute_strides(self.Y.shape)
-
         source = f"""
+        // channels are independent
+        parallel_for({self.Y.shape[1]}, [&](int start, int end) {{
         // start position of kernel
-        for(int c = 0; c < {self.Y.shape[1]}; c++) {{
+        for(int c = start; c < end; c++) {{
             for(int h = 0; h < {self.Y.shape[2]}; h++) {{
                 for(int w = 0; w < {self.Y.shape[3]}; w++) {{
                     float acc = {'-INFINITY' if self.op == "MaxPool" else "0.0f"};
@@ -70,24 +86,17 @@ class PoolingC(Pooling):
                             const int ih = {-pads_start[0]} + (h * {self.strides[0]}) + hh;
                             const int iw = {-pads_start[1]} + (w * {self.strides[1]}) + ww;
                             if(ih >= 0 && ih < {H} && iw >= 0 && iw < {W}) {{
-                                const float val = A[
-                                    c * {input_strides[1]} +
-                                    ih * {input_strides[2]} +
-                                    iw * {input_strides[3]}
-                                ];
+                                const float val = A[{layout_index(self.X, "c", "ih", "iw")}];
                                 acc = {'acc > val ? acc : val' if self.op == "MaxPool" else 'acc + val'};
                                 count++;
                             }}
                         }}
                     }}
-                    OUT[
-                        c * {output_strides[1]} +
-                        h * {output_strides[2]} +
-                        w * {output_strides[3]}
-                    ] = acc{"" if self.op == "MaxPool" else "/(float)count"};
+                    OUT[{layout_index(self.Y, "c", "h", "w")}] = acc{"" if self.op == "MaxPool" else "/(float)count"};
                 }}
             }}
         }}
+        }});
         """
 
         return OpImpl(lang="c", source=source)
@@ -51,16 +51,26 @@ class SoftmaxC(Softmax):
 
         def iterate(predicate: Callable[[str], str]) -> str:
             iterators = []
+            closers = []
             offset = f"i * {labels_stride}"
 
             for i, size in enumerate(sizes):
-                iterators.append(f"for (int d{i} = 0; d{i} < {size}; ++d{i}) {{")
+                if i == 0:
+                    # the outermost dimension is split between threads
+                    iterators.append(
+                        f"parallel_for({size}, [&](int start, int end) {{"
+                        f"for (int d{i} = start; d{i} < end; ++d{i}) {{"
+                    )
+                    closers.append("}});")
+                else:
+                    iterators.append(f"for (int d{i} = 0; d{i} < {size}; ++d{i}) {{")
+                    closers.append("}")
                 offset += f" + d{i} * {strides[i]}"
 
             return f"""
                 {NL.join(iterators)}
                 {predicate(offset)}
-                {NL.join("}" for _ in iterators)}
+                {NL.join(reversed(closers))}
             """
 
         source = iterate(
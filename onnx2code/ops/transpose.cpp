@@ -0,0 +1,100 @@
+// Cache-blocked transpose of a matrix
+//
+// The matrix is walked in blocks of TRANSPOSE_BLOCK x TRANSPOSE_BLOCK that fit in L1,
+// each one split in 8x8 tiles transposed in registers (with AVX2, see targets.cpp).
+// The rows and columns that don't complete a tile are copied one element at a time.
+
+#ifndef TRANSPOSE_BLOCK
+#define TRANSPOSE_BLOCK 64
+#endif
+
+#if O2C_AVX2
+// B (8x8, rows with stride ldb) = A^T (8x8, rows with stride lda)
+template <int lda, int ldb>
+inline void transpose_8x8(const float* __restrict__ A, float* __restrict__ B) {
+    __m256 r0 = _mm256_loadu_ps(A + 0 * lda);
+    __m256 r1 = _mm256_loadu_ps(A + 1 * lda);
+    __m256 r2 = _mm256_loadu_ps(A + 2 * lda);
+    __m256 r3 = _mm256_loadu_ps(A + 3 * lda);
+    __m256 r4 = _mm256_loadu_ps(A + 4 * lda);
+    __m256 r5 = _mm256_loadu_ps(A + 5 * lda);
+    __m256 r6 = _mm256_loadu_ps(A + 6 * lda);
+    __m256 r7 = _mm256_loadu_ps(A + 7 * lda);
+
+    // interleave pairs of rows: a00 a10 a01 a11 | a04 a14 a05 a15, ...
+    __m256 t0 = _mm256_unpacklo_ps(r0, r1);
+    __m256 t1 = _mm256_unpackhi_ps(r0, r1);
+    __m256 t2 = _mm256_unpacklo_ps(r2, r3);
+    __m256 t3 = _mm256_unpackhi_ps(r2, r3);
+    __m256 t4 = _mm256_unpacklo_ps(r4, r5);
+    __m256 t5 = _mm256_unpackhi_ps(r4, r5);
+    __m256 t6 = _mm256_unpacklo_ps(r6, r7);
+    __m256 t7 = _mm256_unpackhi_ps(r6, r7);
+
+    // 4 rows of each column: a00 a10 a20 a30 | a04 a14 a24 a34, ...
+    __m256 s0 = _mm256_shuffle_ps(t0, t2, _MM_SHUFFLE(1, 0, 1, 0));
+    __m256 s1 = _mm256_shuffle_ps(t0, t2, _MM_SHUFFLE(3, 2, 3, 2));
+    __m256 s2 = _mm256_shuffle_ps(t1, t3, _MM_SHUFFLE(1, 0, 1, 0));
+    __m256 s3 = _mm256_shuffle_ps(t1, t3, _MM_SHUFFLE(3, 2, 3, 2));
+    __m256 s4 = _mm256_shuffle_ps(t4, t6, _MM_SHUFFLE(1, 0, 1, 0));
+    __m256 s5 = _mm256_shuffle_ps(t4, t6, _MM_SHUFFLE(3, 2, 3, 2));
+    __m256 s6 = _mm256_shuffle_ps(t5, t7, _MM_SHUFFLE(1, 0, 1, 0));
+    __m256 s7 = _mm256_shuffle_ps(t5, t7, _MM_SHUFFLE(3, 2, 3, 2));
+
+    // join the halves of the 8 rows
+    _mm256_storeu_ps(B + 0 * ldb, _mm256_permute2f128_ps(s0, s4, 0x20));
+    _mm256_storeu_ps(B + 1 * ldb, _mm256_permute2f128_ps(s1, s5, 0x20));
+    _mm256_storeu_ps(B + 2 * ldb, _mm256_permute2f128_ps(s2, s6, 0x20));
+    _mm256_storeu_ps(B + 3 * ldb, _mm256_permute2f128_ps(s3, s7, 0x20));
+    _mm256_storeu_ps(B + 4 * ldb, _mm256_permute2f128_ps(s0, s4, 0x31));
+    _mm256_storeu_ps(B + 5 * ldb, _mm256_permute2f128_ps(s1, s5, 0x31));
+    _mm256_storeu_ps(B + 6 * ldb, _mm256_permute2f128_ps(s2, s6, 0x31));
+    _mm256_storeu_ps(B + 7 * ldb, _mm256_permute2f128_ps(s3, s7, 0x31));
+}
+#else
+template <int lda, int ldb>
+inline void transpose_8x8(const float* __restrict__ A, float* __restrict__ B) {
+    for (int c = 0; c < 8; c++) {
+        for (int r = 0; r < 8; r++) {
+            B[c * ldb + r] = A[r * lda + c];
+        }
+    }
+}
+#endif
+
+// B (C x R, rows with stride ldb) = A^T (R x C, rows with stride lda)
+template <int R, int C, int lda, int ldb>
+inline void transpose_2d(const float* __restrict__ A, float* __restrict__ B) {
+    constexpr int row_blocks = (R + TRANSPOSE_BLOCK - 1) / TRANSPOSE_BLOCK;
+    constexpr int col_blocks = (C + TRANSPOSE_BLOCK - 1) / TRANSPOSE_BLOCK;
+
+    // the blocks write disjoint parts of B
+    parallel_for(row_blocks * col_blocks, [&](int start, int end) {
+        for (int block = start; block < end; block++) {
+            const int r0 = (block / col_blocks) * TRANSPOSE_BLOCK;
+            const int c0 = (block % col_blocks) * TRANSPOSE_BLOCK;
+            const int r1 = min(r0 + TRANSPOSE_BLOCK, R);
+            const int c1 = min(c0 + TRANSPOSE_BLOCK, C);
+
+            // whole tiles
+            int r = r0;
+            for (; r + 8 <= r1; r += 8) {
+                int c = c0;
+                for (; c + 8 <= c1; c += 8) {
+                    transpose_8x8<lda, ldb>(A + r * lda + c, B + c * ldb + r);
+                }
+                for (; c < c1; c++) {
+                    for (int i = r; i < r + 8; i++) {
+                        B[c * ldb + i] = A[i * lda + c];
+                    }
+                }
+            }
+            // remaining rows
+            for (; r < r1; r++) {
+                for (int c = c0; c < c1; c++) {
+                    B[c * ldb + r] = A[r * lda + c];
+                }
+            }
+        }
+    });
+}
@@ -1,6 +1,11 @@
+from math import prod
+from pathlib import Path
+
 from ..util import compute_strides, get_attribute
 from .operation import OpCall, Operation, OpImpl
 
+external_paths_transpose = (Path(__file__).parent / "transpose.cpp",)
+
 
 class Transpose(Operation):
     """
@@ -34,6 +39,56 @@ class Transpose(Operation):
 @Transpose.variant("c")
 class TransposeC(Transpose):
     def impl(self) -> OpImpl:
+        n = len(self.perm)
+        if n >= 2 and self.perm[-1] != n - 1:
+            return self.impl_blocked()
+
+        return self.impl_naive()
+
+    def impl_blocked(self) -> OpImpl:
+        """
+        The innermost axis of the input and the one of the output differ,
+        each pair of them is a matrix transposed by blocks (see transpose.cpp)
+        """
+        input_shape = self.inputs[0].shape
+        output_shape = self.outputs[0].shape
+        n = len(self.perm)
+
+        # output axis that is the innermost of the input
+        b = self.perm.index(n - 1)
+        # R x C matrix of the input (R along the innermost axis of the output)
+        R = input_shape[self.perm[-1]]
+        C = input_shape[-1]
+        lda = self.input_strides[self.perm[-1]]
+        ldb = self.output_strides[b]
+
+        # every other axis, walked as a single index
+        outer = [i for i in range(n - 1) if i != b]
+        count = prod(output_shape[i] for i in outer)
+
+        in_offset = ["0"]
+        out_offset = ["0"]
+        divisor = 1
+        for i in reversed(outer):
+            d = f"((o / {divisor}) % {output_shape[i]})"
+            in_offset.append(f"{d} * {self.input_strides[self.perm[i]]}")
+            out_offset.append(f"{d} * {self.output_strides[i]}")
+            divisor *= output_shape[i]
+
+        source = f"""
+        parallel_for({count}, [&](int start, int end) {{
+            for(int o = start; o < end; o++) {{
+                transpose_2d<{R}, {C}, {lda}, {ldb}>(
+                    A + {" + ".join(in_offset)},
+                    OUT + {" + ".join(out_offset)}
+                );
+            }}
+        }});
+        """
+
+        return OpImpl(lang="c", source=source, external_paths=external_paths_transpose)
+
+    def impl_naive(self) -> OpImpl:
         output_shape = self.outputs[0].shape
 
         for_loops = []
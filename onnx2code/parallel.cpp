@@ -0,0 +1,235 @@
+// Parallel runtime for the generated code
+//
+// O2C_THREADS and O2C_PIN_THREADS are defined by the generator.
+// With O2C_THREADS > 1 a persistent pool of O2C_THREADS - 1 workers is started on
+// the first parallel_for, the calling thread acts as worker 0.
+// O2C_PIN_THREADS pins each worker t to core t (the calling thread is left as is).
+// The pool is global: inference must not run from several host threads at once.
+// Work is split with a static schedule: worker t always gets the same range.
+// Independent calls (parallel_calls) run at the same time on teams of workers,
+// the parallel_for calls inside each one are split among its team.
+
+#ifndef O2C_THREADS
+#define O2C_THREADS 1
+#endif
+
+#ifndef O2C_PIN_THREADS
+#define O2C_PIN_THREADS 0
+#endif
+
+// iterations a worker spins before going to sleep
+#ifndef O2C_SPIN
+#define O2C_SPIN 100000
+#endif
+
+#if O2C_THREADS > 1
+
+#include <pthread.h>
+#include <sched.h>
+
+#include <atomic>
+#include <condition_variable>
+#include <mutex>
+#include <thread>
+
+// true while the current thread runs a parallel region,
+// nested parallel_for calls run serially
+static thread_local bool o2c_in_parallel = false;
+
+// Workers that run one of the calls of parallel_calls: member 0 (the leader)
+// runs the call, the others wait for the ranges of its parallel_for calls
+struct Team {
+    int size = 1;
+    std::atomic<int> generation{0};
+    std::atomic<int> pending{0};
+    std::atomic<bool> done{false};
+    void (*task)(void*, int) = nullptr;
+    void* context = nullptr;
+
+    // runs fn(m) on every member m and waits for all of them (from the leader)
+    template <typename F>
+    void run(F& fn) {
+        task = [](void* context, int m) { (*(F*)context)(m); };
+        context = &fn;
+        pending.store(size - 1, std::memory_order_relaxed);
+        generation.fetch_add(1, std::memory_order_release);
+
+        fn(0);
+
+        while (pending.load(std::memory_order_acquire) != 0) {
+            sched_yield();
+        }
+    }
+
+    // the other members, until the leader is done with its call
+    void work(int m) {
+        int seen = 0;
+
+        while (true) {
+            while (generation.load(std::memory_order_acquire) == seen) {
+                // done is set after the last run, so no work is left behind
+                if (done.load(std::memory_order_acquire)) {
+                    return;
+                }
+                sched_yield();
+            }
+            seen = generation.load(std::memory_order_acquire);
+
+            task(context, m);
+
+            pending.fetch_sub(1, std::memory_order_release);
+        }
+    }
+};
+
+// team of the call the current thread runs (nullptr: the whole pool)
+static thread_local Team* o2c_team = nullptr;
+
+class ThreadPool {
+   public:
+    ThreadPool() {
+        for (int t = 1; t < O2C_THREADS; t++) {
+            std::thread worker(&ThreadPool::work, this, t);
+            pin(worker.native_handle(), t);
+            worker.detach();
+        }
+    }
+
+    // runs fn(t) on every worker t and waits for all of them
+    template <typename F>
+    void run(F& fn) {
+        task = [](void* context, int t) { (*(F*)context)(t); };
+        context = &fn;
+        pending.store(O2C_THREADS - 1, std::memory_order_relaxed);
+
+        {
+            std::lock_guard<std::mutex> lock(mutex);
+            generation.fetch_add(1, std::memory_order_release);
+        }
+        wakeup.notify_all();
+
+        fn(0);
+
+        while (pending.load(std::memory_order_acquire) != 0) {
+            sched_yield();
+        }
+    }
+
+   private:
+    void work(int t) {
+        int seen = 0;
+
+        while (true) {
+            // wait for a new generation of work
+            for (int spins = 0; generation.load(std::memory_order_acquire) == seen; spins++) {
+                if (spins > O2C_SPIN) {
+                    std::unique_lock<std::mutex> lock(mutex);
+                    wakeup.wait(lock, [&] { return generation.load() != seen; });
+                }
+            }
+            seen = generation.load(std::memory_order_acquire);
+
+            task(context, t);
+
+            pending.fetch_sub(1, std::memory_order_release);
+        }
+    }
+
+    static void pin(pthread_t thread, int t) {
+        if (O2C_PIN_THREADS) {
+            cpu_set_t set;
+            CPU_ZERO(&set);
+            CPU_SET(t % std::thread::hardware_concurrency(), &set);
+            pthread_setaffinity_np(thread, sizeof(cpu_set_t), &set);
+        }
+    }
+
+    std::atomic<int> generation{0};
+    std::atomic<int> pending{0};
+    void (*task)(void*, int) = nullptr;
+    void* context = nullptr;
+
+    std::mutex mutex;
+    std::condition_variable wakeup;
+};
+
+// never destroyed: the detached workers wait on it until the process exits
+static ThreadPool& thread_pool() {
+    static ThreadPool* pool = new ThreadPool;
+    return *pool;
+}
+
+#endif
+
+// Splits [0, n) in one contiguous range per thread (of the pool, or of the team
+// of the current call) and calls fn(start, end) once per range
+template <typename F>
+inline void parallel_for(int n, F fn) {
+#if O2C_THREADS > 1
+    Team* team = o2c_team;
+    const int threads = team != nullptr ? team->size : O2C_THREADS;
+
+    if (!o2c_in_parallel && n > 1 && threads > 1) {
+        auto chunk = [&](int t) {
+            const int start = (long)n * t / threads;
+            const int end = (long)n * (t + 1) / threads;
+
+            o2c_in_parallel = true;
+            if (start < end) {
+                fn(start, end);
+            }
+            o2c_in_parallel = false;
+        };
+
+        if (team != nullptr) {
+            team->run(chunk);
+        } else {
+            thread_pool().run(chunk);
+        }
+        return;
+    }
+#endif
+
+    fn(0, n);
+}
+
+// Calls fn(0), ..., fn(n - 1) at the same time (they must be independent)
+// With fewer calls than threads, each one gets a team of about O2C_THREADS / n
+// workers, otherwise each worker runs some of them with its kernels serial
+template <typename F>
+inline void parallel_calls(int n, F fn) {
+#if O2C_THREADS > 1
+    if (n < O2C_THREADS && !o2c_in_parallel && o2c_team == nullptr) {
+        // team j has the workers [first(j), first(j + 1))
+        auto first = [&](int j) { return (int)(((long)j * O2C_THREADS + n - 1) / n); };
+
+        Team teams[O2C_THREADS];
+        for (int j = 0; j < n; j++) {
+            teams[j].size = first(j + 1) - first(j);
+        }
+
+        auto member = [&](int t) {
+            const int j = (long)t * n / O2C_THREADS;
+            Team& team = teams[j];
+
+            if (t == first(j)) {
+                o2c_team = &team;
+                fn(j);
+                o2c_team = nullptr;
+                team.done.store(true, std::memory_order_release);
+            } else {
+                team.work(t - first(j));
+            }
+        };
+
+        thread_pool().run(member);
+        return;
+    }
+#endif
+
+    parallel_for(n, [&](int start, int end) {
+        for (int i = start; i < end; i++) {
+            fn(i);
+        }
+    });
+}
@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 from .tensor import TensorData
 from .util import ShapesMap
@@ -12,3 +12,7 @@ class ModelResult:
     source_h: str
     source_asm: str
     weights: TensorData
+    # arena size (floats) of intermediates achieved by each memory strategy
+    memory_layouts: dict[str, int] = field(default_factory=dict)
+    # instruction sets dispatched to at load time (empty: only the one of -march)
+    targets: list[str] = field(default_factory=list)
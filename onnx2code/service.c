@@ -24,24 +24,8 @@ void* map_shared_memory(const char* name) {
     return shared;
 }
 
-void* read_file(const char* filename) {
-    FILE* fp = fopen(filename, "rb");
-    assert(fp != NULL);
-
-    fseek(fp, 0, SEEK_END);
-    long size = ftell(fp);
-    fseek(fp, 0, SEEK_SET);
-
-    void* buffer = malloc(size);
-
-    fread(buffer, sizeof(char), size, fp);
-    fclose(fp);
-
-    return buffer;
-}
-
 int main(int argc, char** argv) {
-    const float* weights = (const float*)read_file(argv[1]);
+    const float* weights = map_weights(argv[1]);
     float* inputs = (float*)map_shared_memory("/o2c-inputs");
     float* outputs = (float*)map_shared_memory("/o2c-outputs");
 
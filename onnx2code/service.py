@@ -86,6 +86,9 @@ class ModelService:
                 str(asm_file),
                 "-o",
                 str(asm_object),
+                # for the embedded weights
+                "-i",
+                f"{temp_dir}/",
             ]
             + (["-g", "-w+all", "-w+error"] if debug else [])
         )
@@ -104,10 +107,16 @@ class ModelService:
                 temp_dir.__str__(),
                 "-lrt",  # for shm
                 "-lm",  # for math
-                "-march=native",
-                "-mtune=native",
+                "-pthread",  # for the thread pool
                 "-O3",
             ]
+            # with dispatch targets the baseline runs everywhere, the kernels
+            # are compiled for each target by the generated code
+            + (
+                ["-march=x86-64", "-mtune=generic"]
+                if len(self.result.targets) > 0
+                else ["-march=native", "-mtune=native"]
+            )
             + (
                 [
                     "-g",
@@ -0,0 +1,33 @@
+// Instruction sets the kernels can use
+//
+// By default they follow the flags the code is compiled with (-march).
+// When the generator emits a copy of the kernels for each dispatch target,
+// it redefines them before each copy (see targets.py).
+
+#if defined(__x86_64__) || defined(__i386__)
+#include <immintrin.h>
+#endif
+
+#ifndef O2C_AVX512
+#if defined(__AVX512F__) && defined(__AVX512VL__)
+#define O2C_AVX512 1
+#else
+#define O2C_AVX512 0
+#endif
+#endif
+
+#ifndef O2C_AVX2
+#if defined(__AVX2__) && defined(__FMA__)
+#define O2C_AVX2 1
+#else
+#define O2C_AVX2 0
+#endif
+#endif
+
+#ifndef O2C_SSE4_2
+#if defined(__SSE4_2__)
+#define O2C_SSE4_2 1
+#else
+#define O2C_SSE4_2 0
+#endif
+#endif
@@ -0,0 +1,115 @@
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Iterator
+
+
+@dataclass(frozen=True)
+class Target:
+    """
+    Instruction set the generated kernels can be compiled for
+    """
+
+    name: str
+    # extensions enabled with `#pragma GCC target`
+    gcc: str
+    # features checked with `__builtin_cpu_supports` (as in /proc/cpuinfo, "." for "_")
+    cpu: tuple[str, ...]
+    # macros the kernels check (see targets.cpp), the ones not listed are 0
+    macros: tuple[str, ...]
+    # arch of libxsmm_gemm_generator
+    libxsmm: str
+
+    def namespace(self) -> str:
+        return "o2c_" + self.name.replace(".", "_")
+
+
+# from the widest, the dispatcher picks the first one the CPU supports
+TARGETS = {
+    target.name: target
+    for target in [
+        Target(
+            name="avx512",
+            gcc="avx512f,avx512vl,avx512bw,avx512dq,avx2,fma,bmi,bmi2,f16c,popcnt",
+            cpu=("avx512f", "avx512vl", "avx512bw", "avx512dq"),
+            macros=("O2C_AVX512", "O2C_AVX2", "O2C_SSE4_2"),
+            libxsmm="skx",
+        ),
+        Target(
+            name="avx2",
+            gcc="avx2,fma,bmi,bmi2,f16c,popcnt",
+            cpu=("avx2", "fma"),
+            macros=("O2C_AVX2", "O2C_SSE4_2"),
+            libxsmm="hsw",
+        ),
+        Target(
+            name="sse4.2",
+            gcc="sse4.2,popcnt",
+            cpu=("sse4.2",),
+            macros=("O2C_SSE4_2",),
+            libxsmm="wsm",
+        ),
+    ]
+}
+
+# all the macros of targets.cpp
+TARGET_MACROS = ("O2C_AVX512", "O2C_AVX2", "O2C_SSE4_2")
+
+# targets the generated code is dispatched to at load time (empty: only the host)
+dispatch_targets: list[Target] = []
+
+
+def set_dispatch_targets(targets: list[Target]) -> None:
+    # in place, other modules import the list
+    dispatch_targets[:] = targets
+
+
+@contextmanager
+def dispatching(targets: list[Target]) -> Iterator[None]:
+    """
+    Sets the dispatch targets while the operations are generated
+    """
+    previous = list(dispatch_targets)
+    set_dispatch_targets(targets)
+    try:
+        yield
+    finally:
+        set_dispatch_targets(previous)
+
+
+def cpu_features() -> set[str]:
+    """
+    Flags of the CPU the generator runs on (empty if they can't be read)
+    """
+    try:
+        with open("/proc/cpuinfo", "r") as f:
+            for line in f:
+                if line.startswith("flags"):
+                    return set(line.split(":", 1)[1].split())
+    except OSError:
+        pass
+    return set()
+
+
+def host_target() -> Target | None:
+    """
+    Widest target the CPU the generator runs on supports
+    """
+    features = cpu_features()
+    for target in TARGETS.values():
+        if all(feature.replace(".", "_") in features for feature in target.cpu):
+            return target
+    return None
+
+
+def parse_targets(names: list[str]) -> list[Target]:
+    """
+    Targets by name, sorted from the widest
+
+    :raises ValueError: If a name is not a known target
+    """
+    for name in names:
+        if name not in TARGETS:
+            raise ValueError(
+                f"Unknown target '{name}', expected one of {', '.join(TARGETS)}"
+            )
+    return [target for target in TARGETS.values() if target.name in names]
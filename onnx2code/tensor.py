@@ -21,6 +21,10 @@ class TensorInfo:
     size: int
     data: TensorData | None
     variable: str
+    # layout in memory when it is not the row-major order of the shape
+    # (for example NCHW8c: the channels in blocks of 8, the block is the innermost dimension)
+    # size includes the padding of the layout
+    layout: str | None = None
 
     def shape_str(self, sep: str = "x") -> str:
         return sep.join(map(str, self.shape))
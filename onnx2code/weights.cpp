@@ -0,0 +1,50 @@
+// Loading of the weights file for the generated code
+//
+// The file is memory-mapped read-only, so nothing is copied at startup and
+// processes running the same model share the pages of the page cache.
+// Pages are page-aligned, which covers the alignment the generated code expects.
+//
+// O2C_MAP_POPULATE: read the whole file when mapping it (no page faults later)
+// O2C_MADV_WILLNEED: hint the kernel to start reading the file ahead
+
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+
+#ifndef O2C_MAP_POPULATE
+#define O2C_MAP_POPULATE 0
+#endif
+
+#ifndef O2C_MADV_WILLNEED
+#define O2C_MADV_WILLNEED 1
+#endif
+
+const float* map_weights(const char* filename) {
+    int fd = open(filename, O_RDONLY);
+    assert(fd != -1);
+
+    struct stat finfo;
+    fstat(fd, &finfo);
+    size_t size = finfo.st_size;
+
+    if (size == 0) {
+        // the model has no weights, mmap does not accept empty mappings
+        close(fd);
+        static const float empty[1] = {0};
+        return empty;
+    }
+
+    int flags = MAP_PRIVATE | (O2C_MAP_POPULATE ? MAP_POPULATE : 0);
+    void* weights = mmap(NULL, size, PROT_READ, flags, fd, 0);
+    assert(weights != MAP_FAILED);
+
+    // the mapping keeps the file open
+    close(fd);
+
+    if (O2C_MADV_WILLNEED) {
+        madvise(weights, size, MADV_WILLNEED);
+    }
+
+    return (const float*)weights;
+}
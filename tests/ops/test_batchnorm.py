@@ -0,0 +1,108 @@
+import numpy as np
+import onnx
+import pytest
+from onnx import TensorProto, helper, numpy_helper
+
+from onnx2code.checker import check_model, check_model_result
+from onnx2code.generator import Generator
+
+# tf2onnx lowers Keras' BatchNormalization to Mul/Add,
+# so the graphs are built by hand to get actual BatchNormalization nodes
+
+
+def bn_initializers(prefix: str, channels: int) -> list[onnx.TensorProto]:
+    params = {
+        "scale": np.random.normal(size=channels),
+        "B": np.random.normal(size=channels),
+        "mean": np.random.normal(size=channels),
+        "var": np.random.uniform(0.5, 1.5, size=channels),
+    }
+    return [
+        numpy_helper.from_array(value.astype(np.float32), f"{prefix}_{name}")
+        for name, value in params.items()
+    ]
+
+
+def bn_node(prefix: str, input: str, output: str) -> onnx.NodeProto:
+    return helper.make_node(
+        "BatchNormalization",
+        [input] + [f"{prefix}_{name}" for name in ["scale", "B", "mean", "var"]],
+        [output],
+        epsilon=1e-3,
+    )
+
+
+def make_model(
+    nodes: list[onnx.NodeProto],
+    initializers: list[onnx.TensorProto],
+    input_shape: list[int],
+    output_shape: list[int],
+) -> onnx.ModelProto:
+    graph = helper.make_graph(
+        nodes,
+        "test",
+        [helper.make_tensor_value_info("X", TensorProto.FLOAT, input_shape)],
+        [helper.make_tensor_value_info("Y", TensorProto.FLOAT, output_shape)],
+        initializers,
+    )
+    model = helper.make_model(
+        graph, opset_imports=[helper.make_opsetid("", 13)], ir_version=8
+    )
+    return onnx.shape_inference.infer_shapes(model)
+
+
+@pytest.mark.parametrize("shape", [[1, 3], [1, 4, 5], [1, 3, 8, 8], [2, 3, 4, 4]])
+def test_standalone(shape: list[int]) -> None:
+    model = make_model(
+        [bn_node("bn", "X", "Y")], bn_initializers("bn", shape[1]), shape, shape
+    )
+    check_model(model)
+
+
+@pytest.mark.parametrize("use_bias", [False, True], ids=["no_bias", "bias"])
+@pytest.mark.parametrize("variation", ["conv-naive", "im2col"])
+def test_conv(use_bias: bool, variation: str) -> None:
+    W = numpy_helper.from_array(
+        np.random.normal(size=(4, 3, 3, 3)).astype(np.float32), "W"
+    )
+    B = numpy_helper.from_array(np.random.normal(size=4).astype(np.float32), "B")
+
+    model = make_model(
+        [
+            helper.make_node("Conv", ["X", "W"] + (["B"] if use_bias else []), ["C"]),
+            bn_node("bn", "C", "N"),
+            helper.make_node("Relu", ["N"], ["Y"]),
+        ],
+        [W, B] + bn_initializers("bn", 4),
+        [1, 3, 10, 10],
+        [1, 4, 8, 8],
+    )
+    check_model(model, [variation])
+
+
+@pytest.mark.parametrize("op", ["MatMul", "Gemm", "Gemm-transB"])
+@pytest.mark.parametrize("variation", ["gemm-naive", "loop-tiling"])
+@pytest.mark.parametrize("rows", [1, 5])
+def test_gemm(op: str, variation: str, rows: int) -> None:
+    transB = op == "Gemm-transB"
+    shape = (23, 37) if transB else (37, 23)
+    W = numpy_helper.from_array(np.random.normal(size=shape).astype(np.float32), "W")
+
+    model = make_model(
+        [
+            helper.make_node(
+                op.split("-")[0], ["X", "W"], ["G"], **({"transB": 1} if transB else {})
+            ),
+            bn_node("bn", "G", "Y"),
+        ],
+        [W] + bn_initializers("bn", 23),
+        [rows, 37],
+        [rows, 23],
+    )
+    generator = Generator(model, [variation])
+    result = generator.generate()
+
+    # the shifted bias is a vector broadcast over the rows
+    (node,) = generator.nodes
+    assert generator.tensors[node.input[2]].shape == [23]
+    check_model_result(model, result)
@@ -24,3 +24,18 @@ def test_concat(shapes: list[list[int]], axis: int, variation: str) -> None:
         pytest.skip("incompatible configuration")
 
     check_keras(model, [variation])
+
+
+@pytest.mark.parametrize("axis", [0, 1, 2])
+@pytest.mark.parametrize("threads", [1, 2])
+def test_concat_views(axis: int, threads: int) -> None:
+    # along the outer axis the producers write directly into the output
+    inputs = [tf.keras.Input([2, 3, 4]), tf.keras.Input([2, 3, 4])]
+    a = tf.keras.layers.Activation("relu")(inputs[0])
+    b = tf.keras.layers.Activation("tanh")(inputs[1])
+    c = tf.keras.layers.Activation("sigmoid")(b)
+    out = tf.keras.layers.Concatenate(axis=1 + axis)([a, b])
+    # nested concat, views of views
+    out = tf.keras.layers.Concatenate(axis=1 + axis)([out, c])
+    model = tf.keras.Model(inputs=inputs, outputs=[out])
+    check_keras(model, threads=threads)
@@ -18,6 +18,7 @@ from ..util import check_keras
     ids=lambda x: f"s{x[0]}d{x[1]}",
 )
 @pytest.mark.parametrize("use_bias", [False, True], ids=["no_bias", "bias"])
+@pytest.mark.parametrize("variation", ["conv-naive", "im2col"])
 def test_conv(
     shape: list[int],
     kernel_size: int,
@@ -25,6 +26,7 @@ def test_conv(
     padding: str,
     stride_and_dilation: tuple[int, int],
     use_bias: bool,
+    variation: str,
 ) -> None:
     try:
         input = tf.keras.Input(shape=shape)
@@ -41,4 +43,130 @@ def test_conv(
     except Exception:
         pytest.skip("incompatible configuration")
 
-    check_keras(model)
+    check_keras(model, [variation])
+
+
+@pytest.mark.parametrize("activation", ["relu", "sigmoid", "tanh", "relu6"])
+@pytest.mark.parametrize("variation", ["conv-naive", "im2col"])
+def test_conv_epilogue(activation: str, variation: str) -> None:
+    input = tf.keras.Input(shape=(10, 10, 3))
+    output = tf.keras.layers.Conv2D(
+        filters=4,
+        kernel_size=3,
+        bias_initializer="random_normal",
+    )(input)
+    if activation == "relu6":
+        output = tf.keras.layers.ReLU(max_value=6.0)(output)
+    else:
+        output = tf.keras.layers.Activation(activation)(output)
+    output = output * tf.constant([0.5, 1.0, 2.0, -1.0]) + 0.25
+    model = tf.keras.Model(inputs=[input], outputs=[output])
+
+    check_keras(model, variations=[variation])
+
+
+@pytest.mark.parametrize("shape", [(4, 3, 2), (10, 10, 4), (17, 13, 8)])
+@pytest.mark.parametrize("groups", [2, "depthwise"])
+@pytest.mark.parametrize("padding", ["valid", "same"])
+@pytest.mark.parametrize("strides", [1, 2])
+@pytest.mark.parametrize("variation", ["conv-naive", "im2col", "conv-direct"])
+def test_conv_grouped(
+    shape: list[int],
+    groups: int | str,
+    padding: str,
+    strides: int,
+    variation: str,
+) -> None:
+    input = tf.keras.Input(shape=shape)
+    if groups == "depthwise":
+        layer = tf.keras.layers.DepthwiseConv2D(
+            kernel_size=3,
+            padding=padding,
+            strides=strides,
+            depth_multiplier=2,
+            bias_initializer="random_normal",
+        )
+    else:
+        layer = tf.keras.layers.Conv2D(
+            filters=shape[2] * 2,
+            kernel_size=3,
+            padding=padding,
+            strides=strides,
+            groups=groups,
+            bias_initializer="random_normal",
+        )
+    output = tf.keras.layers.ReLU()(layer(input))
+    model = tf.keras.Model(inputs=[input], outputs=[output])
+
+    check_keras(model, [variation])
+
+
+@pytest.mark.parametrize("shape", [(4, 3, 1), (10, 10, 5), (17, 13, 8)])
+@pytest.mark.parametrize("filters", [1, 3, 10])
+@pytest.mark.parametrize("padding", ["valid", "same"])
+@pytest.mark.parametrize("strides", [1, 2])
+@pytest.mark.parametrize("use_bias", [False, True], ids=["no_bias", "bias"])
+def test_conv_winograd(
+    shape: list[int], filters: int, padding: str, strides: int, use_bias: bool
+) -> None:
+    input = tf.keras.Input(shape=shape)
+    output = tf.keras.layers.Conv2D(
+        filters=filters,
+        kernel_size=3,
+        padding=padding,
+        strides=strides,
+        use_bias=use_bias,
+        bias_initializer="random_normal",
+        activation="relu",
+    )(input)
+    model = tf.keras.Model(inputs=[input], outputs=[output])
+
+    # strided convolutions fall back to im2col
+    check_keras(model, ["winograd", "im2col"])
+
+
+@pytest.mark.parametrize("shape", [(4, 3, 1), (10, 10, 5), (17, 13, 8)])
+@pytest.mark.parametrize("filters", [1, 8, 10, 16])
+@pytest.mark.parametrize("kernel_size", [1, 3])
+@pytest.mark.parametrize("padding", ["valid", "same"])
+@pytest.mark.parametrize("strides", [1, 2])
+def test_conv_nchwc(
+    shape: list[int], filters: int, kernel_size: int, padding: str, strides: int
+) -> None:
+    # the tensors between the convolutions stay in NCHWc
+    input = tf.keras.Input(shape=shape)
+    x = input
+    for _ in range(3):
+        x = tf.keras.layers.Conv2D(
+            filters=filters,
+            kernel_size=kernel_size,
+            padding="same",
+            bias_initializer="random_normal",
+            activation="relu",
+        )(x)
+    try:
+        output = tf.keras.layers.Conv2D(
+            filters=3, kernel_size=kernel_size, padding=padding, strides=strides
+        )(x)
+        model = tf.keras.Model(inputs=[input], outputs=[output])
+    except Exception:
+        pytest.skip("incompatible configuration")
+
+    check_keras(model, ["nchwc"])
+
+
+@pytest.mark.parametrize("filters", [5, 16])
+def test_conv_nchwc_propagation(filters: int) -> None:
+    # pooling, residual and concat run in NCHWc between the convolutions,
+    # the NHWC ↔ NCHW transposes of the input and output are removed
+    input = tf.keras.Input(shape=(12, 12, 3))
+    x = tf.keras.layers.Conv2D(filters, 3, padding="same", activation="relu")(input)
+    x = tf.keras.layers.MaxPool2D()(x)
+    y = tf.keras.layers.Conv2D(filters, 3, padding="same", activation="relu")(x)
+    x = tf.keras.layers.Add()([x, y])
+    z = tf.keras.layers.Conv2D(filters, 1)(x)
+    x = tf.keras.layers.Concatenate()([x, z])
+    output = tf.keras.layers.Conv2D(4, 3)(x)
+    model = tf.keras.Model(inputs=[input], outputs=[output])
+
+    check_keras(model, ["nchwc"])
@@ -18,3 +18,16 @@ def test_activations(activation: tf.keras.layers.Activation) -> None:
     output = activation(input)
     model = tf.keras.Model(inputs=[input], outputs=[output])
     check_keras(model)
+
+
+def test_inplace() -> None:
+    # the activations can't be fused into the pooling, they run in-place
+    input = tf.keras.Input(shape=(8, 8, 3))
+    x = tf.keras.layers.MaxPooling2D(2)(input)
+    a = tf.keras.layers.Activation("sigmoid")(x)
+    a = tf.keras.layers.Activation("tanh")(a)
+    # x is still needed here, so the sigmoid can't overwrite it
+    output = tf.keras.layers.Add()([a, x])
+    output = tf.keras.layers.Activation("relu")(output)
+    model = tf.keras.Model(inputs=[input], outputs=[output])
+    check_keras(model)
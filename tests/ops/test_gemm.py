@@ -1,5 +1,21 @@
+import shutil
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+import onnx
 import pytest
 import tensorflow as tf
+from onnx import TensorProto, helper, numpy_helper
+
+from onnx2code.checker import check_model
+from onnx2code.ops import gemm
+from onnx2code.ops.gemm_tiling import GEMM
+from onnx2code.ops.gemm_tiling.GEMM import (
+    MICROKERNEL_PARAMS,
+    LoopTilingParams,
+    set_tiling_params,
+)
 
 from ..util import check_keras
 
@@ -37,3 +53,241 @@ def test_tiling(shape: list[int], units: int) -> None:
     )
     model = tf.keras.Model(inputs=[input], outputs=[dense])
     check_keras(model, variations=["loop-tiling"])
+
+
+@pytest.mark.parametrize("activation", ["relu", "sigmoid", "tanh"])
+@pytest.mark.parametrize("variation", ["gemm-naive", "loop-tiling"])
+def test_epilogue(activation: str, variation: str) -> None:
+    input = tf.keras.Input([19, 37])
+    dense = tf.keras.layers.Dense(
+        23, activation=activation, bias_initializer="uniform"
+    )(input)
+    model = tf.keras.Model(inputs=[input], outputs=[dense])
+    check_keras(model, variations=[variation])
+
+
+@pytest.mark.parametrize("shape", [[7, 300], [33, 600]])
+def test_packed(shape: list[int]) -> None:
+    # K spans several kc panels, the last one narrower than the others
+    input = tf.keras.Input(shape)
+    dense = tf.keras.layers.Dense(37, bias_initializer="uniform")(input)
+    model = tf.keras.Model(inputs=[input], outputs=[dense])
+    check_keras(model, variations=["loop-tiling"])
+
+
+@pytest.mark.parametrize("variation", ["gemm-naive", "loop-tiling"])
+@pytest.mark.parametrize("transA", [0, 1], ids=["A", "At"])
+@pytest.mark.parametrize("transB", [0, 1], ids=["B", "Bt"])
+@pytest.mark.parametrize("constant_B", [False, True], ids=["input_B", "const_B"])
+@pytest.mark.parametrize(
+    "C_shape", [None, [], [23], [19, 1], [19, 23]], ids=lambda x: f"C{x}"
+)
+def test_attributes(
+    variation: str,
+    transA: int,
+    transB: int,
+    constant_B: bool,
+    C_shape: list[int] | None,
+) -> None:
+    # Keras never sets these, the graph is built by hand
+    N, M, K = 19, 37, 23
+    A_shape = [M, N] if transA else [N, M]
+    B_shape = [K, M] if transB else [M, K]
+
+    inputs = [helper.make_tensor_value_info("A", TensorProto.FLOAT, A_shape)]
+    initializers = []
+    if constant_B:
+        B = np.random.normal(size=B_shape).astype(np.float32)
+        initializers.append(numpy_helper.from_array(B, "B"))
+    else:
+        inputs.append(helper.make_tensor_value_info("B", TensorProto.FLOAT, B_shape))
+    if C_shape is not None:
+        C = np.random.normal(size=C_shape).astype(np.float32)
+        initializers.append(numpy_helper.from_array(C, "C"))
+
+    node = helper.make_node(
+        "Gemm",
+        ["A", "B"] + (["C"] if C_shape is not None else []),
+        ["Y"],
+        transA=transA,
+        transB=transB,
+        alpha=0.75,
+        beta=-1.5,
+    )
+    graph = helper.make_graph(
+        [node],
+        "test",
+        inputs,
+        [helper.make_tensor_value_info("Y", TensorProto.FLOAT, [N, K])],
+        initializers,
+    )
+    model = helper.make_model(
+        graph, opset_imports=[helper.make_opsetid("", 13)], ir_version=8
+    )
+    check_model(onnx.shape_inference.infer_shapes(model), [variation])
+
+
+@pytest.mark.parametrize(
+    "shapes",
+    [
+        ([4, 5, 6], [4, 6, 7]),
+        ([2, 3, 5, 6], [2, 3, 6, 7]),
+        ([3, 1, 5, 6], [1, 4, 6, 7]),
+        ([1, 9, 6], [3, 6, 7]),
+    ],
+    ids=lambda x: f"{x[0]}x{x[1]}",
+)
+@pytest.mark.parametrize("variation", ["gemm-naive", "loop-tiling"])
+@pytest.mark.parametrize("threads", [1, 2])
+def test_batched(
+    shapes: tuple[list[int], list[int]], variation: str, threads: int
+) -> None:
+    A = tf.keras.Input(shapes[0])
+    B = tf.keras.Input(shapes[1])
+    output = tf.keras.layers.Lambda(lambda x: tf.matmul(x[0], x[1]))([A, B])
+    output = tf.keras.layers.Activation("relu")(output)
+    model = tf.keras.Model(inputs=[A, B], outputs=[output])
+    check_keras(model, variations=[variation], threads=threads)
+
+
+@pytest.mark.parametrize("shape", [[5, 6], [2, 3, 5, 6]])
+@pytest.mark.parametrize("variation", ["gemm-naive", "loop-tiling"])
+def test_batched_shared(shape: list[int], variation: str) -> None:
+    # the batches of A are flattened into rows, B stays packed
+    B = np.random.normal(size=[6, 7]).astype(np.float32)
+    input = tf.keras.Input(shape)
+    output = tf.keras.layers.Lambda(lambda x: tf.matmul(x, B))(input)
+    model = tf.keras.Model(inputs=[input], outputs=[output])
+    check_keras(model, variations=[variation])
+
+
+@pytest.mark.parametrize(
+    "params",
+    [
+        *MICROKERNEL_PARAMS.values(),
+        LoopTilingParams(nc=4096, kc=64, mc=64, mr=8, nr=8, mv=4, nu=4),
+    ],
+    ids=[*MICROKERNEL_PARAMS.keys(), "8x8"],
+)
+@pytest.mark.parametrize("shape", [[64, 64], [19, 300]])
+def test_microkernels(params: LoopTilingParams, shape: list[int]) -> None:
+    # the kernel is picked by the extensions of the host, the others use the fallbacks
+    previous = GEMM.tiling_params
+    set_tiling_params(params)
+    try:
+        input = tf.keras.Input(shape)
+        dense = tf.keras.layers.Dense(37, bias_initializer="uniform")(input)
+        model = tf.keras.Model(inputs=[input], outputs=[dense])
+        check_keras(model, variations=["loop-tiling"])
+    finally:
+        set_tiling_params(previous)
+
+
+@pytest.fixture
+def fake_libxsmm(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Iterator[Path]:
+    """
+    Stands in for libxsmm_gemm_generator, the file it returns gets
+    the arguments of each run (one per line)
+    """
+    runs = tmp_path / "runs"
+    generator = tmp_path / "libxsmm_gemm_generator"
+    generator.write_text(
+        "#!/bin/sh\n"
+        f'echo "$*" >> {runs}\n'
+        'echo "void $3(const float* A, const float* B, float* C) {}"\n'
+        'echo "libxsmm_num_total_flops += 1;"\n'
+    )
+    generator.chmod(0o755)
+
+    monkeypatch.setattr(gemm, "LIBXSMM_PATH", str(generator))
+    monkeypatch.setenv("ONNX2CODE_CACHE", str(tmp_path / "cache"))
+    gemm.run_libxsmm.cache_clear()
+    yield runs
+    gemm.run_libxsmm.cache_clear()
+
+
+def test_libxsmm_cache(fake_libxsmm: Path) -> None:
+    def count() -> int:
+        return (
+            len(fake_libxsmm.read_text().splitlines()) if fake_libxsmm.exists() else 0
+        )
+
+    source = gemm.libxsmm_gemm("kernel", 5, 6, 7, "hsw")
+    assert source == "void kernel(const float* A, const float* B, float* C) {}"
+    assert count() == 1
+
+    # in-process memo
+    gemm.libxsmm_gemm("kernel", 5, 6, 7, "hsw")
+    assert count() == 1
+
+    # on-disk cache, as in a new process
+    gemm.run_libxsmm.cache_clear()
+    assert gemm.libxsmm_gemm("kernel", 5, 6, 7, "hsw") == source
+    assert count() == 1
+
+    # other shape or arch
+    gemm.libxsmm_gemm("kernel", 5, 6, 8, "hsw")
+    gemm.libxsmm_gemm("kernel", 5, 6, 7, "skx")
+    assert count() == 3
+
+
+def test_libxsmm_params(
+    fake_libxsmm: Path, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(gemm, "libxsmm_params", {})
+
+    # not measured: the baseline
+    assert gemm.get_libxsmm_params("skx", 8, 8, 16) == gemm.LibxsmmParams("nopf", False)
+    assert gemm.get_libxsmm_params("hsw", 512, 512, 512) == gemm.LibxsmmParams()
+
+    measured = {("skx", 512, 512, 512): gemm.LibxsmmParams("BL2viaC", False)}
+    gemm.save_libxsmm_params(tmp_path / "params.json", measured)
+    gemm.set_libxsmm_params(gemm.load_libxsmm_params(tmp_path / "params.json"))
+    assert (
+        gemm.get_libxsmm_params("skx", 512, 512, 512)
+        == measured[("skx", 512, 512, 512)]
+    )
+    assert gemm.load_libxsmm_params(tmp_path / "missing.json") == {}
+
+    gemm.libxsmm_gemm("kernel", 5, 6, 7, "skx", "AL2_BL2viaC", True)
+    assert fake_libxsmm.read_text().split()[-5:] == [
+        "1",
+        "1",
+        "skx",
+        "AL2_BL2viaC",
+        "SP",
+    ]
+
+
+@pytest.mark.skipif(
+    shutil.which(gemm.LIBXSMM_PATH) is None, reason="libxsmm is not installed"
+)
+@pytest.mark.parametrize("prefetch", ["BL2viaC", "AL2_BL2viaC"])
+@pytest.mark.parametrize("aligned", [False, True], ids=["unaligned", "aligned"])
+@pytest.mark.parametrize("batch", [[], [3]], ids=["single", "batched"])
+def test_libxsmm_prefetch(
+    prefetch: str, aligned: bool, batch: list[int], monkeypatch: pytest.MonkeyPatch
+) -> None:
+    # the kernels that prefetch take the operands of the next call too
+    N, M, K = 19, 37, 24
+    params = gemm.LibxsmmParams(prefetch, aligned)
+    monkeypatch.setattr(
+        gemm,
+        "libxsmm_params",
+        {(arch, N, M, K): params for arch in gemm.LIBXSMM_VECTOR_BYTES},
+    )
+
+    # B is an input, a batched MatMul runs a kernel for each pair of matrices
+    graph = helper.make_graph(
+        [helper.make_node("MatMul", ["A", "B"], ["Y"])],
+        "test",
+        [
+            helper.make_tensor_value_info("A", TensorProto.FLOAT, batch + [N, M]),
+            helper.make_tensor_value_info("B", TensorProto.FLOAT, batch + [M, K]),
+        ],
+        [helper.make_tensor_value_info("Y", TensorProto.FLOAT, batch + [N, K])],
+    )
+    model = helper.make_model(
+        graph, opset_imports=[helper.make_opsetid("", 13)], ir_version=8
+    )
+    check_model(model, ["libxsmm"])
@@ -1,5 +1,13 @@
+import numpy as np
+import onnx
 import pytest
 import tensorflow as tf
+from onnx import TensorProto, helper, numpy_helper
+
+from onnx2code.checker import check_model_result
+import onnx2code.generator as generator_module
+from onnx2code.generator import Generator
+from onnx2code.util import get_attribute
 
 from ..util import check_keras
 
@@ -29,3 +37,122 @@ def test_transpose_perm(perm: list[int]) -> None:
     out = tf.keras.layers.Permute(perm)(input)
     model = tf.keras.Model(inputs=[input], outputs=[out])
     check_keras(model)
+
+
+@pytest.mark.parametrize("shape", [[8, 16, 24], [19, 70, 9], [1, 130, 67]])
+@pytest.mark.parametrize(
+    "perm",
+    [([3, 1, 2]), ([2, 3, 1]), ([1, 3, 2])],
+    ids=lambda x: ",".join(map(str, x)),
+)
+def test_transpose_blocked(shape: list[int], perm: list[int]) -> None:
+    # tiles of 8x8, with rows and columns left over
+    input = tf.keras.Input(shape=shape)
+    out = tf.keras.layers.Permute(perm)(input)
+    model = tf.keras.Model(inputs=[input], outputs=[out])
+    check_keras(model, threads=2)
+
+
+def transpose_model(
+    nodes: list[onnx.NodeProto],
+    inputs: dict[str, list[int]],
+    output_shape: list[int],
+    initializers: list[onnx.TensorProto] = [],
+) -> onnx.ModelProto:
+    # built by hand, tf2onnx would already simplify the transposes
+    graph = helper.make_graph(
+        nodes,
+        "test",
+        [
+            helper.make_tensor_value_info(name, TensorProto.FLOAT, shape)
+            for name, shape in inputs.items()
+        ],
+        [helper.make_tensor_value_info("Y", TensorProto.FLOAT, output_shape)],
+        initializers,
+    )
+    model = helper.make_model(
+        graph, opset_imports=[helper.make_opsetid("", 13)], ir_version=8
+    )
+    return onnx.shape_inference.infer_shapes(model)
+
+
+def check_transposes(
+    model: onnx.ModelProto,
+    variations: list[str],
+    remaining: int,
+    monkeypatch: pytest.MonkeyPatch,
+) -> Generator:
+    # onnxsim would merge or drop the transposes before _eliminate_transposes
+    monkeypatch.setattr(
+        generator_module.onnx_simplifier, "simplify", lambda model, **_: (model, True)
+    )
+
+    def transposes(nodes: list[onnx.NodeProto]) -> int:
+        return [node.op_type for node in nodes].count("Transpose")
+
+    generator = Generator(model, variations)
+    assert transposes(generator.nodes) == transposes(list(model.graph.node))
+    result = generator.generate()
+    assert transposes(generator.nodes) == remaining
+    check_model_result(model, result)
+    return generator
+
+
+@pytest.mark.parametrize(
+    "shape,first,second,remaining",
+    [
+        ([6, 10, 12], [1, 2, 0], [2, 0, 1], 0),
+        ([2, 6, 10, 12], [0, 2, 3, 1], [0, 3, 1, 2], 0),
+        ([6, 10, 12], [1, 2, 0], [1, 2, 0], 1),
+        ([2, 6, 10, 12], [0, 2, 3, 1], [3, 2, 1, 0], 1),
+    ],
+    ids=["cancel", "cancel-nhwc", "merge", "merge-nhwc"],
+)
+def test_transpose_pairs(
+    shape: list[int],
+    first: list[int],
+    second: list[int],
+    remaining: int,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    # consecutive transposes are merged or cancel out
+    output_shape = [shape[first[i]] for i in second]
+    model = transpose_model(
+        [
+            helper.make_node("Transpose", ["X"], ["T1"], perm=first),
+            helper.make_node("Transpose", ["T1"], ["T2"], perm=second),
+            helper.make_node("Relu", ["T2"], ["Y"]),
+        ],
+        {"X": shape},
+        output_shape,
+    )
+    check_transposes(model, [], remaining, monkeypatch)
+
+
+@pytest.mark.parametrize("variation", ["gemm-naive", "loop-tiling"])
+@pytest.mark.parametrize("operand", [0, 1], ids=["A", "B"])
+def test_transpose_gemm(
+    variation: str, operand: int, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    # the transpose is folded into transA/transB of the MatMul
+    N, M, K = 19, 12, 7
+    if operand == 0:
+        inputs = {"X": [M, N]}
+        matmul = helper.make_node("MatMul", ["T", "W"], ["Y"])
+        W = np.random.normal(size=[M, K]).astype(np.float32)
+    else:
+        inputs = {"X": [K, M]}
+        matmul = helper.make_node("MatMul", ["W", "T"], ["Y"])
+        W = np.random.normal(size=[N, M]).astype(np.float32)
+
+    model = transpose_model(
+        [helper.make_node("Transpose", ["X"], ["T"], perm=[1, 0]), matmul],
+        inputs,
+        [N, K],
+        [numpy_helper.from_array(W, "W")],
+    )
+    generator = check_transposes(model, [variation], 0, monkeypatch)
+
+    (node,) = generator.nodes
+    trans = "transA" if operand == 0 else "transB"
+    assert get_attribute(node, trans, 0) == 1
@@ -0,0 +1,113 @@
+import random
+
+import pytest
+
+from onnx2code.memory import (
+    STRATEGIES,
+    Records,
+    Result,
+    TensorUsageRecord,
+    best_fit,
+    branch_and_bound,
+    compare_layouts,
+    lower_bound,
+)
+
+
+def random_records(n: int, seed: int) -> Records:
+    rng = random.Random(seed)
+    records = []
+    for _ in range(n):
+        first_op = rng.randint(0, n // 2)
+        records.append(
+            TensorUsageRecord(
+                first_op, first_op + rng.randint(0, 4), rng.randint(1, 100)
+            )
+        )
+    return records
+
+
+def check_layout(records: Records, result: Result) -> None:
+    size, offsets = result
+    assert len(offsets) == len(records)
+
+    for i, a in enumerate(records):
+        offset_a = offsets[i]
+        assert offset_a is not None and offset_a >= 0
+        assert offset_a + a.size <= size
+
+        for j, b in enumerate(records[:i]):
+            offset_b = offsets[j]
+            assert offset_b is not None
+            if not (a.last_op < b.first_op or a.first_op > b.last_op):
+                # alive at the same time, must not share memory
+                assert offset_a + a.size <= offset_b or offset_b + b.size <= offset_a
+
+    assert size >= lower_bound(records)
+
+
+@pytest.mark.parametrize("strategy", STRATEGIES.keys())
+@pytest.mark.parametrize("seed", range(5))
+def test_strategy(strategy: str, seed: int) -> None:
+    records = random_records(60, seed)
+    check_layout(records, STRATEGIES[strategy](records))
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_branch_and_bound(seed: int) -> None:
+    records = random_records(8, seed)
+    layouts = compare_layouts(records)
+    exact = branch_and_bound(records, time_budget=10)
+
+    check_layout(records, exact)
+    assert exact[0] <= min(size for size, _ in layouts.values())
+
+
+def test_paper_example() -> None:
+    # example from the TFLite paper
+    records = [
+        TensorUsageRecord(0, 1, 32),
+        TensorUsageRecord(1, 4, 28),
+        TensorUsageRecord(2, 5, 36),
+        TensorUsageRecord(3, 5, 16),
+        TensorUsageRecord(4, 5, 8),
+        TensorUsageRecord(5, 7, 64),
+        TensorUsageRecord(6, 8, 10),
+        TensorUsageRecord(7, 8, 40),
+    ]
+    assert compare_layouts(records)["greedy_by_size"][0] == 124
+    assert branch_and_bound(records, time_budget=10)[0] == 124
+
+
+def reference_best_fit(records: Records, order: list[int]) -> Result:
+    # quadratic version, visits every placed tensor
+    offsets: list[int | None] = [None] * len(records)
+    placed: list[int] = []
+
+    for i in order:
+        t = records[i]
+        prev_offset, best_offset, smallest_gap = 0, None, None
+
+        for k in sorted(placed, key=lambda k: offsets[k]):  # type: ignore
+            rec, offset = records[k], offsets[k]
+            assert offset is not None
+            if rec.last_op < t.first_op or rec.first_op > t.last_op:
+                continue
+            gap = offset - prev_offset
+            if gap >= t.size and (smallest_gap is None or gap < smallest_gap):
+                smallest_gap, best_offset = gap, prev_offset
+            prev_offset = max(prev_offset, offset + rec.size)
+
+        offsets[i] = prev_offset if best_offset is None else best_offset
+        placed.append(i)
+
+    size = max((o + r.size for o, r in zip(offsets, records)), default=0)  # type: ignore
+    return size, offsets
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_best_fit(seed: int) -> None:
+    records = random_records(300, seed)
+    order = sorted(range(len(records)), key=lambda i: records[i].size, reverse=True)
+
+    assert best_fit(records, order) == reference_best_fit(records, order)
@@ -0,0 +1,33 @@
+import pytest
+import tensorflow as tf
+
+from onnx2code.ops.gemm_tiling.GEMM import MICROKERNEL_PARAMS, portable_tiling_params
+from onnx2code.targets import TARGETS, cpu_features, parse_targets
+from tests.util import check_keras
+
+
+@pytest.mark.parametrize("target", list(TARGETS))
+@pytest.mark.parametrize("variation", ["loop-tiling", "gemm-naive"])
+def test_dispatch(target: str, variation: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    features = cpu_features()
+    if not all(f.replace(".", "_") in features for f in TARGETS[target].cpu):
+        pytest.skip(f"the CPU doesn't support {target}")
+
+    # forces the copy of the kernels that runs
+    monkeypatch.setenv("O2C_TARGET", target)
+
+    input = tf.keras.Input((9, 9, 2))
+    x = tf.keras.layers.Conv2D(4, 3, activation="relu")(input)
+    x = tf.keras.layers.Flatten()(x)
+    x = tf.keras.layers.Dense(37)(x)
+    model = tf.keras.Model(inputs=[input], outputs=[x])
+    check_keras(model, variations=[variation], threads=2, targets=list(TARGETS))
+
+
+def test_portable_tiling_params() -> None:
+    # the microkernel of the narrowest target, generic if it has none
+    params = portable_tiling_params(parse_targets(["avx512", "avx2"]))
+    assert params == MICROKERNEL_PARAMS["avx2"]
+    params = portable_tiling_params(parse_targets(["avx512", "avx2", "sse4.2"]))
+    assert params == MICROKERNEL_PARAMS["generic"]
+    assert portable_tiling_params([]) == MICROKERNEL_PARAMS["generic"]
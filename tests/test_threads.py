@@ -0,0 +1,35 @@
+import pytest
+import tensorflow as tf
+
+from tests.util import check_keras
+
+
+@pytest.mark.parametrize("threads", [2, 3, 8])
+@pytest.mark.parametrize("variation", ["c", "loop-tiling"])
+def test_threads(threads: int, variation: str) -> None:
+    input = tf.keras.Input((19, 19, 3))
+    x = tf.keras.layers.Conv2D(8, 3, activation="relu")(input)
+    x = tf.keras.layers.MaxPooling2D(2)(x)
+    x = tf.keras.layers.Conv2D(5, 3, padding="same", bias_initializer="uniform")(x)
+    x = tf.keras.layers.AveragePooling2D(2, padding="same")(x)
+    x = tf.keras.layers.Flatten()(x)
+    x = tf.keras.layers.Dense(37, activation="relu")(x)
+    x = tf.keras.layers.Dense(10, activation="softmax")(x)
+    model = tf.keras.Model(inputs=[input], outputs=[x])
+    check_keras(model, [variation], threads=threads)
+
+
+@pytest.mark.parametrize("threads", [2, 4, 8])
+def test_branches(threads: int) -> None:
+    # Inception-like block, the branches are independent
+    # (3 of them: more branches than threads with 2, teams of threads with 4 and 8)
+    input = tf.keras.Input((12, 12, 4))
+    a = tf.keras.layers.Conv2D(6, 1, activation="relu")(input)
+    b = tf.keras.layers.Conv2D(3, 1)(input)
+    b = tf.keras.layers.Conv2D(5, 3, padding="same", activation="relu")(b)
+    c = tf.keras.layers.MaxPooling2D(3, strides=1, padding="same")(input)
+    c = tf.keras.layers.Conv2D(4, 1)(c)
+    x = tf.keras.layers.Concatenate()([a, b, c])
+    x = tf.keras.layers.Conv2D(7, 3, activation="relu")(x)
+    model = tf.keras.Model(inputs=[input], outputs=[x])
+    check_keras(model, ["c"], threads=threads)
@@ -0,0 +1,12 @@
+import tensorflow as tf
+
+from tests.util import check_keras
+
+
+def test_embed_weights() -> None:
+    input = tf.keras.Input((9, 9, 2))
+    x = tf.keras.layers.Conv2D(4, 3, activation="relu")(input)
+    x = tf.keras.layers.Flatten()(x)
+    x = tf.keras.layers.Dense(7)(x)
+    model = tf.keras.Model(inputs=[input], outputs=[x])
+    check_keras(model, embed_weights=True)
@@ -4,6 +4,18 @@ import tf2onnx
 from onnx2code.checker import check_model
 
 
-def check_keras(model: tf.keras.Model, variations: list[str] = []) -> None:
+def check_keras(
+    model: tf.keras.Model,
+    variations: list[str] = [],
+    threads: int = 1,
+    embed_weights: bool = False,
+    targets: list[str] = [],
+) -> None:
     model_proto, _ = tf2onnx.convert.from_keras(model)
-    check_model(model_proto, variations)
+    check_model(
+        model_proto,
+        variations,
+        threads=threads,
+        embed_weights=embed_weights,
+        targets=targets,
+    )